@@ -0,0 +1,2 @@
+# 压测脚本，不属于 flaskr 包本身。用法见 benchmarks/bench.py：
+#     python -m benchmarks.bench --posts 100000 --output bench.json
@@ -0,0 +1,313 @@
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from flaskr import create_app
+from flaskr.db import close_pools, init_db
+
+from . import datasets
+
+# flaskr 压测：生成数据集，用 Flask test client（不经过网络，测的是应用本身）和本机上真正的 WSGI server
+# （包括 HTTP 解析和 socket）两种方式跑各个 view，输出 JSON 格式的吞吐量、延迟分位数和内存峰值。
+#
+#     python -m benchmarks.bench --users 100 --posts 100000 --output bench.json
+#     python -m benchmarks.bench --baseline bench.json        # exits with 1 on a regression
+#
+# Latency is measured per request in the client; throughput is successful requests per wall-clock
+# second across all --concurrency workers.
+
+
+class TestClientDriver(object):
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        response.close()
+        return response.status_code
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    # HTTP/1.1 so the benchmark reuses connections like a browser would
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args):
+        # 不打印每个请求的访问日志，否则测的主要是终端输出的速度
+        pass
+
+
+class HTTPDriver(object):
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port)
+        self.cookies = {}
+
+    def request(self, method, path, data=None):
+        headers = {}
+        body = None
+
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookies:
+            headers['Cookie'] = '; '.join('{}={}'.format(*item) for item in self.cookies.items())
+
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        response.read()
+
+        for header in response.headers.get_all('Set-Cookie') or ():
+            name, _, value = header.split(';', 1)[0].partition('=')
+            if value and 'Expires=Thu, 01 Jan 1970' not in header:
+                self.cookies[name] = value
+            else:
+                self.cookies.pop(name, None)
+
+        return response.status
+
+    def close(self):
+        self.connection.close()
+
+
+def login(driver, worker):
+    return driver.request('POST', '/auth/login', {
+        'username': datasets.username(worker), 'password': datasets.PASSWORD,
+    })
+
+
+# 每个场景：(是否需要先登录, 每个 worker 需要预先准备的文章数, 发一次请求的函数)
+SCENARIOS = {
+    'index': (False, 0, lambda driver, worker, ids, i: driver.request('GET', '/')),
+    'index_logged_in': (True, 0, lambda driver, worker, ids, i: driver.request('GET', '/')),
+    'login': (False, 0, lambda driver, worker, ids, i: login(driver, worker)),
+    'create': (True, 0, lambda driver, worker, ids, i: driver.request(
+        'POST', '/create', {'title': 'bench {}'.format(i), 'body': 'created by the benchmark'})),
+    'update': (True, 1, lambda driver, worker, ids, i: driver.request(
+        'POST', '/{}/update'.format(ids[0]), {'title': 'updated {}'.format(i), 'body': 'updated'})),
+    'delete': (True, None, lambda driver, worker, ids, i: driver.request(
+        'POST', '/{}/delete'.format(ids[i]))),
+}
+
+
+def percentile(values, p):
+    # nearest-rank，values 已经排好序
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+def run_scenario(app, make_driver, name, requests, concurrency):
+    needs_login, prepared, send = SCENARIOS[name]
+    per_worker = max(1, requests // concurrency)
+    workers = []
+
+    # 准备阶段不计时：登录，准备好要修改/删除的文章
+    db = sqlite3.connect(app.config['DATABASE'])
+    for worker in range(concurrency):
+        driver = make_driver()
+        if needs_login:
+            login(driver, worker)
+        count = per_worker if prepared is None else prepared
+        ids = datasets.add_posts(db, datasets.username(worker), count) if count else []
+        workers.append((driver, worker, ids))
+    db.close()
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency + 1)
+
+    def work(driver, worker, ids):
+        local = []
+        failed = 0
+        barrier.wait()
+        for i in range(per_worker):
+            start = time.perf_counter()
+            status = send(driver, worker, ids, i)
+            elapsed = time.perf_counter() - start
+            if status >= 400:
+                failed += 1
+            else:
+                local.append(elapsed)
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=work, args=args) for args in workers]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    for driver, _, _ in workers:
+        if hasattr(driver, 'close'):
+            driver.close()
+
+    latencies.sort()
+    return {
+        'requests': per_worker * concurrency,
+        'errors': errors[0],
+        'seconds': wall,
+        'throughput_rps': len(latencies) / wall if wall else None,
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p95_ms': _ms(percentile(latencies, 95)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+        'max_ms': _ms(latencies[-1] if latencies else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是 KB，macOS 是字节
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def compare(results, baseline, tolerance):
+    # 和保存下来的基线比较：吞吐量下降或 p95 延迟上升超过 tolerance（比例）就算退化
+    scenarios = {}
+    regressions = []
+
+    for driver, current_results in results['results'].items():
+        for name, current in current_results.items():
+            previous = baseline.get('results', {}).get(driver, {}).get(name)
+            if not previous or not previous.get('throughput_rps') or not previous.get('p95_ms'):
+                continue
+
+            key = '{}/{}'.format(driver, name)
+            throughput = (current['throughput_rps'] or 0) / previous['throughput_rps'] - 1
+            p95 = (current['p95_ms'] or 0) / previous['p95_ms'] - 1
+            scenarios[key] = {'throughput_change': throughput, 'p95_change': p95}
+
+            if throughput < -tolerance or p95 > tolerance:
+                regressions.append(key)
+
+    return {'tolerance': tolerance, 'scenarios': scenarios, 'regressions': regressions}
+
+
+def run(args):
+    instance = tempfile.mkdtemp(prefix='flaskr-bench-')
+    config = {
+        'SECRET_KEY': 'bench',
+        'DATABASE': os.path.join(instance, 'flaskr.sqlite'),
+        # 所有请求都来自 127.0.0.1，不关掉限流的话测的就是 429
+        'RATELIMIT_ENABLED': False,
+    }
+    if args.hash_method:
+        config['PASSWORD_HASH_METHOD'] = args.hash_method
+    if args.write_queue != 'off':
+        config['WRITE_QUEUE_ENABLED'] = True
+        config['WRITE_QUEUE_WAIT'] = args.write_queue == 'wait'
+    app = create_app(config)
+
+    try:
+        with app.app_context():
+            init_db()
+
+        db = sqlite3.connect(config['DATABASE'])
+        started = time.perf_counter()
+        datasets.generate(db, users=max(args.users, args.concurrency), posts=args.posts,
+                          seed=args.seed, hash_method=app.config['PASSWORD_HASH_METHOD'])
+        db.close()
+        generate_seconds = time.perf_counter() - started
+
+        results = {}
+        scenarios = args.scenarios.split(',')
+
+        for driver in args.drivers.split(','):
+            if driver == 'testclient':
+                results[driver] = {
+                    name: run_scenario(app, lambda: TestClientDriver(app), name, args.requests, args.concurrency)
+                    for name in scenarios
+                }
+            elif driver == 'wsgi':
+                server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=KeepAliveHandler)
+                thread = threading.Thread(target=server.serve_forever, daemon=True)
+                thread.start()
+                try:
+                    results[driver] = {
+                        name: run_scenario(app, lambda: HTTPDriver('127.0.0.1', server.port),
+                                           name, args.requests, args.concurrency)
+                        for name in scenarios
+                    }
+                finally:
+                    server.shutdown()
+            else:
+                raise SystemExit('Unknown driver {!r}'.format(driver))
+
+        return {
+            'meta': {
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'users': max(args.users, args.concurrency),
+                'posts': args.posts,
+                'requests': args.requests,
+                'concurrency': args.concurrency,
+                'write_queue': args.write_queue,
+                'generate_seconds': generate_seconds,
+            },
+            'results': results,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+    finally:
+        close_pools(app)
+        shutil.rmtree(instance, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the flaskr views.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--drivers', default='testclient,wsgi')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--hash-method', help='PASSWORD_HASH_METHOD for the app and the generated users')
+    parser.add_argument('--write-queue', choices=('off', 'wait', 'relaxed'), default='off',
+                        help='run create/update/delete through flaskr.writer')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    status = 0
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compare(report, json.load(f), args.tolerance)
+        if report['comparison']['regressions']:
+            status = 1
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
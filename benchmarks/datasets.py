@@ -0,0 +1,86 @@
+import random
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+# 生成压测用的数据：N 个用户，M 篇文章。正文长度服从对数正态分布，大部分是一两百个词的短文，
+# 少数是几千词的长文，和真实博客比较接近。
+# Every user gets the same password (PASSWORD) and the same hash, so generating a large dataset
+# doesn't spend minutes in the password hash.
+
+PASSWORD = 'password'
+
+WORDS = (
+    'flask sqlite request response template query index cache session cookie blueprint view '
+    'route context cursor commit transaction connection thread worker server client header '
+    'latency throughput page post author title body user login register update delete create '
+    'the a of and to in is it that for on with as was at by this be from or have not are but'
+).split()
+
+
+def username(i):
+    return 'user{}'.format(i)
+
+
+def random_body(rng):
+    # 中位数大约 150 个词，截断在 5 到 5000 之间
+    words = int(min(max(rng.lognormvariate(5.0, 0.8), 5), 5000))
+    paragraphs = []
+    while words > 0:
+        length = min(words, rng.randint(30, 120))
+        paragraphs.append(' '.join(rng.choice(WORDS) for _ in range(length)))
+        words -= length
+    return '\n\n'.join(paragraphs)
+
+
+def generate(db, users=100, posts=10000, seed=0, hash_method='pbkdf2:sha256:600000', batch_size=5000):
+    # db is a sqlite3 connection to a database created by init_db(); returns the number of rows written
+    rng = random.Random(seed)
+    pwhash = generate_password_hash(PASSWORD, hash_method)
+
+    db.executemany(
+        'INSERT INTO user (username, password) VALUES (?, ?)',
+        ((username(i), pwhash) for i in range(users))
+    )
+    user_ids = [row[0] for row in db.execute('SELECT id FROM user ORDER BY id')]
+
+    # 文章的发表时间均匀分布在过去两年里，按时间顺序插入
+    start = datetime(2020, 1, 1)
+    step = timedelta(days=730) / max(posts, 1)
+    batch = []
+
+    for i in range(posts):
+        batch.append((
+            ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 10))).capitalize(),
+            random_body(rng),
+            rng.choice(user_ids),
+            (start + step * i).strftime('%Y-%m-%d %H:%M:%S'),
+        ))
+
+        if len(batch) >= batch_size:
+            _insert_posts(db, batch)
+            batch = []
+
+    if batch:
+        _insert_posts(db, batch)
+
+    return len(user_ids) + posts
+
+
+def _insert_posts(db, batch):
+    db.executemany('INSERT INTO post (title, body, author_id, created) VALUES (?, ?, ?, ?)', batch)
+    db.commit()
+
+
+def add_posts(db, author, count):
+    # 给 update / delete 场景准备的文章，返回新文章的 id
+    cursor = db.execute('SELECT id FROM user WHERE username = ?', (author,))
+    author_id = cursor.fetchone()[0]
+    ids = []
+    for i in range(count):
+        ids.append(db.execute(
+            'INSERT INTO post (title, body, author_id) VALUES (?, ?, ?)',
+            ('bench {}'.format(i), 'benchmark post', author_id)
+        ).lastrowid)
+    db.commit()
+    return ids
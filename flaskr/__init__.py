@@ -8,11 +8,23 @@
 #  __init__ 是包的标志.
 
 import os
+import time
+
 from flask import Flask
 
 
 # create a Flask instance inside a function as application factory
 def create_app(test_config=None):
+    # 每个阶段花的时间记在 app.extensions['flaskr.startup'] 里，flask startup-profile 会显示出来
+    phases = []
+    started = time.perf_counter()
+
+    def phase(name):
+        nonlocal started
+        now = time.perf_counter()
+        phases.append((name, now - started))
+        started = now
+
     # 创建 flask 实例，其他所有的东西都是注册在这个实例上面的，为这个实例服务。
     app = Flask(__name__, instance_relative_config=True)
     # __name__应该是用来初始化 app.instance_path 的
@@ -28,6 +40,119 @@ def create_app(test_config=None):
         # 设置sqlite路径
         # app.instance_path 以后会配置
         DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite'),
+        # blog.index 每页显示的文章数
+        # number of posts per page on the index, see blog.fetch_page
+        POSTS_PER_PAGE=20,
+        # /archive 每次从游标读取的行数，见 blog.archive
+        ARCHIVE_BATCH_SIZE=500,
+        # 数据库连接池，见 flaskr.db.ConnectionPool
+        # get_db() hands out one of DB_POOL_SIZE read-write connections (a single, serialized writer by default),
+        # get_read_db() one of DB_READ_POOL_SIZE read-only ones. A request waits up to DB_POOL_TIMEOUT
+        # seconds for a free connection (503 after that), and a connection is reopened after DB_POOL_MAX_USES requests.
+        # 存储后端，见 flaskr.db.BACKENDS。None means sqlite:///<DATABASE>; another scheme connects to a
+        # database server instead ('flaskrdb://' is the tests' stand-in). get_read_db() reads from DATABASE_REPLICA_URLS in turn (the primary
+        # when empty); a user who wrote in the last DB_READ_YOUR_WRITES seconds reads from the primary.
+        DATABASE_URL=None,
+        DATABASE_REPLICA_URLS=[],
+        DB_READ_YOUR_WRITES=5.0,
+        DB_POOL_SIZE=1,
+        DB_READ_POOL_SIZE=8,
+        DB_POOL_TIMEOUT=10.0,
+        DB_POOL_MAX_USES=1000,
+        # prepared statements kept per connection (sqlite3's default is 128), see flaskr.queries
+        DB_CACHED_STATEMENTS=256,
+        # 第一个请求之前用 EXPLAIN QUERY PLAN 检查 flaskr.queries 里的所有语句，热点查询全表扫描就报错
+        QUERY_PLAN_CHECK=True,
+        # g.user 的缓存，见 flaskr.cache.get_cache 和 flaskr.auth.load_user
+        # 'memory' keeps USER_CACHE_SIZE rows per worker; 'shared' uses SHARED_CACHE_CLIENT
+        # (a memcached-style client, defaults to the in-process flaskr.cache.LocalCacheClient stand-in).
+        USER_CACHE_BACKEND='memory',
+        USER_CACHE_SIZE=1024,
+        USER_CACHE_TTL=300,
+        SHARED_CACHE_CLIENT=None,
+        # blog.index 的整页缓存（只缓存匿名用户的页面）和每篇文章的 HTML 片段缓存，都按条目数 LRU 淘汰
+        PAGE_CACHE_BACKEND='memory',
+        PAGE_CACHE_SIZE=256,
+        PAGE_CACHE_TTL=None,
+        FRAGMENT_CACHE_BACKEND='memory',
+        FRAGMENT_CACHE_SIZE=4096,
+        FRAGMENT_CACHE_TTL=None,
+        # 服务器端 session，见 flaskr.sessions。None keeps Flask's signed cookie; 'cache' stores sessions in
+        # get_cache('session') (SESSION_CACHE_BACKEND 'memory' or 'shared'), 'sqlite' in a table of the database.
+        SESSION_STORE=None,
+        SESSION_CACHE_BACKEND='memory',
+        SESSION_CACHE_SIZE=10000,
+        SESSION_CACHE_TTL=None,
+        SESSION_POOL_SIZE=2,
+        # 密码哈希，见 flaskr.hashing。At most HASH_WORKERS hashes run at once and HASH_QUEUE_DEPTH more may wait;
+        # beyond that register/login answer 503 right away. Changing PASSWORD_HASH_METHOD (any werkzeug
+        # method string, e.g. 'pbkdf2:sha256:600000') rehashes each password on its next successful login.
+        PASSWORD_HASH_METHOD='scrypt',
+        HASH_WORKERS=4,
+        HASH_QUEUE_DEPTH=16,
+        # 性能监控，见 flaskr.metrics。Off by default; when on, adds Server-Timing headers and /metrics.
+        METRICS_ENABLED=False,
+        METRICS_SERVER_TIMING=True,
+        METRICS_N_PLUS_ONE_THRESHOLD=10,
+        # 限流，见 flaskr.ratelimit。RATELIMITS maps a scope to (requests, seconds): a token bucket per client
+        # address ('ip') and per submitted username ('username') that holds `requests` tokens and refills
+        # over `seconds`. Login, register and create take a token on POST and answer 429 when one is empty.
+        # 'memory' buckets are per worker; 'shared' keeps them in SHARED_CACHE_CLIENT for all workers.
+        RATELIMIT_ENABLED=True,
+        RATELIMIT_STORAGE='memory',
+        RATELIMIT_SWEEP_INTERVAL=60.0,
+        RATELIMITS={
+            'ip': (30, 60),
+            'username': (10, 300),
+        },
+        # 准入控制：最多同时处理 ADMISSION_MAX_REQUESTS 个请求，排队超过 ADMISSION_TIMEOUT 秒的返回 503。
+        # None turns it off.
+        ADMISSION_MAX_REQUESTS=64,
+        ADMISSION_TIMEOUT=1.0,
+        # 后台写队列，见 flaskr.writer。When enabled, create/update/delete hand their statements to one writer
+        # thread that commits up to WRITE_QUEUE_BATCH_SIZE of them together, waiting at most WRITE_QUEUE_MAX_DELAY
+        # seconds for a batch to fill. WRITE_QUEUE_WAIT=False returns before the write is committed.
+        WRITE_QUEUE_ENABLED=False,
+        WRITE_QUEUE_WAIT=True,
+        WRITE_QUEUE_BATCH_SIZE=64,
+        WRITE_QUEUE_MAX_DELAY=0.005,
+        # Jinja 模板的字节码缓存，见 flaskr.startup。TEMPLATE_CACHE_DIR defaults to instance/jinja-cache.
+        TEMPLATE_BYTECODE_CACHE=True,
+        TEMPLATE_CACHE_DIR=None,
+        # 每次渲染前 stat 模板文件看有没有改过。None follows debug mode, so it is off in production
+        # and on under `flask run --debug`.
+        TEMPLATES_AUTO_RELOAD=None,
+        # 静态文件，见 flaskr.assets。`flask build-assets` writes hashed, precompressed copies to ASSETS_DIR
+        # (instance/assets by default); they are cached by browsers for ASSETS_MAX_AGE seconds.
+        ASSETS_DIR=None,
+        ASSETS_MAX_AGE=31536000,
+        ASSETS_COMPRESS_MIN_SIZE=256,
+        # 响应压缩，见 flaskr.compress。gzip/deflate (br if the brotli package is installed) from Accept-Encoding,
+        # for responses of COMPRESS_MIMETYPES of at least COMPRESS_MIN_SIZE bytes or of unknown (streamed) length.
+        COMPRESS_ENABLED=True,
+        COMPRESS_MIN_SIZE=500,
+        COMPRESS_LEVEL=6,
+        COMPRESS_BROTLI_QUALITY=4,
+        COMPRESS_MIMETYPES=['text/html', 'text/css', 'text/plain', 'application/json', 'application/javascript'],
+        # flaskr.asgi 处理请求的线程数，只在用 ASGI server 运行时有用。Request bodies are read into memory first;
+        # larger ones than MAX_CONTENT_LENGTH (ASGI_MAX_BODY bytes when that is None) get 413.
+        ASGI_WORKERS=32,
+        ASGI_MAX_BODY=1024 * 1024,
+        # PRAGMA name -> value, applied in this order once to every new connection (flaskr.db.ConnectionPool).
+        # WAL 模式下读和写互不阻塞：/ 的读请求不会再被 /create、/<id>/update 的写锁挡住。
+        SQLITE_PRAGMAS={
+            # wait up to 5s for a lock instead of failing with "database is locked"
+            'busy_timeout': 5000,
+            # readers and the single writer run side by side; init-db and `flask db upgrade` make this persistent
+            'journal_mode': 'WAL',
+            # in WAL mode NORMAL is still safe against corruption and skips most fsyncs
+            'synchronous': 'NORMAL',
+            # negative means KiB: 64 MiB page cache per connection
+            'cache_size': -64000,
+            # read the first 256 MiB of the file through mmap instead of read() calls
+            'mmap_size': 268435456,
+            'temp_store': 'MEMORY',
+        },
     )
 
     # 覆盖默认的配置
@@ -39,13 +164,23 @@ def create_app(test_config=None):
         app.config.from_pyfile('config.py', silent=True)
 
     else:
-        app.config.from_pyfile(test_config)
+        # test_config is a dict, e.g. {'TESTING': True, 'DATABASE': ...} from tests/conftest.py
+        app.config.from_mapping(test_config)
+
+    # 路径要自己建，已经存在的话（除了第一次启动都是这样）不用再调用 makedirs
+    if not os.path.isdir(app.instance_path):
+        os.makedirs(app.instance_path, exist_ok=True)
+    phase('config')
 
-    # 路径要自己建
-    try:
-        os.makedirs(app.instance_path)
-    except OSError:
-        pass
+    # 模板的字节码缓存要在第一次用到 app.jinja_env 之前配置，blueprint 注册模板函数的时候就会用到
+    from . import startup
+    startup.init_app(app)
+    phase('startup')
+
+    # url_for('static') 通过 manifest 返回带哈希的文件名
+    from . import assets
+    assets.init_app(app)
+    phase('assets')
 
     # 直接在flask 实例上注册
     @app.route('/hello')
@@ -55,15 +190,42 @@ def create_app(test_config=None):
     # 因为采用了 create_app 工厂方法，其他函数无法感知 flask 实例 app ,所以这里设置了调用。
     from . import db
     db.init_app(app)
+    phase('db')
+
+    # 所有的 SQL 语句和启动时的查询计划检查
+    from . import queries
+    queries.init_app(app)
+    phase('queries')
+
+    # 性能监控要在 blueprint 之前注册，这样它的 before_request 最先执行。关闭的时候连模块都不导入
+    if app.config['METRICS_ENABLED']:
+        from . import metrics
+        metrics.init_app(app)
+        phase('metrics')
+
+    # 服务器端 session，关闭的时候不导入
+    if app.config['SESSION_STORE']:
+        from . import sessions
+        sessions.init_app(app)
+        phase('sessions')
+
+    # 限流和并发上限，也要在 blueprint 之前
+    from . import ratelimit
+    ratelimit.init_app(app)
+    phase('ratelimit')
 
     # 同样的原因，需要在这里注册 Blueprint
     # The authentication Blueprint will have views to register new users and to login and logout
     from . import auth
     app.register_blueprint(auth.bp)
+    # g.user 在第一次被读取时才查询
+    app.app_ctx_globals_class = auth.LazyUserGlobals
+    phase('auth')
 
     from . import blog
     # Import and register the blueprint from the factory using app.register_blueprint().
     app.register_blueprint(blog.bp)
+    phase('blog')
 
     '''
     app.add_url_rule() associates the endpoint name 'index' with the / url 
@@ -81,4 +243,12 @@ def create_app(test_config=None):
     Then the index and blog.index endpoints and URLs would be different.
     '''
 
+    # 响应压缩包在 wsgi_app 外面，关闭的时候不导入
+    if app.config['COMPRESS_ENABLED']:
+        from . import compress
+        compress.init_app(app)
+        phase('compress')
+
+    app.extensions['flaskr.startup'] = phases
+
     return app
@@ -0,0 +1,180 @@
+import asyncio
+import contextvars
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from flaskr import create_app
+from flaskr.db import close_pools
+
+# ASGI 入口：用 uvicorn / hypercorn 之类的 ASGI server 运行 flaskr，
+#     uvicorn --factory flaskr.asgi:create_asgi_app
+# ASGI server 在一个事件循环里管理所有的连接，空闲的 keep-alive 连接不占线程；只有正在处理的请求才会
+# 在 ASGI_WORKERS 个线程的线程池里运行同样的 Flask app（同样的路由、模板和 session）。
+# The views stay synchronous: SQLite and the password hash block whichever thread runs them, so they
+# run on this fixed-size executor (and, below it, on the flaskr.db pools and the flaskr.hashing pool)
+# instead of on the event loop. Responses are sent chunk by chunk, so /archive still streams.
+
+
+class ASGIAdapter(object):
+    def __init__(self, app, workers=32, max_body=1024 * 1024):
+        self.app = app
+        # 请求体整个读进内存，所以要有上限，超过的请求直接 413，不进线程池
+        self.max_body = max_body
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='flaskr-asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type {!r}'.format(scope['type']))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                close_pools(self.app)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        # flaskr 的请求体只有表单，很小，直接读完。Both the announced Content-Length and the bytes
+        # actually received are checked against max_body, so a chunked upload can't get past it either.
+        length = dict(scope.get('headers', ())).get(b'content-length', b'0')
+        if not length.isdigit() or int(length) > self.max_body:
+            await self.reject(send, 413 if length.isdigit() else 400)
+            return
+
+        body = io.BytesIO()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if body.tell() > self.max_body:
+                await self.reject(send, 413)
+                return
+            more_body = message.get('more_body', False)
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers
+            ]
+
+        def call():
+            iterable = self.app(build_environ(scope, body), start_response)
+            return iterable, iter(iterable)
+
+        def next_chunk(chunks):
+            # 每次只在线程池里取一块，取完立刻发出去，流式响应不会被缓存在内存里
+            for chunk in chunks:
+                if chunk:
+                    return chunk
+            return None
+
+        # Flask keeps the request and app context in context variables, which belong to the thread that
+        # set them. Each step of the response may run on a different pool thread, so all of them run
+        # inside the same copied context: the generator of a streamed response still finds its request.
+        # 同一个请求的各个步骤是依次执行的，不会同时进入这个 context
+        context = contextvars.copy_context()
+
+        def run(f, *args):
+            return loop.run_in_executor(self.executor, context.run, f, *args)
+
+        iterable, chunks = await run(call)
+        started = False
+
+        try:
+            while True:
+                chunk = await run(next_chunk, chunks)
+
+                if not started:
+                    await send({
+                        'type': 'http.response.start',
+                        'status': response['status'],
+                        'headers': response['headers'],
+                    })
+                    started = True
+
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            # close() 触发 Flask 的 teardown，把数据库连接还回连接池
+            if hasattr(iterable, 'close'):
+                await run(iterable.close)
+
+
+    async def reject(self, send, status):
+        body = HTTPStatus(status).phrase.encode('latin1')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'text/plain'), (b'content-length', str(len(body)).encode('latin1'))],
+        })
+        await send({'type': 'http.response.body', 'body': body, 'more_body': False})
+
+
+def build_environ(scope, body):
+    # PEP 3333: 路径要先按 UTF-8 编码，再当成 latin-1 解码
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # 请求体已经完整读进内存，没有 Content-Length 的请求（chunked）也可以读到结尾
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = name
+        else:
+            key = 'HTTP_' + name
+
+        if key in environ:
+            # 同名的多个 header 用逗号合并（Cookie 用分号）
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+
+    return environ
+
+
+def create_asgi_app(test_config=None):
+    app = create_app(test_config)
+    return ASGIAdapter(
+        app,
+        workers=app.config['ASGI_WORKERS'],
+        max_body=app.config['MAX_CONTENT_LENGTH'] or app.config['ASGI_MAX_BODY'],
+    )
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import with_appcontext
+
+# 静态文件的构建和缓存。`flask build-assets` 在部署的时候运行一次：
+# every file under flaskr/static is copied to ASSETS_DIR (instance/assets by default) under a name
+# that contains a hash of its content, e.g. style.css -> style.1f3870be274f.css, together with
+# .gz and (when the brotli package is installed) .br variants of the text files. manifest.json maps the
+# original names to the hashed ones, and url_for('static', filename='style.css') returns the hashed URL.
+# The content behind a hashed URL never changes, so it is sent with
+# `Cache-Control: public, max-age=<ASSETS_MAX_AGE>, immutable` and browsers stop revalidating it; a
+# changed file gets a new name. The precompressed variant is picked from Accept-Encoding.
+# Without a manifest (e.g. in development) url_for and /static behave exactly as before.
+
+MANIFEST = 'manifest.json'
+
+# 压缩以后比原文件小得多的类型；图片、字体本身已经压缩过了
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+# (Content-Encoding, file suffix), in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+class Assets(object):
+    def __init__(self, directory):
+        self.directory = directory
+        # original name -> hashed name
+        self.files = {}
+        self.hashed = set()
+        # hashed name -> encodings that have a precompressed variant
+        self.encodings = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+
+        self.files = manifest.get('files', {})
+        self.hashed = set(self.files.values())
+        self.encodings = manifest.get('encodings', {})
+
+
+def get_assets(app=None):
+    app = app or current_app._get_current_object()
+    return app.extensions['flaskr.assets']
+
+
+def hashed_name(name, content):
+    root, ext = os.path.splitext(name)
+    return '{}.{}{}'.format(root, hashlib.sha256(content).hexdigest()[:12], ext)
+
+
+def _compressors():
+    import gzip
+
+    compressors = [('gzip', '.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        compressors.insert(0, ('br', '.br', lambda data: brotli.compress(data, quality=11)))
+    return compressors
+
+
+def build(source, directory, min_size=256):
+    # Returns the manifest that was written. Files from earlier builds are left in place, so pages
+    # rendered before a deploy can still load the assets they link to.
+    files = {}
+    encodings = {}
+    compressors = _compressors()
+
+    for root, dirs, names in os.walk(source):
+        for filename in sorted(names):
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, source).replace(os.sep, '/')
+
+            with open(path, 'rb') as f:
+                content = f.read()
+
+            hashed = files[name] = hashed_name(name, content)
+            target = os.path.join(directory, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(content)
+
+            mimetype = mimetypes.guess_type(filename)[0] or ''
+            if len(content) < min_size or not mimetype.startswith(COMPRESSIBLE):
+                continue
+
+            for encoding, suffix, compress in compressors:
+                compressed = compress(content)
+                # 压缩了反而没变小的就不要了
+                if len(compressed) < len(content):
+                    with open(target + suffix, 'wb') as f:
+                        f.write(compressed)
+                    encodings.setdefault(hashed, []).append(encoding)
+
+    manifest = {'files': files, 'encodings': encodings}
+    # 先写临时文件再改名，正在运行的 worker 不会读到写了一半的 manifest
+    with open(os.path.join(directory, MANIFEST + '.tmp'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(os.path.join(directory, MANIFEST + '.tmp'), os.path.join(directory, MANIFEST))
+    return manifest
+
+
+def hashed_url(endpoint, values):
+    # url_defaults: url_for('static', filename='style.css') -> /static/style.<hash>.css
+    if endpoint == 'static':
+        hashed = get_assets().files.get(values.get('filename'))
+        if hashed is not None:
+            values['filename'] = hashed
+
+
+def serve_static(filename):
+    # Replaces Flask's static view. Hashed names come from ASSETS_DIR, everything else from
+    # flaskr/static as before.
+    assets = get_assets()
+    if filename not in assets.hashed:
+        return current_app.send_static_file(filename)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    variants = assets.encodings.get(filename, ())
+    encoding = None
+    for name, suffix in ENCODINGS:
+        if name in variants and request.accept_encodings[name]:
+            encoding = name
+            filename += suffix
+            break
+
+    response = send_from_directory(
+        assets.directory, filename, mimetype=mimetype, max_age=current_app.config['ASSETS_MAX_AGE']
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    if encoding is not None:
+        response.content_encoding = encoding
+    if variants:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+@click.command('build-assets')
+@click.option('--clean', is_flag=True, help='Remove the assets of earlier builds first.')
+@with_appcontext
+def build_assets_command(clean):
+    """Copy the static files to content-hashed, precompressed assets."""
+    assets = get_assets()
+    if clean and os.path.isdir(assets.directory):
+        shutil.rmtree(assets.directory)
+    os.makedirs(assets.directory, exist_ok=True)
+
+    manifest = build(current_app.static_folder, assets.directory, current_app.config['ASSETS_COMPRESS_MIN_SIZE'])
+    assets.load()
+
+    for name, hashed in sorted(manifest['files'].items()):
+        click.echo('{:<36} {} {}'.format(name, hashed, ' '.join(manifest['encodings'].get(hashed, ()))))
+    click.echo('Built {} assets in {}.'.format(len(manifest['files']), assets.directory))
+
+
+def init_app(app):
+    app.extensions['flaskr.assets'] = Assets(app.config['ASSETS_DIR'] or os.path.join(app.instance_path, 'assets'))
+    app.url_defaults(hashed_url)
+    app.view_functions['static'] = serve_static
+    app.cli.add_command(build_assets_command)
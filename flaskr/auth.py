@@ -1,13 +1,18 @@
 import functools
+import sqlite3
 
 from flask import (
     Blueprint, flash, g, redirect, render_template, request, session, url_for
 )
+from flask.ctx import _AppCtxGlobals
 
-# 以下这两个函数用在对密码的处理上。
-from werkzeug.security import check_password_hash, generate_password_hash
-
-from flaskr.db import get_db
+from flaskr import queries
+from flaskr.cache import get_cache
+from flaskr.db import get_db, get_read_db, mark_written, release_db
+# 以下这几个函数用在对密码的处理上。它们包装了 werkzeug 的 generate_password_hash / check_password_hash，
+# 在 flaskr.hashing 的线程池里执行。
+from flaskr.hashing import check_password, hash_password, needs_rehash
+from flaskr.ratelimit import limit
 
 '''
 Blueprint 相当于一个集合，集合的元素是 view。 不同于我们在 最简单的 flask 应用中做的那样，直接把 view 注册到 app.
@@ -32,13 +37,12 @@ bp = Blueprint('auth', __name__, url_prefix='/auth')
 # When Flask receives a request to /auth/register,
 # it will call the register view and use the return value as the response.
 @bp.route('/register', methods=('GET', 'POST'))
+@limit('ip')
 def register():
     if request.method == 'POST':
         # request.form is a special type of dict mapping submitted form keys and values.
         username = request.form['username']
         password = request.form['password']
-        db = get_db()
-
         error = None
 
         if not username:
@@ -59,24 +63,36 @@ def register():
         # fetchone() 和 fetchall() 在查询结果为空的时候时候差别还是很大的。
         # fetchone() 返回的是 None. fetchall() 返回的是()
 
-        elif db.execute(
-                'SELECT id FROM user WHERE username=? ', (username,)
-        ).fetchone() is not None:
+        # 只读的查询走只读连接池，写连接只在真正写入的时候才拿
+        elif get_read_db().execute(queries.USER_EXISTS, (username,)).fetchone() is not None:
             error = 'User {} is already registered.'.format(username)
 
         # If validation succeeds, insert the new user data into the database.
         # For security, passwords should never be stored in the database directly.
         # Instead, generate_password_hash() is used to securely hash the password, and that hash is stored.
+        # (hash_password() runs it on the hashing pool with the configured PASSWORD_HASH_METHOD)
         # Since this query modifies data, db.commit() needs to be called afterwards to save the changes.
+        # The writer is checked out just for the INSERT and given back right after the commit (release_db).
+        # The check above ran on another connection, so two registrations of the same name can both pass it;
+        # the UNIQUE constraint on user.username turns the second INSERT into an IntegrityError.
 
         if error is None:
-            db.execute(
-                'INSERT INTO user (username,password) VALUES (?,?)',
-                (username, generate_password_hash(password))
-
-            )
-            db.commit()
+            # 算哈希的时候不拿任何连接，这样同时注册/登录的请求能在 flaskr.hashing 的线程池里并行
+            release_db()
+            pwhash = hash_password(password)
+            db = get_db()
+            try:
+                cursor = db.execute(queries.INSERT_USER, (username, pwhash))
+                db.commit()
+            except sqlite3.IntegrityError:
+                error = 'User {} is already registered.'.format(username)
+            else:
+                mark_written()
+                invalidate_user(cursor.lastrowid)
+            finally:
+                release_db()
 
+        if error is None:
             # After storing the user, they are redirected to the login page.
             # url_for() generates the URL for the login view based on its name.
             # 'auth.login' 是 view 的名字而不是 url
@@ -98,18 +114,19 @@ def register():
     return render_template('auth/register.html')
 
 
+# 按 IP 和用户名两个维度限流，超过限额的请求在查库和算哈希之前就被拒绝
 @bp.route('/login', methods=('GET', 'POST'))
+@limit('ip', 'username')
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        db = get_db()
         error = None
 
         # 将查询结果保存在 user 里面
-        user = db.execute(
-            'SELECT * FROM user WHERE username =?', (username,)
-        ).fetchone()
+        user = get_read_db().execute(queries.USER_BY_USERNAME, (username,)).fetchone()
+        # 检查密码之前先把连接还回去：哈希很慢，不能占着连接算
+        release_db()
 
         if user is None:
             error = 'Incorrect username.'
@@ -120,9 +137,19 @@ def login():
         # 数据库中的 password 的字段将会保存加密方式和盐 pbkdf2:sha1:1000$X97hPa3g$252c0cca000c3674b8ef7a2b8ecd409695aac370
         # 因为盐值是随机的，所以就算是相同的密码，生成的哈希值也不会是一样的
 
-        elif not check_password_hash(user['password'], password):
+        elif not check_password(user['password'], password):
             error = 'Incorrect password.'
 
+        # PASSWORD_HASH_METHOD 改了以后，老用户在下次登录成功时用新的算法/参数重新哈希，用户无感知
+        elif needs_rehash(user['password']):
+            pwhash = hash_password(password)
+            db = get_db()
+            db.execute(queries.UPDATE_PASSWORD, (pwhash, user['id']))
+            db.commit()
+            release_db()
+            mark_written()
+            invalidate_user(user['id'])
+
         # session is a dict that stores data across requests.
         # When validation succeeds, the user’s id is stored in a new session.
         # The data is stored in a cookie that is sent to the browser,
@@ -145,6 +172,8 @@ def login():
 # load_logged_in_user checks if a user id is stored in the session and gets that user’s data from the database,
 # storing it on g.user, which lasts for the length of the request.
 # If there is no user id, or if the id doesn’t exist, g.user will be None.
+# 查询是延迟执行的：这里只记下 user_id，第一次读取 g.user 的时候才去缓存/数据库里取（见 LazyUserGlobals），
+# 没有用到 g.user 的请求就完全不查询。
 @bp.before_app_request
 def load_logged_in_user():
     user_id = session.get('user_id')
@@ -155,9 +184,49 @@ def load_logged_in_user():
     else:
         # 这里才是根据 session 来设置用户信息
         # g 在每次请求的时候都会重置，所有每次其请求g 都不一样
-        g.user = get_db().execute(
-            'SELECT * FROM user WHERE id=?', (user_id,)
-        ).fetchone()
+        g._user_id = user_id
+
+
+def load_user(user_id):
+    # 先查缓存，没有再查数据库。缓存的是 dict 而不是 sqlite3.Row，这样共享缓存也能序列化。
+    cache = get_cache('user')
+    user = cache.get(user_id)
+
+    if user is None:
+        row = get_read_db().execute(queries.USER_BY_ID, (user_id,)).fetchone()
+
+        if row is not None:
+            user = dict(row)
+            cache.set(user_id, user)
+
+    return user
+
+
+def invalidate_user(user_id):
+    # Call this after anything that changes a user row, so the next g.user reads the new data.
+    get_cache('user').delete(user_id)
+
+
+class LazyUserGlobals(_AppCtxGlobals):
+    # Used as app.app_ctx_globals_class (see create_app). g.user stays a plain row or None, so
+    # "g.user is None" and "{% if g.user %}" keep working; it is just loaded on first access.
+
+    def __getattr__(self, name):
+        # __getattr__ 只有在属性不存在的时候才会被调用
+        if name == 'user' and '_user_id' in self.__dict__:
+            self.user = load_user(self.__dict__.pop('_user_id'))
+            return self.user
+
+        return super().__getattr__(name)
+
+    def get(self, name, default=None):
+        if name == 'user' and '_user_id' in self.__dict__:
+            return self.user
+
+        return super().get(name, default)
+
+    def __contains__(self, item):
+        return super().__contains__(item) or (item == 'user' and '_user_id' in self.__dict__)
 
 
 @bp.route('/logout')
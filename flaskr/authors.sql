@@ -0,0 +1,56 @@
+-- 反规范化的作者信息：post.author_username 和每个用户的 user_stats，都由触发器维护，应用代码只管读。
+-- 迁移 3 (migrate_authors) 执行这个文件，migrate-authors 也会在旧数据库上执行它，
+-- 所以这里只能用 IF NOT EXISTS，不能 DROP。
+CREATE TABLE IF NOT EXISTS user_stats(
+  user_id INTEGER PRIMARY KEY,
+  post_count INTEGER NOT NULL DEFAULT 0,
+  last_post_at TIMESTAMP,
+  FOREIGN KEY (user_id) REFERENCES user(id)
+);
+
+-- blog.author 按作者分页，user_stats 的触发器和 user_rename 按作者查文章，都用这个索引。
+-- It replaces the old post(author_id) index, which is a prefix of it.
+DROP INDEX IF EXISTS post_author_id;
+CREATE INDEX IF NOT EXISTS post_author_created ON post(author_id, created DESC, id DESC);
+
+-- blog.create 插入的时候直接带上 author_username；别的写入（import-posts、手写的 SQL）由触发器补上
+CREATE TRIGGER IF NOT EXISTS post_author_insert AFTER INSERT ON post WHEN new.author_username IS NULL BEGIN
+  UPDATE post SET author_username = (SELECT username FROM user WHERE id = new.author_id) WHERE id = new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_author_update AFTER UPDATE OF author_id ON post BEGIN
+  UPDATE post SET author_username = (SELECT username FROM user WHERE id = new.author_id) WHERE id = new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS user_rename AFTER UPDATE OF username ON user BEGIN
+  UPDATE post SET author_username = new.username WHERE author_id = new.id;
+END;
+
+-- user_stats 按增量维护，不重新 COUNT(*)
+CREATE TRIGGER IF NOT EXISTS user_stats_insert AFTER INSERT ON post BEGIN
+  INSERT INTO user_stats(user_id, post_count, last_post_at) VALUES (new.author_id, 1, new.created)
+    ON CONFLICT(user_id) DO UPDATE SET
+      post_count = post_count + 1,
+      last_post_at = max(coalesce(last_post_at, excluded.last_post_at), excluded.last_post_at);
+END;
+
+-- 只有删掉的正好是最新一篇时才需要重新找 last_post_at
+CREATE TRIGGER IF NOT EXISTS user_stats_delete AFTER DELETE ON post BEGIN
+  UPDATE user_stats SET
+    post_count = post_count - 1,
+    last_post_at = CASE WHEN old.created < last_post_at THEN last_post_at
+                        ELSE (SELECT max(created) FROM post WHERE author_id = old.author_id) END
+  WHERE user_id = old.author_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS user_stats_move AFTER UPDATE OF author_id ON post
+WHEN new.author_id IS NOT old.author_id BEGIN
+  UPDATE user_stats SET
+    post_count = post_count - 1,
+    last_post_at = (SELECT max(created) FROM post WHERE author_id = old.author_id)
+  WHERE user_id = old.author_id;
+  INSERT INTO user_stats(user_id, post_count, last_post_at) VALUES (new.author_id, 1, new.created)
+    ON CONFLICT(user_id) DO UPDATE SET
+      post_count = post_count + 1,
+      last_post_at = max(coalesce(last_post_at, excluded.last_post_at), excluded.last_post_at);
+END;
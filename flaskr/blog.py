@@ -1,12 +1,22 @@
+import hashlib
+import re
+from datetime import datetime, timezone
+
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, Response, current_app, flash, g, get_template_attribute, make_response, redirect,
+    render_template, request, session, stream_template, url_for
 )
+from markupsafe import Markup, escape
 
 from werkzeug.exceptions import abort
 
 # 引入 login_required 装饰器，部分页面要做登入认证
 from flaskr.auth import login_required
-from flaskr.db import get_db
+from flaskr.cache import get_cache
+from flaskr import queries
+from flaskr.db import get_db, get_read_db, mark_written, release_db
+from flaskr.ratelimit import limit
+from flaskr.writer import get_write_queue, wait
 
 bp = Blueprint('blog', __name__)
 
@@ -16,23 +26,338 @@ So the index view will be at /, the create view at /create, and so on.
 '''
 
 
+# 游标分页（keyset pagination）：用上一页最后一篇文章的 (created, id) 作为游标，
+# 而不是 OFFSET。OFFSET 需要先扫描并丢弃前面所有的行，页数越靠后越慢；
+# 游标配合 post(created DESC, id DESC) 索引，每一页都只是一次索引范围扫描。
+# The cursor is the (created, id) pair of the last post shown, so "the next page" is simply
+# "posts strictly older than this one". id breaks ties between posts created in the same second.
+def encode_cursor(post):
+    return '{}_{}'.format(post['created'], post['id'])
+
+
+# str.isdigit() 也接受 '²' 这样的 Unicode 数字，int() 转不了；太大的整数 sqlite3 绑定参数时会 OverflowError。
+# Only ASCII digits that fit in SQLite's 64-bit INTEGER are valid ids.
+CURSOR_ID = re.compile(r'[0-9]{1,18}')
+
+
+def decode_cursor(cursor):
+    created, sep, id = cursor.rpartition('_')
+
+    if not sep or not created or not CURSOR_ID.fullmatch(id):
+        abort(400, 'Invalid page cursor.')
+
+    return created, int(id)
+
+
+def fetch_page(query, params, per_page, before=None, after=None):
+    # query is one of the queries.page() statement sets (first / before / after); params fill the
+    # placeholders in front of the cursor condition.
+    # 多取一行 (per_page + 1) 用来判断是否还有下一页，不需要额外的 COUNT(*)。
+    db = get_read_db()
+
+    if after is not None:
+        # Walking backwards: read the posts just newer than the cursor in ascending order,
+        # then flip them so the page is still rendered newest first.
+        rows = db.execute(
+            query['after'],
+            params + decode_cursor(after) + (per_page + 1,)
+        ).fetchall()
+        has_prev = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_next = True
+    else:
+        if before is not None:
+            sql, cursor_params = query['before'], decode_cursor(before)
+        else:
+            sql, cursor_params = query['first'], ()
+
+        rows = db.execute(
+            sql,
+            params + cursor_params + (per_page + 1,)
+        ).fetchall()
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        has_prev = before is not None
+
+    page = {'posts': rows, 'next': None, 'prev': None}
+
+    if rows:
+        if has_next:
+            page['next'] = encode_cursor(rows[-1])
+        if has_prev:
+            page['prev'] = encode_cursor(rows[0])
+
+    return page
+
+
+# 页面缓存：匿名用户看到的 / 在有人发文、改文、删文之前都是一样的，渲染一次就缓存起来。
+# Every change to post starts a new "posts generation": the triggers in generation.sql move
+# posts_generation.modified forward. Cached pages and ETags include the generation, so a write makes all
+# of them stale at once, without tracking which pages a post appeared on. It lives in the database
+# rather than in a cache, so a write served by one worker is seen by every other worker and node.
+def posts_generation():
+    # The time of the last write, which doubles as Last-Modified; read once per request.
+    if 'posts_generation' not in g:
+        g.posts_generation = get_read_db().execute(queries.POSTS_GENERATION).fetchone()[0]
+
+    return g.posts_generation
+
+
+def bump_posts_generation():
+    # 触发器已经覆盖了所有对 post 的修改；这是给绕过了触发器的写入用的（import-posts --defer-indexes 导入时会暂时删掉触发器）
+    db = get_db()
+    db.execute(queries.BUMP_POSTS_GENERATION)
+    db.commit()
+    release_db()
+    mark_written()
+    g.pop('posts_generation', None)
+
+
+def conditional_response(etag, last_modified, render, cache_key=None):
+    # 条件请求：浏览器带着上次的 ETag 回来，如果页面没变就直接返回 304，不查数据库也不渲染。
+    # render() builds the page body and is only called on a miss. With cache_key the body is also
+    # kept in the page cache, which is only safe for pages that look the same to everyone.
+    response = make_response('')
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+    # revalidate on every view; the page differs per session, so browsers must not reuse it across logins
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+
+    # 有 flash 消息的页面只能显示一次，不能缓存
+    cacheable = '_flashes' not in session
+
+    if cacheable and response.make_conditional(request).status_code == 304:
+        return response
+
+    body = None
+    if cacheable and cache_key is not None:
+        body = get_cache('page').get(cache_key)
+
+    if body is None:
+        body = render()
+        if cacheable and cache_key is not None:
+            get_cache('page').set(cache_key, body)
+
+    response.set_data(body)
+    return response
+
+
+def page_etag(*parts):
+    return hashlib.blake2b(repr(parts).encode('utf8'), digest_size=16).hexdigest()
+
+
+# 每篇文章的 HTML 片段缓存。片段里不包含只有作者能看到的 Edit 链接，所以所有用户共用一份。
+# Fragments are keyed by the post's content, so editing one post doesn't throw away the others.
+@bp.app_template_global()
+def post_fragment(post):
+    key = '{}:{}'.format(post['id'], page_etag(
+        post['title'], post['body'], post['username'], str(post['created'])
+    ))
+    cache = get_cache('fragment')
+    fragment = cache.get(key)
+
+    if fragment is None:
+        fragment = {
+            'header': get_template_attribute('blog/_post.html', 'header')(post),
+            'body': get_template_attribute('blog/_post.html', 'body')(post),
+        }
+        cache.set(key, fragment)
+
+    return fragment
+
+
 # index的 endpoint 依然是blog.index
+# /?before=<cursor> shows older posts, /?after=<cursor> shows newer ones.
 @bp.route('/')
 def index():
-    db = get_db()
-    posts = db.execute(
-        'SELECT p.id,title,body,created,author_id,username'
-        ' FROM post p JOIN user u ON p.author_id=uid'
-        ' ORDER BY created DESC'
-    ).fetchall()
+    before = request.args.get('before')
+    after = request.args.get('after')
+    # 用 session 里的 user_id 而不是 g.user，命中缓存的时候连用户都不用查
+    user_id = session.get('user_id')
+    generation = posts_generation()
+
+    def render():
+        page = fetch_page(
+            queries.INDEX_PAGE,
+            (),
+            current_app.config['POSTS_PER_PAGE'],
+            before=before,
+            after=after,
+        )
 
-    # 这里将 posts 变量作为 posts 返回，这样在模板中也可以使用 post 变量。
-    return render_template('blog/index.html', posts=posts)
+        # 这里将 posts 变量作为 posts 返回，这样在模板中也可以使用 post 变量。
+        return render_template('blog/index.html', **page)
+
+    # Logged-in pages show the user's name and Edit links, so only anonymous pages are stored whole;
+    # logged-in ones are rebuilt from the post fragments.
+    return conditional_response(
+        page_etag(generation, user_id, before, after),
+        generation,
+        render,
+        cache_key=('index', generation, before, after) if user_id is None else None,
+    )
+
+
+# 单篇文章的页面。ETag 由文章 id 和 posts generation（最后一次写入的时间）组成，和 index 一样，
+# 命中的时候不查数据库。
+@bp.route('/<int:id>')
+def detail(id):
+    user_id = session.get('user_id')
+    generation = posts_generation()
+
+    def render():
+        return render_template('blog/detail.html', post=get_post(id, check_author=False))
+
+    return conditional_response(
+        page_etag('detail', id, generation, user_id),
+        generation,
+        render,
+        cache_key=('detail', generation, id) if user_id is None else None,
+    )
+
+
+# 一个作者的所有文章，分页方式和 index 一样。用户名先在 user 的 UNIQUE 索引里查到 id，
+# then the page is a range scan of post(author_id, created DESC, id DESC) in index order, without a sort.
+@bp.route('/author/<username>')
+def author(username):
+    before = request.args.get('before')
+    after = request.args.get('after')
+    user_id = session.get('user_id')
+    generation = posts_generation()
+
+    def render():
+        author = get_read_db().execute(queries.AUTHOR_BY_USERNAME, (username,)).fetchone()
+
+        if author is None:
+            abort(404, "User {0} doesn't exist.".format(username))
+
+        page = fetch_page(
+            queries.AUTHOR_PAGE,
+            (author['id'],),
+            current_app.config['POSTS_PER_PAGE'],
+            before=before,
+            after=after,
+        )
+
+        return render_template('blog/author.html', author=author, **page)
+
+    return conditional_response(
+        page_etag('author', username, generation, user_id, before, after),
+        generation,
+        render,
+        cache_key=('author', generation, username, before, after) if user_id is None else None,
+    )
+
+
+# 流式输出：不把所有文章一次 fetchall() 到内存里，而是边从游标读边渲染边发送。
+# fetchmany() reads the cursor in batches of ARCHIVE_BATCH_SIZE rows, so only one batch is in
+# memory at a time no matter how many posts there are.
+def iter_rows(cursor, size):
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield from rows
+
+
+def buffered(chunks, size=8192):
+    # Jinja 的 generate() 每个模板片段都会 yield 一小段字符串，攒到 size 个字符再发送，减少 write 的次数
+    buffer = []
+    length = 0
+
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+
+# 所有文章的归档页。The first bytes go out before the query has finished reading; the request
+# context, and with it the read connection, is kept until the last post has been sent.
+@bp.route('/archive')
+def archive():
+    cursor = get_read_db().execute(queries.ARCHIVE)
+    posts = iter_rows(cursor, current_app.config['ARCHIVE_BATCH_SIZE'])
+
+    return Response(buffered(stream_template('blog/archive.html', posts=posts)), mimetype='text/html')
+
+
+# 全文搜索，用的是 search.sql 里的 FTS5 索引 post_fts，按 bm25 相关度排序。
+# 用户输入的每个词都用双引号括起来，这样 " - * 之类的字符不会被当成 FTS5 的查询语法。
+def match_expression(q):
+    return ' '.join('"{}"'.format(term.replace('"', '""')) for term in q.split())
+
+
+def highlight(snippet):
+    # snippet() marks matches with \x02 / \x03; escape the post text first, then turn the markers into tags
+    return Markup(str(escape(snippet)).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+
+# /search?q=<words>&after=<cursor>, where the cursor is the (rank, id) of the last result shown
+@bp.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    after = request.args.get('after')
+    per_page = current_app.config['POSTS_PER_PAGE']
+    results = []
+    next_cursor = None
+
+    if q:
+        if after is not None:
+            rank, sep, id = after.rpartition('_')
+            try:
+                rank = float(rank)
+            except ValueError:
+                rank = None
+            if not sep or rank is None or not CURSOR_ID.fullmatch(id):
+                abort(400, 'Invalid page cursor.')
+            cursor = (rank, int(id))
+        else:
+            cursor = (float('-inf'), 0)
+
+        rows = get_read_db().execute(
+            queries.SEARCH,
+            (match_expression(q),) + cursor + (per_page + 1,)
+        ).fetchall()
+
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            next_cursor = '{!r}_{}'.format(rows[-1]['rank'], rows[-1]['id'])
+
+        results = [dict(row, snippet=highlight(row['snippet'])) for row in rows]
+
+    return render_template('blog/search.html', q=q, results=results, next=next_cursor)
+
+
+# 文章的写操作都经过这里：打开了写队列 (WRITE_QUEUE_ENABLED) 就交给写线程批量提交，否则直接在这个请求里提交。
+# statements are (sql, params) pairs that are committed together. 直接提交的时候，写连接在 commit 之后马上还回去，
+# redirect 和渲染页面都不占着它。
+def write_posts(*statements):
+    write_queue = get_write_queue()
+    if write_queue is not None:
+        wait(write_queue.submit(statements))
+    else:
+        db = get_db()
+        for sql, params in statements:
+            db.execute(sql, params)
+        db.commit()
+        release_db()
+    mark_written()
+
+    # posts_generation 由触发器在同一个事务里更新，这里只要让这个请求重新读一次
+    g.pop('posts_generation', None)
 
 
 # A user must be logged in to visit these views, otherwise they will be redirected to the login page.
 @bp.route('/create', methods=('GET', 'POST'))
 @login_required
+@limit('ip')
 def create():
     if request.method == 'POST':
         title = request.form['title']
@@ -46,12 +371,7 @@ def create():
             flash(error)
 
         else:
-            db = get_db()
-            db.execute(
-                'INSERT INTO post (title,body,author_id)'
-                'VALUES (?,?,?)', (title, body, g.user['id'])
-            )
-            db.commit()
+            write_posts((queries.INSERT_POST, (title, body, g.user['id'], g.user['username'])))
             return redirect(url_for('blog.index'))
 
     return render_template('blog/create.html')
@@ -59,11 +379,9 @@ def create():
 
 # 一个确认权限的过程，title id 要和 uid 匹配
 def get_post(id, check_author=True):
-    post = get_db().execute(
-        'SELECT p.id,title,body ,created, author_id,username'
-        '  FROM post p JOIN user u ON p.author_id=u.id'
-        '  WHERE p.id= ?', (id,)
-    ).fetchone()
+    # 只是读，所以都用只读连接；update/delete 真正写入的时候 (write_posts) 才拿写连接。
+    # On a lagging replica the author still reads their own latest version, see flaskr.db.reads_own_writes.
+    post = get_read_db().execute(queries.POST_BY_ID, (id,)).fetchone()
 
     # abort 会抛出一个特定的异常,这个异常会返回一个 HTTP 的状态码.
     # abort() will raise a special exception that returns an HTTP status code.
@@ -75,7 +393,7 @@ def get_post(id, check_author=True):
 
     # The check_author argument is defined so that the function can be used to get a post without checking the author.
     # This would be useful if you wrote a view to show an individual post on a page,
-    # where the user doesn’t matter because they’re not modifying the post.
+    # where the user doesn’t matter because they’re not modifying the post. (blog.detail does.)
     if check_author and post['author_id'] != g.user['id']:
         abort(403)
 
@@ -105,13 +423,7 @@ def update(id):
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                'UPDATE post SET title=?,body=?'
-                '  WHERE id=?',
-                (title, body, id)
-            )
-            db.commit()
+            write_posts((queries.UPDATE_POST, (title, body, id)))
             return redirect(url_for('blog.index'))
 
     return render_template('blog/update.html', post=post)
@@ -121,7 +433,5 @@ def update(id):
 @login_required
 def delete(id):
     get_post(id)
-    db = get_db()
-    db.execute('DELETE FROM post WHERE id=?', (id,))
-    db.commit()
+    write_posts((queries.DELETE_POST, (id,)))
     return redirect(url_for('blog.index'))
@@ -0,0 +1,182 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+# 进程内缓存：LRU + TTL。容量满了淘汰最久没用过的条目，过期的条目在读取时丢弃。
+# Caches are created per app from config by get_cache(name): NAME_CACHE_BACKEND picks the backend,
+# NAME_CACHE_SIZE and NAME_CACHE_TTL size it. 'memory' is an LRUCache local to the worker process,
+# 'shared' stores entries in SHARED_CACHE_CLIENT so every worker (and every node) sees the same data.
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expires, value)，OrderedDict 的顺序就是最近使用的顺序
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+
+            if entry is not _MISSING:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class LocalCacheClient(object):
+    # 本地的“共享缓存服务”替身，接口和 memcached 客户端一样 (get / set / delete / flush_all)。
+    # A stand-in for a memcached-style server that lives in this process. Values are pickled the
+    # same way a network client would, so code that works against it works against the real thing.
+    # Point SHARED_CACHE_CLIENT at e.g. pymemcache.Client(('cache-host', 11211)) in production.
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None:
+                return None
+
+            expires, data = entry
+            if expires and expires <= time.time():
+                del self._data[key]
+                return None
+
+        return pickle.loads(data)
+
+    def set(self, key, value, expire=0):
+        data = pickle.dumps(value)
+        with self._lock:
+            self._data[key] = (time.time() + expire if expire else 0, data)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        return True
+
+    def flush_all(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+
+class SharedCache(object):
+    # Same interface as LRUCache on top of a memcached-style client. Keys are namespaced by cache
+    # name and turned into strings, since memcached keys must be short strings.
+
+    def __init__(self, client, namespace, ttl=None):
+        self.client = client
+        self.namespace = namespace
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return '{}:{}'.format(self.namespace, key)
+
+    def get(self, key, default=None):
+        value = self.client.get(self._key(key))
+
+        if value is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        self.client.set(self._key(key), value, expire=int(ttl or 0))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        # memcached 不能按前缀删除，只能全部清空
+        self.client.flush_all()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+# the stand-in used when SHARED_CACHE_CLIENT is not configured, shared by every app in the process
+local_cache_client = LocalCacheClient()
+
+
+def get_cache(name, app=None):
+    app = app or current_app._get_current_object()
+    caches = app.extensions.setdefault('flaskr.cache', {})
+    cache = caches.get(name)
+
+    if cache is None:
+        prefix = name.upper() + '_CACHE_'
+        backend = app.config[prefix + 'BACKEND']
+        ttl = app.config[prefix + 'TTL']
+
+        if backend == 'memory':
+            cache = LRUCache(app.config[prefix + 'SIZE'], ttl)
+        elif backend == 'shared':
+            client = app.config['SHARED_CACHE_CLIENT'] or local_cache_client
+            cache = SharedCache(client, name, ttl)
+        else:
+            raise ValueError('Unknown cache backend {!r} for {}'.format(backend, prefix + 'BACKEND'))
+
+        # 并发创建时以先放进去的为准
+        cache = caches.setdefault(name, cache)
+
+    return cache
@@ -0,0 +1,157 @@
+import zlib
+
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import ClosingIterator
+
+# 响应压缩（COMPRESS_ENABLED），create_app 把它装在 app.wsgi_app 外面，所有的响应都经过这里。
+# The encoding is negotiated from Accept-Encoding: br (only when the brotli package is installed),
+# then gzip, then deflate. A response is left alone when it is
+#   - smaller than COMPRESS_MIN_SIZE bytes (by its Content-Length): the headers would cost more than is saved,
+#   - not one of COMPRESS_MIMETYPES, already encoded (e.g. the precompressed flaskr.assets files),
+#     a HEAD request, a partial/empty status, or marked Cache-Control: no-transform.
+# A response without a Content-Length is streamed (/archive): every chunk is compressed and flushed
+# as it comes, so the client still gets the first posts before the last ones are read.
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class _Zlib(object):
+    def __init__(self, level, wbits):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data, flush):
+        data = self._compressor.compress(data)
+        if flush:
+            data += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _Brotli(object):
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data, flush):
+        data = self._compressor.process(data)
+        if flush:
+            data += self._compressor.flush()
+        return data
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class CompressionMiddleware(object):
+    def __init__(self, app, min_size=500, level=6, brotli_quality=4,
+                 mimetypes=('text/html', 'text/css', 'text/plain', 'application/json', 'application/javascript')):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.mimetypes = mimetypes
+
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def choose(self, environ):
+        # Accept-Encoding 里 q>0 的、我们支持的编码，按 br > gzip > deflate 选
+        accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        for encoding in ('br', 'gzip', 'deflate'):
+            if accept[encoding] and (encoding != 'br' or brotli is not None):
+                return encoding
+        return None
+
+    def compressor(self, encoding):
+        if encoding == 'br':
+            return _Brotli(self.brotli_quality)
+        # wbits 31 writes a gzip header, 15 the zlib format that HTTP calls "deflate"
+        return _Zlib(self.level, 31 if encoding == 'gzip' else 15)
+
+    def should_compress(self, status, headers):
+        if int(status.split(' ', 1)[0]) not in (200, 201, 203):
+            return False
+
+        names = {name.lower(): value for name, value in headers}
+        if 'content-encoding' in names or 'no-transform' in names.get('cache-control', ''):
+            return False
+        if names.get('content-type', '').split(';', 1)[0].strip() not in self.mimetypes:
+            return False
+
+        length = names.get('content-length')
+        return length is None or int(length) >= self.min_size
+
+    def __call__(self, environ, start_response):
+        encoding = None if environ['REQUEST_METHOD'] == 'HEAD' else self.choose(environ)
+        if encoding is None:
+            return self.app(environ, start_response)
+
+        state = {}
+
+        def compressing_start_response(status, headers, exc_info=None):
+            if self.should_compress(status, headers):
+                state['streaming'] = not any(name.lower() == 'content-length' for name, _ in headers)
+                headers = [(name, value) for name, value in headers
+                           if name.lower() not in ('content-length', 'vary', 'etag')] + [
+                    ('Content-Encoding', encoding),
+                    ('Vary', _vary(headers)),
+                ] + [('ETag', _weak(value)) for name, value in headers if name.lower() == 'etag']
+                state['compressor'] = self.compressor(encoding)
+            return start_response(status, headers, exc_info)
+
+        iterable = self.app(environ, compressing_start_response)
+        # Flask 在返回 iterable 之前就调用了 start_response
+        if 'compressor' not in state:
+            return iterable
+
+        return ClosingIterator(self._compress(iterable, state['compressor'], state['streaming']),
+                               getattr(iterable, 'close', None))
+
+    def _compress(self, iterable, compressor, streaming):
+        bytes_in = bytes_out = 0
+
+        for chunk in iterable:
+            bytes_in += len(chunk)
+            data = compressor.compress(chunk, flush=streaming)
+            if data:
+                bytes_out += len(data)
+                yield data
+
+        data = compressor.finish()
+        bytes_out += len(data)
+        yield data
+
+        self.compressed += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+
+    def stats(self):
+        return {'compressed': self.compressed, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+
+def _vary(headers):
+    values = [value for name, value in headers if name.lower() == 'vary']
+    if not any('accept-encoding' in value.lower() for value in values):
+        values.append('Accept-Encoding')
+    return ', '.join(values)
+
+
+def _weak(etag):
+    # 压缩以后的内容和原来不是同一串字节，强 ETag 要改成弱的；If-None-Match 用弱比较，304 还是照常
+    return etag if etag.startswith('W/') else 'W/' + etag
+
+
+def init_app(app):
+    middleware = CompressionMiddleware(
+        app.wsgi_app,
+        min_size=app.config['COMPRESS_MIN_SIZE'],
+        level=app.config['COMPRESS_LEVEL'],
+        brotli_quality=app.config['COMPRESS_BROTLI_QUALITY'],
+        mimetypes=app.config['COMPRESS_MIMETYPES'],
+    )
+    app.wsgi_app = app.extensions['flaskr.compress'] = middleware
@@ -1,8 +1,27 @@
+import collections
+import contextlib
+import csv
+import itertools
+import json
+import os
+import queue
 import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
 import click
-from flask import current_app, g
+from flask import current_app, g, has_request_context, session
 from flask.cli import with_appcontext
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.utils import import_string
 
 
 # g is a special object that is unique for each request. (每次请求都会新创建一个对象)
@@ -16,39 +35,422 @@ from flask.cli import with_appcontext
 # current_app 是一个全局应用上下文，表示的是当前运行的 flask 实例。  在__init__.py 中我们是通过工厂方法 create_app 创建了 flask 实例 app.
 # 我们在其他文件中是获取不到这个 app变量的,所以我们通过访问 current_app 的方式，来得到我们想要的全局数据，比如数据库连接 URL。
 
-def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
+# 连接池：以前每个请求都要 sqlite3.connect() 一次，请求结束再 close()，每次都要重新打开文件、解析 schema、
+# 预热 page cache。现在连接在请求结束后放回池子里，下一个请求直接拿来用。
+# Connections are kept warm in a pool that lives on the app (app.extensions['flaskr.db']).
+# get_db() checks one out for the duration of the app context and close_db() gives it back;
+# views that write give it back right after their commit with release_db().
+
+# 读写分离：只读的 view（blog.index、load_logged_in_user 等）用 get_read_db()，从只读连接池里拿 mode=ro 的连接；
+# 写操作都走 get_db()，默认只有一个写连接 (DB_POOL_SIZE=1)，写请求排队执行。WAL 模式下读不会被写阻塞，
+# 读的吞吐量可以随线程数增加。
+# get_read_db() connections are opened read-only (mode=ro URI plus PRAGMA query_only), so a
+# view that was moved to them by mistake fails loudly instead of writing.
+
+
+class PoolTimeout(ServiceUnavailable):
+    # 所有连接都被占用并且等待超过 DB_POOL_TIMEOUT 秒，返回 503 而不是无限等待
+    description = 'All database connections are busy, please try again.'
+
+
+class _Connection(sqlite3.Connection):
+    # sqlite3.Connection 不能直接加属性，子类可以。uses 记录被借出的次数，用来定期回收连接。
+    uses = 0
+
+
+class PooledConnection(object):
+    # What get_db() hands out: a thin wrapper that forwards everything to the pooled sqlite3
+    # connection until it is released. After that it behaves like a closed connection, so a
+    # handle that leaks past the end of the request can't touch a connection someone else now owns.
+    __slots__ = ('_conn', '_pool')
+
+    def __init__(self, conn, pool):
+        self._conn = conn
+        self._pool = pool
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return getattr(self._conn, name)
+
+    # with db: ... commits or rolls back, same as a plain sqlite3 connection
+    def __enter__(self):
+        self.__getattr__('__enter__')()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.__getattr__('__exit__')(*exc_info)
+
+    def close(self, discard=False):
+        # 归还给连接池，而不是真正关闭
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.checkin(conn, discard=discard)
+
+
+# 写在数据库文件里的 PRAGMA，不是每个连接自己的状态
+FILE_PRAGMAS = ('journal_mode',)
+
+
+class ConnectionPool(object):
+    def __init__(self, database, size=5, timeout=10.0, max_uses=1000, pragmas=None,
+                 readonly=False, cached_statements=128):
+        self.database = database
+        self.cached_statements = cached_statements
+        self.readonly = readonly
+        self.size = size
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.pragmas = pragmas or {}
+        self._file_pragmas_applied = False
+
+        # LIFO: the most recently returned connection has the warmest page cache.
+        # 后进先出，最近用过的连接缓存最热
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.recycled = 0
+
+    @classmethod
+    def from_url(cls, url, **options):
+        # sqlite:///relative/path or sqlite:////absolute/path, as SQLAlchemy writes them
+        path = url.partition('://')[2]
+        if not path.startswith('/'):
+            raise ValueError('Expected sqlite:///<path>, got {!r}'.format(url))
+        return cls(path[1:], **options)
+
+    def open(self):
+        if self.readonly:
+            # urllib.request.pathname2url 也是 quote()，但要多导入一大堆模块，拖慢启动
+            database = 'file:{}?mode=ro'.format(quote(os.path.abspath(self.database)))
+        else:
+            database = self.database
+
+        conn = sqlite3.connect(
+            database,
+            uri=self.readonly,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            # 连接会被不同的请求线程借用，但同一时间只有一个线程持有它
+            check_same_thread=False,
+            # 每个连接缓存编译好的语句，flaskr.queries 里的 SQL 在每个连接上只编译一次
+            cached_statements=self.cached_statements,
+            factory=_Connection,
         )
+        #  sqlite3.Row tells the connection to return rows that behave like dicts. This allows accessing the columns by name.
+        #  相当于 pymysql.cursors.DictCursor
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def connect(self):
+        conn = self.open()
+
+        # PRAGMAs are per-connection state, so they are applied once here instead of on every request,
+        # all in one executescript() call. journal_mode is stored in the database file itself, so
+        # each pool sets it on its first connection only; a read-only connection can't change it at
+        # all and relies on `flask db upgrade` (or init-db) having stored it.
+        pragmas = []
+        for name, value in self.pragmas.items():
+            if name in FILE_PRAGMAS and (self.readonly or self._file_pragmas_applied):
+                continue
+            pragmas.append('PRAGMA {}={};'.format(name, value))
+
+        if self.readonly:
+            pragmas.append('PRAGMA query_only=1;')
+
+        conn.executescript(''.join(pragmas))
+        self._file_pragmas_applied = True
+
+        return conn
+
+    def checkout(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+
+        if conn is not None:
+            self.hits += 1
+        else:
+            conn = self._open_or_wait()
+
+        conn.uses += 1
+        return PooledConnection(conn, self)
+
+    def _open_or_wait(self):
+        deadline = None
+        while True:
+            with self._lock:
+                can_open = self._open < self.size
+                if can_open:
+                    self._open += 1
+
+            if can_open:
+                self.misses += 1
+                try:
+                    return self.connect()
+                except Exception:
+                    self._release()
+                    raise
+
+            # 池子满了，等别的请求归还连接
+            if deadline is None:
+                self.waits += 1
+                deadline = time.monotonic() + self.timeout
+            try:
+                conn = self._idle.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self.timeouts += 1
+                raise PoolTimeout()
+
+            # None is put on the queue when a connection was closed instead of returned: its slot is
+            # free again, so go back and open a new one (unless another thread got there first).
+            if conn is not None:
+                return conn
+
+    def _release(self):
+        with self._lock:
+            self._open -= 1
+        # 叫醒一个正在等连接的线程
+        self._idle.put(None)
+
+    def checkin(self, conn, discard=False):
+        if not discard and conn.in_transaction:
+            # 请求里没有 commit 的修改不能带给下一个请求
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                discard = True
+
+        if discard or conn.uses >= self.max_uses:
+            # Recycle the connection after an error or after max_uses checkouts;
+            # the next checkout opens a fresh one in its place.
+            self.recycled += 1
+            try:
+                conn.close()
+            finally:
+                self._release()
+        else:
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if conn is not None:
+                with self._lock:
+                    self._open -= 1
+                conn.close()
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'open': self._open,
+            'idle': sum(conn is not None for conn in list(self._idle.queue)),
+            'hits': self.hits,
+            'misses': self.misses,
+            'waits': self.waits,
+            'timeouts': self.timeouts,
+            'recycled': self.recycled,
+        }
+
+
+# 存储后端：DATABASE_URL 的 scheme 决定连接池的类型，每个后端都是一个 ConnectionPool（或者它的子类），
+# 有同样的 from_url / checkout / checkin / close / stats。Everything above get_db() stays the same.
+#     sqlite:///<path>                the SQLite file itself (DATABASE_URL=None means sqlite:///<DATABASE>)
+#     flaskrdb://:secret@host:port    the stand-in database server the tests use, see flaskr.dbclient
+# Other backends can be added here as 'scheme': 'module.ClassName'.
+BACKENDS = {
+    'sqlite': 'flaskr.db.ConnectionPool',
+    'flaskrdb': 'flaskr.dbclient.RemotePool',
+}
+
+
+def database_url(app):
+    return app.config['DATABASE_URL'] or 'sqlite:///' + app.config['DATABASE']
+
+
+def open_pool(app, url, size, readonly=False):
+    scheme = url.partition('://')[0]
+    if scheme not in BACKENDS:
+        raise ValueError('Unknown database backend {!r} in {!r}'.format(scheme, url))
+
+    return import_string(BACKENDS[scheme]).from_url(
+        url,
+        size=size,
+        timeout=app.config['DB_POOL_TIMEOUT'],
+        max_uses=app.config['DB_POOL_MAX_USES'],
+        pragmas=app.config['SQLITE_PRAGMAS'],
+        readonly=readonly,
+        cached_statements=app.config['DB_CACHED_STATEMENTS'],
+    )
+
+
+class ReplicaSet(object):
+    # get_read_db() 的连接池：DATABASE_REPLICA_URLS 里每个副本一个只读连接池，轮流使用。
+    # Without replicas it holds one read-only pool on the primary itself, which for SQLite is the
+    # same file and so is never behind. Real replicas are; `lagging` turns on read-your-writes routing.
+
+    def __init__(self, pools, lagging=False):
+        self.pools = pools
+        self.lagging = lagging
+        self._next = itertools.count()
+
+    def pick(self):
+        return self.pools[next(self._next) % len(self.pools)]
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+    def stats(self):
+        stats = collections.Counter()
+        for pool in self.pools:
+            stats.update(pool.stats())
+        stats['replicas'] = len(self.pools)
+        return dict(stats)
+
 
-        g.db.row_factory = sqlite3.Row
-    #  sqlite3.Row tells the connection to return rows that behave like dicts. This allows accessing the columns by name.
-    #  相当于 pymysql.cursors.DictCursor
+_pool_lock = threading.Lock()
+
+
+def _open_pools(app, readonly):
+    size = app.config['DB_READ_POOL_SIZE' if readonly else 'DB_POOL_SIZE']
+    if not readonly:
+        return open_pool(app, database_url(app), size)
+
+    urls = app.config['DATABASE_REPLICA_URLS'] or [database_url(app)]
+    return ReplicaSet(
+        [open_pool(app, url, size, readonly=True) for url in urls],
+        lagging=bool(app.config['DATABASE_REPLICA_URLS']),
+    )
+
+
+def get_pool(app=None, readonly=False):
+    # 连接池挂在 app 上，每个 app 一个（测试里每个测试都会创建新的 app 和新的数据库文件）
+    # readonly=True returns one of the replica pools, in turn.
+    app = app or current_app._get_current_object()
+    key = 'flaskr.db.read' if readonly else 'flaskr.db'
+    pool = app.extensions.get(key)
+
+    if pool is None:
+        with _pool_lock:
+            pool = app.extensions.get(key)
+            if pool is None:
+                pool = app.extensions[key] = _open_pools(app, readonly)
+
+    return pool.pick() if readonly else pool
+
+
+def close_pools(app):
+    # flaskr.writer 的写队列先把排队的写操作提交完，再关闭连接池
+    for key in ('flaskr.writer', 'flaskr.db', 'flaskr.db.read', 'flaskr.sessions.pool'):
+        pool = app.extensions.pop(key, None)
+        if pool is not None:
+            pool.close()
+
+
+def _checkout(pool):
+    db = pool.checkout()
+
+    # flaskr.metrics 打开的时候会在这里包一层，统计每条 SQL 的耗时
+    wrap = current_app.extensions.get('flaskr.db.wrap')
+    if wrap is not None:
+        db = wrap(db)
+
+    return db
+
+
+# session 里记录这个用户最后一次写入（提交）的时间
+WROTE_AT = '_db_wrote_at'
+
+
+def reads_own_writes():
+    # 副本有复制延迟：一个用户刚写过（DB_READ_YOUR_WRITES 秒以内），他的读请求也走主库，
+    # so a redirect to the page showing the new post doesn't read a replica that hasn't got it yet.
+    # Other users keep reading from the replicas.
+    replicas = current_app.extensions.get('flaskr.db.read')
+    if replicas is None or not replicas.lagging or not has_request_context():
+        return False
+    return session.get(WROTE_AT, 0) > time.time() - current_app.config['DB_READ_YOUR_WRITES']
+
+
+def get_db():
+    if 'db' not in g:
+        g.db = _checkout(get_pool())
 
     return g.db
 
 
+def mark_written():
+    # 写操作提交之后调用：只拿了写连接、没有提交任何东西的请求不会把用户绑到主库上，也不会改写 session cookie。
+    if has_request_context() and current_app.config['DATABASE_REPLICA_URLS']:
+        session[WROTE_AT] = time.time()
+
+
+def get_read_db():
+    # 如果这个请求已经拿到了写连接，就继续用它读，这样能读到自己刚写的数据（read-your-writes）
+    if 'db' in g:
+        return g.db
+
+    if 'read_db' not in g:
+        # get_pool() 先创建副本的连接池，reads_own_writes() 要看它
+        replica = get_pool(readonly=True)
+        g.read_db = _checkout(get_pool() if reads_own_writes() else replica)
+
+    return g.read_db
+
+
 def close_db(e=None):
     # g设置变量，直接用.XX 就行，删除要用pop
-    db = g.pop('db', None)
+    for name in ('db', 'read_db'):
+        db = g.pop(name, None)
 
-    if db is not None:  # if a connection was created by checking if g.db was set
-        db.close()
+        if db is not None:  # if a connection was created by checking if g.db was set
+            # e 是请求中没有处理的异常，出过错的连接直接丢弃，不放回池子
+            db.close(discard=e is not None)
 
 
-def init_db():
-    db = get_db()
+def release_db():
+    # 写完马上把连接还给连接池，不用等到请求结束 (teardown)。默认只有一个写连接 (DB_POOL_SIZE=1)，
+    # so a view calls this right after its commit: rendering the page or redirecting doesn't need the
+    # connection, and every other write is waiting for it. A later get_db()/get_read_db() checks out a new one.
+    close_db()
+
+
+# init-db 会删掉所有的表，只适合开发和测试。已经有数据的数据库用 `flask db upgrade`（见下面的 MIGRATIONS）。
+# 删除的顺序：先删虚拟表，再删引用 user 的表
+TABLES = (
+    'post_fts', 'user_stats', 'posts_generation', 'session', 'import_checkpoint', 'import_deferred',
+    'schema_version', 'post', 'user',
+)
+
 
+def run_sql(db, filename):
     # 在 flask 中打开文件的方式，路径都是相对于 flaskr 的，你配置了 instance_relative_config=True
     # open_resource() opens a file relative to the flaskr package, which is useful since you won’t necessarily know
     # where that location is when deploying the application later.
-    # get_db returns a database connection, which is used to execute the commands read from the file.
-    with current_app.open_resource('schema.sql') as f:
+    with current_app.open_resource(filename) as f:
         db.executescript(f.read().decode('utf8'))
 
 
+def init_db():
+    db = get_db()
+
+    for table in TABLES:
+        db.execute('DROP TABLE IF EXISTS {}'.format(table))
+    db.commit()
+
+    # 空数据库上跑一遍所有的迁移，建出来的 schema 和 upgrade 以后的一模一样
+    upgrade()
+
+
 # click.command() defines a command line command called init-db that calls the init_db function
 # and shows a success message to the user. You can read Command Line Interface to learn more about writing commands.
 @click.command('init-db')
@@ -59,6 +461,524 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+def rebuild_search_index():
+    # 给已有的数据库补建全文索引，或者重建一个坏掉的索引。
+    # Creates post_fts and its triggers if this database predates them, then rebuilds the index with
+    # FTS5's 'rebuild', one statement in one transaction. Re-indexing in batches would race with the
+    # triggers: posts written meanwhile would be indexed twice and updates would 'delete' entries that
+    # were never indexed, which corrupts the index. Readers carry on (WAL); writers wait for the rebuild.
+    # Whatever the triggers did to a new or half-built index before it is thrown away by the rebuild,
+    # so running this again after an interruption always ends with a complete index.
+    db = get_db()
+    run_sql(db, 'search.sql')
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute("INSERT INTO post_fts(post_fts) VALUES ('rebuild')")
+        indexed = db.execute('SELECT COUNT(*) FROM post').fetchone()[0]
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+    return indexed
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """Create the full-text index if needed and re-index all posts."""
+    indexed = rebuild_search_index()
+    click.echo('Indexed {} posts.'.format(indexed))
+
+
+# post.author_username 和 user_stats（见 authors.sql）。旧的数据库用 migrate-authors（也就是迁移 3）加上新列、表和触发器，
+# 再分批回填；check-authors 和 user / post 表对比，找出不一致的行。
+def _has_author_username(db):
+    return any(row['name'] == 'author_username' for row in db.execute('PRAGMA table_info(post)'))
+
+
+def refresh_user_stats(db):
+    # 从 post 表整个重新算一遍，一条 GROUP BY 走 post_author_id 索引
+    db.execute('DELETE FROM user_stats')
+    db.execute(
+        'INSERT INTO user_stats (user_id, post_count, last_post_at)'
+        ' SELECT author_id, COUNT(*), MAX(created) FROM post GROUP BY author_id'
+    )
+
+
+def migrate_authors(batch_size=1000, pause=0):
+    # Safe to run more than once: only rows whose author_username is still missing are filled in.
+    db = get_db()
+
+    if not _has_author_username(db):
+        db.execute('ALTER TABLE post ADD COLUMN author_username TEXT')
+
+    run_sql(db, 'authors.sql')
+
+    last_id = 0
+    updated = 0
+
+    # 按 id 分段回填，每段一个事务，不会长时间占着写锁
+    while True:
+        row = db.execute(
+            'SELECT MAX(id) FROM (SELECT id FROM post WHERE id > ? ORDER BY id LIMIT ?)', (last_id, batch_size)
+        ).fetchone()
+        if row[0] is None:
+            break
+
+        updated += db.execute(
+            'UPDATE post SET author_username = (SELECT username FROM user WHERE user.id = post.author_id)'
+            ' WHERE id > ? AND id <= ? AND author_username IS NULL',
+            (last_id, row[0])
+        ).rowcount
+        db.commit()
+        last_id = row[0]
+        time.sleep(pause)
+
+    refresh_user_stats(db)
+    db.commit()
+
+    return updated
+
+
+def check_authors(fix=False):
+    # Returns (posts, users): the number of posts whose author_username is wrong and the number of
+    # users whose user_stats row doesn't match their posts, counted before fixing anything.
+    db = get_db()
+
+    posts = db.execute(
+        'SELECT COUNT(*) FROM post p JOIN user u ON p.author_id = u.id WHERE p.author_username IS NOT u.username'
+    ).fetchone()[0]
+    users = db.execute(
+        'SELECT COUNT(*) FROM user u LEFT JOIN user_stats s ON s.user_id = u.id'
+        ' LEFT JOIN (SELECT author_id, COUNT(*) AS post_count, MAX(created) AS last_post_at'
+        '            FROM post GROUP BY author_id) a ON a.author_id = u.id'
+        ' WHERE coalesce(s.post_count, 0) != coalesce(a.post_count, 0) OR s.last_post_at IS NOT a.last_post_at'
+    ).fetchone()[0]
+
+    if fix and (posts or users):
+        db.execute(
+            'UPDATE post SET author_username = (SELECT username FROM user WHERE user.id = post.author_id)'
+            ' WHERE author_username IS NOT (SELECT username FROM user WHERE user.id = post.author_id)'
+        )
+        refresh_user_stats(db)
+        db.commit()
+
+    return posts, users
+
+
+@click.command('migrate-authors')
+@click.option('--batch-size', default=1000, show_default=True, help='Posts updated per transaction.')
+@with_appcontext
+def migrate_authors_command(batch_size):
+    """Add post.author_username and user_stats to an existing database."""
+    updated = migrate_authors(batch_size)
+    click.echo('Updated {} posts.'.format(updated))
+
+
+@click.command('check-authors')
+@click.option('--fix', is_flag=True, help='Rewrite the rows that are out of sync.')
+@with_appcontext
+def check_authors_command(fix):
+    """Compare post.author_username and user_stats with the user and post tables."""
+    posts, users = check_authors(fix)
+
+    if not (posts or users):
+        click.echo('post.author_username and user_stats are consistent.')
+    elif fix:
+        click.echo('Fixed {} posts and {} user_stats rows.'.format(posts, users))
+    else:
+        raise click.ClickException(
+            '{} posts and {} user_stats rows are out of sync; run with --fix to repair them.'.format(posts, users)
+        )
+
+
+# 数据库迁移：schema 的每一次修改都是 MIGRATIONS 里的一个编号，schema_version 表记录已经执行过的编号，
+# `flask db upgrade` 按顺序执行还没执行过的，`flask db status` 列出每个迁移的状态。init-db 也是在空数据库上跑 upgrade。
+# Every migration must be safe to run again on a database that already has its changes (IF NOT EXISTS,
+# checking for a column before adding it) or only part of them: databases created before schema_version
+# existed start at version 0 and run all of them, and a migration interrupted halfway is run again and
+# has to finish the job, so a backfill resumes from what is still missing rather than from whether a
+# table exists.
+# Backfills that can run beside the app's writes (author_username) go in batches of --batch-size rows,
+# one transaction each, with --pause seconds in between. The search index can't: its triggers and a
+# batched backfill would both write the same rows, so it is rebuilt in one transaction (see
+# rebuild_search_index). SQLite builds an index in a single statement as well; readers are not blocked
+# meanwhile (WAL), writers wait up to busy_timeout.
+# Only one upgrade runs at a time, see UpgradeLock.
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(f):
+        MIGRATIONS.append((version, description, f))
+        MIGRATIONS.sort(key=lambda migration: migration[0])
+        return f
+
+    return decorator
+
+
+@migration(1, 'user and post tables, post(created, id) index')
+def _migrate_tables(db, batch_size, pause):
+    run_sql(db, 'schema.sql')
+
+
+@migration(2, 'full-text search (post_fts)')
+def _migrate_search(db, batch_size, pause):
+    rebuild_search_index()
+
+
+@migration(3, 'post.author_username and user_stats')
+def _migrate_authors(db, batch_size, pause):
+    migrate_authors(batch_size, pause)
+
+
+@migration(4, 'posts_generation for the page caches')
+def _migrate_generation(db, batch_size, pause):
+    run_sql(db, 'generation.sql')
+
+
+def schema_version(db):
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT NOT NULL,'
+        ' applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, seconds REAL NOT NULL)'
+    )
+    return {row[0]: row for row in db.execute('SELECT version, description, applied, seconds FROM schema_version')}
+
+
+class UpgradeLocked(click.ClickException):
+    pass
+
+
+class UpgradeLock(object):
+    # 两个节点同时跑 `flask db upgrade` 的话，同一个迁移会执行两遍，第二个写 schema_version 的时候还会撞上主键。
+    # The lock is an OS file lock (flock) on a file next to the database, which every node that shares
+    # the SQLite file can reach. The kernel holds it for as long as the file is open and drops it when
+    # the process exits, so a crashed upgrade never leaves it behind, and a long migration step (a big
+    # CREATE INDEX or the FTS rebuild) can't make it look abandoned. Anyone else waits up to `wait` seconds.
+
+    def __init__(self, path, wait=600.0):
+        self.path = path
+        self.wait = wait
+        self._file = None
+
+    def acquire(self):
+        deadline = time.monotonic() + self.wait
+        f = open(self.path, 'a')
+        try:
+            while not _try_lock(f):
+                if time.monotonic() >= deadline:
+                    raise UpgradeLocked('Another `flask db upgrade` is running.')
+                time.sleep(0.1)
+        except BaseException:
+            f.close()
+            raise
+        self._file = f
+
+    def release(self):
+        f, self._file = self._file, None
+        if f is not None:
+            _unlock(f)
+            f.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _try_lock(f):
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def _unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def upgrade_lock_path(app):
+    # <database>-upgrade.lock for SQLite, never the database file itself: closing any other handle on
+    # it would drop the locks SQLite holds. A database server has no file here, so that falls back to
+    # the instance folder, which only keeps upgrades on the same host apart.
+    if database_url(app).partition('://')[0] == 'sqlite':
+        return get_pool(app).database + '-upgrade.lock'
+    return os.path.join(app.instance_path, 'upgrade.lock')
+
+
+def upgrade(target=None, batch_size=1000, pause=0, echo=None, wait=600.0):
+    # Runs the pending migrations up to target (all of them by default); returns their versions.
+    # wait: seconds to wait for an upgrade that is already running elsewhere to finish.
+    db = get_db()
+    done = []
+
+    with UpgradeLock(upgrade_lock_path(current_app._get_current_object()), wait=wait):
+        # 拿到锁以后再读：别的节点刚刚可能已经执行完了
+        applied = schema_version(db)
+        db.commit()
+
+        for version, description, migrate in MIGRATIONS:
+            if version in applied or (target is not None and version > target):
+                continue
+
+            if echo is not None:
+                echo('{:>4}  {}'.format(version, description))
+            started = time.perf_counter()
+            migrate(db, batch_size, pause)
+            db.execute('INSERT INTO schema_version (version, description, seconds) VALUES (?, ?, ?)',
+                       (version, description, time.perf_counter() - started))
+            db.commit()
+            done.append(version)
+
+    # journal_mode 是写在数据库文件里的，设置一次以后所有连接（包括别的进程）都会用 WAL
+    # Unlike the other PRAGMAs, journal_mode=WAL is stored in the database file itself. Pools that
+    # don't set PRAGMAs (a database server sets up its own connections) leave it alone.
+    journal_mode = get_pool().pragmas.get('journal_mode')
+    if journal_mode is not None:
+        db.execute('PRAGMA journal_mode={}'.format(journal_mode))
+
+    return done
+
+
+@click.group('db')
+def db_group():
+    """Versioned schema migrations."""
+
+
+@db_group.command('upgrade')
+@click.option('--to', 'target', type=int, help='Stop after this version.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows backfilled per transaction.')
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to wait between batches.')
+@with_appcontext
+def upgrade_command(target, batch_size, pause):
+    """Run the migrations that haven't been applied yet."""
+    done = upgrade(target, batch_size, pause, echo=click.echo)
+    if done:
+        click.echo('Upgraded to version {}.'.format(done[-1]))
+    else:
+        click.echo('Already up to date.')
+
+
+@db_group.command('status')
+@with_appcontext
+def status_command():
+    """List the migrations and whether they have been applied."""
+    db = get_db()
+    applied = schema_version(db)
+    db.commit()
+
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            state = 'applied {} ({:.1f} s)'.format(applied[version]['applied'], applied[version]['seconds'])
+        else:
+            state = 'pending'
+        click.echo('{:>4}  {:<48} {}'.format(version, description, state))
+
+    pending = sum(1 for version, _, _ in MIGRATIONS if version not in applied)
+    if pending:
+        raise click.ClickException('{} migrations pending; run `flask db upgrade`.'.format(pending))
+
+
+# 批量导入 / 导出。导出格式是 NDJSON（每行一个 JSON 对象）或 CSV，每条记录的 type 是 user 或 post，
+# 先导出所有用户，再导出所有文章。用户的 password 是已经哈希过的值，导入时原样写回，不会重新哈希。
+# Both directions stream: export reads the tables with fetchmany() and import reads the file line by
+# line, so memory use doesn't depend on the number of rows.
+BULK_FIELDS = ('type', 'id', 'username', 'password', 'author_id', 'created', 'title', 'body')
+
+
+def export_records(batch_size=1000):
+    db = get_read_db()
+
+    for type, sql in (
+        ('user', 'SELECT id, username, password FROM user ORDER BY id'),
+        ('post', 'SELECT id, author_id, created, title, body FROM post ORDER BY id'),
+    ):
+        cursor = db.execute(sql)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                record = dict(row, type=type)
+                if 'created' in record:
+                    record['created'] = str(record['created'])
+                yield record
+
+
+def read_records(f, format):
+    if format == 'csv':
+        for record in csv.DictReader(f):
+            # CSV 里所有的值都是字符串，空字符串表示这一列对这种记录不适用
+            yield {key: value for key, value in record.items() if value != ''}
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _defer_post_maintenance(db):
+    # import-posts --defer-indexes：导入前先删掉 post 表上的索引和触发器（包括全文索引的同步触发器），导入完再一次性重建，
+    # 比每插入一行都更新一遍索引快得多。删掉的定义先存到 import_deferred 表里，导入中断了下次也能恢复。
+    # Only for offline loads: while the import runs, the index, author and search pages of a live app
+    # fall back to full table scans and sorts, and writes from the app are not indexed until the end.
+    db.execute('CREATE TABLE IF NOT EXISTS import_deferred (name TEXT PRIMARY KEY, type TEXT, sql TEXT)')
+    for name, type, sql in db.execute(
+        "SELECT name, type, sql FROM sqlite_master"
+        " WHERE tbl_name = 'post' AND type IN ('index', 'trigger') AND sql IS NOT NULL"
+    ).fetchall():
+        db.execute('INSERT OR REPLACE INTO import_deferred VALUES (?, ?, ?)', (name, type, sql))
+        db.execute('DROP {} {}'.format(type.upper(), name))
+    db.commit()
+
+
+def _restore_post_maintenance(db):
+    for name, sql in db.execute('SELECT name, sql FROM import_deferred').fetchall():
+        db.execute(sql)
+    db.execute('DROP TABLE import_deferred')
+
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'post_fts'").fetchone():
+        db.execute("INSERT INTO post_fts(post_fts) VALUES ('rebuild')")
+
+    # 作者名和 user_stats 的触发器也被删掉过，导入的文章要补上
+    if _has_author_username(db):
+        db.execute(
+            'UPDATE post SET author_username = (SELECT username FROM user WHERE user.id = post.author_id)'
+            ' WHERE author_username IS NULL'
+        )
+        refresh_user_stats(db)
+    db.commit()
+
+
+def import_records(records, source=None, batch_size=5000, defer_indexes=False):
+    # records 是 dict 的可迭代对象。INSERT OR IGNORE 加上显式的 id，重复导入同一个文件不会产生重复数据；
+    # source 不为空时，每批提交的同时在 import_checkpoint 里记下已经导入到第几条，中断后再运行会跳过这些记录。
+    # Returns (users, posts) written by this run.
+    db = get_db()
+    db.execute('CREATE TABLE IF NOT EXISTS import_checkpoint (source TEXT PRIMARY KEY, position INTEGER NOT NULL)')
+    done = 0
+    if source is not None:
+        row = db.execute('SELECT position FROM import_checkpoint WHERE source = ?', (source,)).fetchone()
+        done = row[0] if row is not None else 0
+    # an earlier import with defer_indexes was interrupted: its indexes are still dropped, restore them at the end
+    deferred = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'import_deferred'").fetchone() is not None
+    db.commit()
+
+    if defer_indexes:
+        _defer_post_maintenance(db)
+        deferred = True
+
+    users, posts = [], []
+    counts = [0, 0]
+    position = 0
+
+    def flush():
+        if users:
+            counts[0] += db.executemany(
+                'INSERT OR IGNORE INTO user (id, username, password) VALUES (?, ?, ?)', users
+            ).rowcount
+        if posts:
+            counts[1] += db.executemany(
+                'INSERT OR IGNORE INTO post (id, author_id, created, title, body) VALUES (?, ?, ?, ?, ?)', posts
+            ).rowcount
+        if source is not None:
+            db.execute('INSERT OR REPLACE INTO import_checkpoint VALUES (?, ?)', (source, position))
+        db.commit()
+        del users[:], posts[:]
+
+    for record in records:
+        position += 1
+        if position <= done:
+            continue
+
+        if record['type'] == 'user':
+            users.append((record['id'], record['username'], record['password']))
+        elif record['type'] == 'post':
+            posts.append((record['id'], record['author_id'], record['created'], record['title'], record['body']))
+        else:
+            raise click.ClickException('Unknown record type {!r} at record {}.'.format(record['type'], position))
+
+        if len(users) + len(posts) >= batch_size:
+            flush()
+
+    flush()
+
+    if deferred:
+        _restore_post_maintenance(db)
+    if source is not None:
+        db.execute('DELETE FROM import_checkpoint WHERE source = ?', (source,))
+        db.commit()
+
+    return tuple(counts)
+
+
+def _format_for(path, format):
+    if format is not None:
+        return format
+    return 'csv' if path.endswith('.csv') else 'ndjson'
+
+
+def _open_bulk_file(path, mode):
+    # newline='' 让 CSV 字段里的 \r\n（浏览器提交的 textarea 就是这样换行的）原样保留
+    if path == '-':
+        return contextlib.nullcontext(click.get_text_stream('stdout' if mode == 'w' else 'stdin', encoding='utf8'))
+    return open(path, mode, encoding='utf8', newline='')
+
+
+@click.command('export-posts')
+@click.argument('output', type=click.Path(dir_okay=False, allow_dash=True), default='-')
+@click.option('--format', type=click.Choice(['ndjson', 'csv']), help='Defaults to the file extension, else ndjson.')
+@with_appcontext
+def export_posts_command(output, format):
+    """Export all users and posts as NDJSON or CSV."""
+    format = _format_for(output, format)
+
+    with _open_bulk_file(output, 'w') as f:
+        if format == 'csv':
+            writer = csv.DictWriter(f, BULK_FIELDS)
+            writer.writeheader()
+            writer.writerows(export_records())
+        else:
+            for record in export_records():
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+@click.command('import-posts')
+@click.argument('input', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', type=click.Choice(['ndjson', 'csv']), help='Defaults to the file extension, else ndjson.')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows written per transaction.')
+@click.option('--defer-indexes', is_flag=True,
+              help='Drop the indexes and triggers of post during the import and rebuild them at the end.'
+                   ' Faster, but only for offline loads: the app falls back to full scans meanwhile.')
+@with_appcontext
+def import_posts_command(input, format, batch_size, defer_indexes):
+    """Import users and posts written by export-posts, resuming an interrupted import."""
+    format = _format_for(input, format)
+    # 从标准输入导入的时候没办法断点续传
+    source = None if input == '-' else os.path.abspath(input)
+
+    with _open_bulk_file(input, 'r') as f:
+        users, posts = import_records(
+            read_records(f, format), source=source, batch_size=batch_size, defer_indexes=defer_indexes
+        )
+
+    # --defer-indexes 导入的时候 posts_generation 的触发器被暂时删掉了，所有 worker 的页面缓存在这里一起失效
+    from flaskr.blog import bump_posts_generation
+    bump_posts_generation()
+
+    click.echo('Imported {} users and {} posts.'.format(users, posts))
+
+
 # 将 close_db 和 init_db_command 函数注册到 flask 实例中，让flask 知道他们的存在。注意，因为采用了工厂方法，我们采用了完全不同的获取
 # app 实例的方式。 上面是通过 current_app，现在是设置一个函数，通过在另一段代码中调用
 # The close_db and init_db_command functions need to be registered with the application instance
@@ -70,5 +990,11 @@ def init_app(app):
     # 返回响应的时候回调
 
     app.cli.add_command(init_db_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(migrate_authors_command)
+    app.cli.add_command(check_authors_command)
+    app.cli.add_command(export_posts_command)
+    app.cli.add_command(import_posts_command)
+    app.cli.add_command(db_group)
     # adds a new command that can be called with the flask command.
     # 添加到 flask 命令行
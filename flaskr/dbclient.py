@@ -0,0 +1,242 @@
+import base64
+import collections
+import datetime
+import json
+import socket
+import sqlite3
+from urllib.parse import unquote, urlsplit
+
+from flaskr.db import ConnectionPool
+
+# 客户端-服务器模式的存储后端：DATABASE_URL = 'flaskrdb://:secret@host:port'。
+# The database lives behind a server and every worker keeps a pool of TCP connections to it instead
+# of opening the file itself. The only server is the flaskr.dbserver stand-in the tests run, which
+# exercises this code path; a production deployment would register a real client-server driver in
+# flaskr.db.BACKENDS instead.
+# RemoteConnection speaks newline-delimited JSON and implements the part of sqlite3.Connection that
+# flaskr uses: execute / executemany / executescript, fetchone / fetchmany / fetchall, commit /
+# rollback and in_transaction. Errors come back as the same sqlite3 exception classes, so the views'
+# `except sqlite3.IntegrityError` works unchanged.
+
+DEFAULT_PORT = 7432
+
+
+def _default(value):
+    # JSON 没有日期和二进制类型，编码成带标记的对象
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat(' ')}
+    if isinstance(value, datetime.date):
+        return {'$date': value.isoformat()}
+    if isinstance(value, (bytes, memoryview)):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    raise TypeError('Cannot send {!r} to the database server'.format(type(value).__name__))
+
+
+def _object_hook(obj):
+    if len(obj) == 1:
+        if '$datetime' in obj:
+            return datetime.datetime.fromisoformat(obj['$datetime'])
+        if '$date' in obj:
+            return datetime.date.fromisoformat(obj['$date'])
+        if '$bytes' in obj:
+            return base64.b64decode(obj['$bytes'])
+    return obj
+
+
+def dumps(message):
+    return json.dumps(message, default=_default, separators=(',', ':')).encode('utf8') + b'\n'
+
+
+def loads(line):
+    return json.loads(line, object_hook=_object_hook)
+
+
+def _parameters(parameters):
+    # 命名参数（dict）原样发送，位置参数转成 list
+    return parameters if isinstance(parameters, dict) else list(parameters)
+
+
+class Row(tuple):
+    # 和 sqlite3.Row 一样，可以用下标或者列名取值，dict(row) 也可以
+    def __new__(cls, values, columns):
+        row = super().__new__(cls, values)
+        row._columns = columns
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                key = self._columns[key]
+            except KeyError:
+                raise IndexError('No item with that key')
+        return super().__getitem__(key)
+
+    def keys(self):
+        return list(self._columns)
+
+
+class RemoteCursor(object):
+    # The server sends the first `arraysize` rows with the answer to execute() and keeps the cursor
+    # open for the rest, so fetchmany() on a large result set streams it batch by batch.
+    arraysize = 500
+
+    def __init__(self, connection, response):
+        self.connection = connection
+        self.lastrowid = response.get('lastrowid')
+        self.rowcount = response.get('rowcount', -1)
+
+        columns = response.get('columns')
+        if columns is None:
+            self.description = None
+            self._columns = {}
+        else:
+            self.description = tuple((name,) + (None,) * 6 for name in columns)
+            self._columns = {name: index for index, name in enumerate(columns)}
+
+        self._rows = collections.deque(response.get('rows', ()))
+        self._cursor = response.get('cursor')
+
+    def _fill(self):
+        if not self._rows and self._cursor is not None:
+            response = self.connection._call(op='fetch', cursor=self._cursor, size=self.arraysize)
+            self._rows.extend(response['rows'])
+            self._cursor = response['cursor']
+
+    def fetchone(self):
+        self._fill()
+        if not self._rows:
+            return None
+        return Row(self._rows.popleft(), self._columns)
+
+    def fetchmany(self, size=None):
+        size = size or self.arraysize
+        rows = []
+        while len(rows) < size:
+            self._fill()
+            if not self._rows:
+                break
+            rows.append(Row(self._rows.popleft(), self._columns))
+        return rows
+
+    def fetchall(self):
+        rows = []
+        while True:
+            batch = self.fetchmany()
+            if not batch:
+                return rows
+            rows += batch
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def close(self):
+        self._rows.clear()
+        if self._cursor is not None:
+            self.connection._call(op='close', cursor=self._cursor)
+            self._cursor = None
+
+
+class RemoteConnection(object):
+    # One TCP connection is one server-side sqlite3 connection, with its own transaction.
+    uses = 0
+    row_factory = None
+
+    def __init__(self, host, port, secret='', timeout=None):
+        # timeout 只用于建立连接；查询本身可能要跑很久
+        self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._sock.settimeout(None)
+        # 请求和响应都很小，不要等 Nagle 攒包
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rwb')
+        self.in_transaction = False
+
+        try:
+            self._call(op='hello', secret=secret)
+        except sqlite3.Error:
+            self.close()
+            raise
+
+    def _call(self, **request):
+        if self._file is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+
+        try:
+            self._file.write(dumps(request))
+            self._file.flush()
+            line = self._file.readline()
+        except OSError as e:
+            raise sqlite3.OperationalError('Lost the connection to the database server: {}'.format(e))
+        if not line:
+            raise sqlite3.OperationalError('The database server closed the connection.')
+
+        response = loads(line)
+        self.in_transaction = response.get('in_transaction', False)
+
+        if 'error' in response:
+            error = getattr(sqlite3, response['error']['type'], None)
+            if not (isinstance(error, type) and issubclass(error, sqlite3.Error)):
+                error = sqlite3.DatabaseError
+            raise error(response['error']['message'])
+
+        return response
+
+    def execute(self, sql, parameters=()):
+        response = self._call(op='execute', sql=sql, params=_parameters(parameters), size=RemoteCursor.arraysize)
+        return RemoteCursor(self, response)
+
+    def executemany(self, sql, seq_of_parameters):
+        response = self._call(op='executemany', sql=sql, params=[_parameters(p) for p in seq_of_parameters])
+        return RemoteCursor(self, response)
+
+    def executescript(self, sql):
+        return RemoteCursor(self, self._call(op='executescript', sql=sql))
+
+    def commit(self):
+        self._call(op='commit')
+
+    def rollback(self):
+        self._call(op='rollback')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def close(self):
+        # 服务器读到 EOF 就关闭它那边的 sqlite3 连接，没提交的事务随之回滚
+        if self._file is not None:
+            self._file.close()
+            self._sock.close()
+            self._file = None
+
+
+class RemotePool(ConnectionPool):
+    # The same pool as for SQLite, with TCP connections to the server instead of file handles.
+    # SQLITE_PRAGMAS are not sent: the server sets up its own connections and refuses PRAGMAs from clients.
+
+    def __init__(self, address, secret='', **options):
+        super().__init__(address, **options)
+        self.secret = secret
+
+    @classmethod
+    def from_url(cls, url, **options):
+        parts = urlsplit(url)
+        options.pop('pragmas', None)
+        return cls((parts.hostname or '127.0.0.1', parts.port or DEFAULT_PORT),
+                   secret=unquote(parts.password or ''), **options)
+
+    def open(self):
+        host, port = self.database
+        return RemoteConnection(host, port, secret=self.secret, timeout=self.timeout)
+
+    def connect(self):
+        return self.open()
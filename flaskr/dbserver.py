@@ -0,0 +1,148 @@
+import collections
+import hmac
+import itertools
+import os
+import secrets
+import socketserver
+import sqlite3
+from urllib.parse import quote
+
+from flaskr.dbclient import dumps, loads
+
+# flaskr.dbclient 的服务器端：一个很小的数据库服务器，把一个 SQLite 文件通过 TCP 提供给 flaskrdb:// 的客户端。
+# It is a stand-in for a real client-server database in the tests, not something to deploy: it only
+# listens on 127.0.0.1, has no CLI command, and a "replica" (readonly=True) is a read-only view of the
+# same file, which exercises the replica routing in flaskr.db but doesn't scale anything out.
+# Every client connection gets its own sqlite3 connection and thread, so transactions and open
+# cursors belong to the connection, as they would on a real server.
+# Clients must first send the server's secret (the password of its URL). After that they can run SQL
+# on the database, but not ATTACH / DETACH (which includes VACUUM INTO) or PRAGMAs that change
+# anything, so a client can't reach other files or change how the server opens the database.
+
+# 每个连接最多保留的未读完的游标数，超过就关闭最早的
+MAX_CURSORS = 16
+
+# 允许的 PRAGMA，都是只读的：migrate_authors 用 table_info 看有没有某一列，FTS5 自己会读 data_version
+READ_PRAGMAS = ('data_version', 'table_info')
+
+
+def authorize(action, arg1, arg2, database, trigger):
+    if action in (sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH):
+        return sqlite3.SQLITE_DENY
+    if action == sqlite3.SQLITE_PRAGMA and arg1 not in READ_PRAGMAS:
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+
+class DatabaseHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # 第一行必须是 hello 和正确的 secret，否则直接断开，不打开数据库
+        hello = loads(self.rfile.readline() or b'{}')
+        if hello.get('op') != 'hello' or not hmac.compare_digest(
+            str(hello.get('secret', '')).encode('utf8'), self.server.secret.encode('utf8')
+        ):
+            self.wfile.write(dumps({'error': {'type': 'OperationalError', 'message': 'Authentication failed.'}}))
+            return
+        self.wfile.write(dumps({}))
+
+        conn = self.server.connect()
+        self.cursors = collections.OrderedDict()
+        self.ids = itertools.count(1)
+
+        try:
+            for line in self.rfile:
+                request = loads(line)
+                try:
+                    response = getattr(self, 'op_' + request['op'])(conn, request)
+                except sqlite3.Error as e:
+                    response = {'error': {'type': type(e).__name__, 'message': str(e)}}
+                response['in_transaction'] = conn.in_transaction
+                self.wfile.write(dumps(response))
+        finally:
+            conn.close()
+
+    def _result(self, cursor, size=0):
+        response = {'lastrowid': cursor.lastrowid, 'rowcount': cursor.rowcount, 'cursor': None}
+        if cursor.description is None:
+            return response
+
+        response['columns'] = [column[0] for column in cursor.description]
+        return self._rows(response, cursor, size)
+
+    def _rows(self, response, cursor, size):
+        response['rows'] = [list(row) for row in cursor.fetchmany(size)]
+
+        if len(response['rows']) == size:
+            # 可能还有，游标留着给下一个 fetch
+            cursor_id = response['cursor'] or next(self.ids)
+            self.cursors[cursor_id] = cursor
+            if len(self.cursors) > MAX_CURSORS:
+                self.cursors.popitem(last=False)[1].close()
+            response['cursor'] = cursor_id
+        else:
+            cursor.close()
+            response['cursor'] = None
+
+        return response
+
+    def op_execute(self, conn, request):
+        return self._result(conn.execute(request['sql'], request['params']), request['size'])
+
+    def op_fetch(self, conn, request):
+        cursor = self.cursors.pop(request['cursor'], None)
+        if cursor is None:
+            raise sqlite3.ProgrammingError('The cursor is closed.')
+        return self._rows({'cursor': request['cursor']}, cursor, request['size'])
+
+    def op_close(self, conn, request):
+        cursor = self.cursors.pop(request['cursor'], None)
+        if cursor is not None:
+            cursor.close()
+        return {}
+
+    def op_executemany(self, conn, request):
+        return self._result(conn.executemany(request['sql'], request['params']))
+
+    def op_executescript(self, conn, request):
+        return self._result(conn.executescript(request['sql']))
+
+    def op_commit(self, conn, request):
+        conn.commit()
+        return {}
+
+    def op_rollback(self, conn, request):
+        conn.rollback()
+        return {}
+
+
+class DatabaseServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    # 连接池里的连接一直开着，关闭服务器的时候不等它们
+    block_on_close = False
+    allow_reuse_address = True
+
+    def __init__(self, database, port=0, readonly=False, secret=None, pragmas=None):
+        # PRAGMAs are applied by the server to every connection it opens; clients can't send them.
+        self.database = database
+        self.readonly = readonly
+        self.secret = secret or secrets.token_urlsafe(24)
+        self.pragmas = pragmas or {}
+        # 只监听本机，见上面的说明
+        super().__init__(('127.0.0.1', port), DatabaseHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'flaskrdb://:{}@{}:{}'.format(self.secret, host, port)
+
+    def connect(self):
+        if self.readonly:
+            database, uri = 'file:{}?mode=ro'.format(quote(os.path.abspath(self.database))), True
+        else:
+            database, uri = self.database, False
+
+        # 和本地连接一样按声明的类型转换 TIMESTAMP，客户端收到的是 datetime
+        conn = sqlite3.connect(database, uri=uri, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        conn.executescript(''.join('PRAGMA {}={};'.format(name, value) for name, value in self.pragmas.items()))
+        conn.set_authorizer(authorize)
+        return conn
@@ -0,0 +1,23 @@
+-- 迁移 4：页面缓存和 ETag 用的 posts generation（见 blog.posts_generation）。
+-- 放在数据库里而不是进程内缓存里，所有 worker、所有节点看到的都是同一个值。
+-- modified is the time of the last change to post, in seconds since the epoch; it only ever grows,
+-- even for several writes within the same millisecond, so it serves as the generation and as Last-Modified.
+CREATE TABLE IF NOT EXISTS posts_generation(
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  modified REAL NOT NULL
+);
+
+INSERT OR IGNORE INTO posts_generation (id, modified) VALUES (1, (julianday('now') - 2440587.5) * 86400.0);
+
+-- 任何对 post 的修改都会换一个 generation，包括不经过 view 的写入（import-posts、手写的 SQL、改用户名）
+CREATE TRIGGER IF NOT EXISTS posts_generation_insert AFTER INSERT ON post BEGIN
+  UPDATE posts_generation SET modified = max((julianday('now') - 2440587.5) * 86400.0, modified + 0.001) WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_generation_update AFTER UPDATE ON post BEGIN
+  UPDATE posts_generation SET modified = max((julianday('now') - 2440587.5) * 86400.0, modified + 0.001) WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_generation_delete AFTER DELETE ON post BEGIN
+  UPDATE posts_generation SET modified = max((julianday('now') - 2440587.5) * 86400.0, modified + 0.001) WHERE id = 1;
+END;
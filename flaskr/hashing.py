@@ -0,0 +1,122 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# 密码哈希（PBKDF2 / scrypt）故意设计得很慢。登录高峰的时候如果直接在请求线程里算，所有请求线程都会被占住，
+# 连不需要哈希的普通页面也要排队。这里把哈希放到一个单独的、大小固定的线程池里：
+# 最多 HASH_WORKERS 个同时计算，最多 HASH_QUEUE_DEPTH 个排队，再多的请求直接返回 503。
+# hashlib releases the GIL while it hashes, so threads give real parallelism here without the
+# pickling and startup cost of a process pool.
+
+
+class HashQueueFull(ServiceUnavailable):
+    description = 'Too many sign-ins at once, please try again in a moment.'
+
+
+class HashPool(object):
+    def __init__(self, method, workers=4, queue_depth=16):
+        self.method = method
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='flaskr-hash')
+        # 正在计算的加上排队的，总数不超过 workers + queue_depth
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+        self._lock = threading.Lock()
+        self._prefix = None
+
+        self.hashes = 0
+        self.rejected = 0
+        self.hash_seconds = 0.0
+        self.max_hash_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def run(self, func, *args):
+        # Runs func on the pool and blocks until it is done. Raises HashQueueFull right away,
+        # before any work is queued, when the pool is already saturated.
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashQueueFull(retry_after=1)
+
+        queued = time.perf_counter()
+
+        def task():
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self._record(started - queued, time.perf_counter() - started)
+                self._slots.release()
+
+        return self._executor.submit(task).result()
+
+    def _record(self, wait, elapsed):
+        with self._lock:
+            self.hashes += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self.hash_seconds += elapsed
+            self.max_hash_seconds = max(self.max_hash_seconds, elapsed)
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # 存储的哈希形如 pbkdf2:sha256:50000$salt$hash，$ 前面是算法和参数。
+        # PASSWORD_HASH_METHOD may be a shorthand such as 'scrypt'; the full method string werkzeug
+        # stores for it is learned once from a real hash.
+        if self._prefix is None:
+            self._prefix = self.hash('').split('$', 1)[0]
+
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def stats(self):
+        return {
+            'hashes': self.hashes,
+            'rejected': self.rejected,
+            'hash_seconds': self.hash_seconds,
+            'max_hash_seconds': self.max_hash_seconds,
+            'wait_seconds': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+_pool_lock = threading.Lock()
+
+
+def get_hash_pool(app=None):
+    app = app or current_app._get_current_object()
+    pool = app.extensions.get('flaskr.hashing')
+
+    if pool is None:
+        with _pool_lock:
+            pool = app.extensions.get('flaskr.hashing')
+            if pool is None:
+                pool = app.extensions['flaskr.hashing'] = HashPool(
+                    app.config['PASSWORD_HASH_METHOD'],
+                    workers=app.config['HASH_WORKERS'],
+                    queue_depth=app.config['HASH_QUEUE_DEPTH'],
+                )
+
+    return pool
+
+
+def hash_password(password):
+    return get_hash_pool().hash(password)
+
+
+def check_password(pwhash, password):
+    return get_hash_pool().check(pwhash, password)
+
+
+def needs_rehash(pwhash):
+    return get_hash_pool().needs_rehash(pwhash)
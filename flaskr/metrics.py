@@ -0,0 +1,232 @@
+import bisect
+import threading
+import time
+from collections import Counter
+
+from flask import Response, current_app, g, request
+
+# 性能监控，默认关闭 (METRICS_ENABLED=False)。关闭的时候 init_app 什么都不注册，没有任何额外开销。
+# When enabled it records:
+# - a latency histogram per endpoint (before_request / after_request hooks)
+# - the time and count of every execute() on the flaskr.db connections, through TimedConnection
+# - a warning when one request runs the same statement METRICS_N_PLUS_ONE_THRESHOLD times (N+1 queries)
+# and reports them in a Server-Timing header and, in Prometheus text format, at /metrics.
+
+# 单位是秒
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # 最后一个是 +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.queries = {}
+        self.query_counts = Counter()
+        self.n_plus_one = Counter()
+
+    def record(self, endpoint, elapsed, queries):
+        with self._lock:
+            histogram = self.requests.get(endpoint)
+            if histogram is None:
+                histogram = self.requests[endpoint] = Histogram()
+            histogram.observe(elapsed)
+
+            if queries.count:
+                histogram = self.queries.get(endpoint)
+                if histogram is None:
+                    histogram = self.queries[endpoint] = Histogram()
+                histogram.observe(queries.seconds)
+                self.query_counts[endpoint] += queries.count
+
+            if queries.repeated:
+                self.n_plus_one[endpoint] += 1
+
+
+class RequestQueries(object):
+    # 一个请求内执行过的 SQL，挂在 g._queries 上
+    __slots__ = ('count', 'seconds', 'statements', 'repeated')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+        self.repeated = None
+
+
+class TimedConnection(object):
+    # Wraps the connection get_db()/get_read_db() hand out and times the statements run through it.
+    # Fetching rows from the returned cursor is not included, only the execute() call itself.
+    __slots__ = ('_db',)
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def __enter__(self):
+        self._db.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._db.__exit__(*exc_info)
+
+    def _timed(self, method, sql, *args):
+        start = time.perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            queries = g.get('_queries')
+            if queries is not None:
+                queries.count += 1
+                queries.seconds += time.perf_counter() - start
+                queries.statements[sql] += 1
+
+    def execute(self, sql, *args):
+        return self._timed(self._db.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._timed(self._db.executemany, sql, *args)
+
+    def executescript(self, sql):
+        return self._timed(self._db.executescript, sql)
+
+
+def get_metrics(app=None):
+    app = app or current_app._get_current_object()
+    return app.extensions['flaskr.metrics']
+
+
+def start_timer():
+    g._request_start = time.perf_counter()
+    g._queries = RequestQueries()
+
+
+def record_request(response):
+    start = g.pop('_request_start', None)
+    if start is None:
+        return response
+
+    elapsed = time.perf_counter() - start
+    queries = g.pop('_queries')
+    endpoint = request.endpoint or 'unmatched'
+
+    # 同一条 SQL 在一个请求里执行了很多次，通常是在循环里逐条查询 (N+1)
+    if queries.statements:
+        sql, times = queries.statements.most_common(1)[0]
+        if times >= current_app.config['METRICS_N_PLUS_ONE_THRESHOLD']:
+            queries.repeated = sql
+            current_app.logger.warning(
+                'Possible N+1 queries in %s: %d executions of %r', endpoint, times, sql
+            )
+
+    get_metrics().record(endpoint, elapsed, queries)
+
+    if current_app.config['METRICS_SERVER_TIMING']:
+        # 浏览器开发者工具的 Timing 面板会显示这个头
+        response.headers.add(
+            'Server-Timing',
+            'app;dur={:.2f}, db;dur={:.2f};desc="{} queries"'.format(
+                elapsed * 1000, queries.seconds * 1000, queries.count
+            )
+        )
+
+    return response
+
+
+def _histogram_lines(name, label, histograms):
+    lines = []
+    for value, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(name, label, value, bound, cumulative))
+        lines.append('{}_sum{{{}="{}"}} {}'.format(name, label, value, histogram.sum))
+        lines.append('{}_count{{{}="{}"}} {}'.format(name, label, value, histogram.count))
+    return lines
+
+
+def _stats_lines(name, label, value, stats):
+    return [
+        '{}_{}{{{}="{}"}} {}'.format(name, key, label, value, number)
+        for key, number in sorted(stats.items())
+    ]
+
+
+def render_metrics():
+    metrics = get_metrics()
+
+    with metrics._lock:
+        lines = [
+            '# HELP flaskr_request_duration_seconds Time spent handling requests, by endpoint.',
+            '# TYPE flaskr_request_duration_seconds histogram',
+        ]
+        lines += _histogram_lines('flaskr_request_duration_seconds', 'endpoint', metrics.requests)
+        lines += [
+            '# HELP flaskr_db_query_duration_seconds Time spent in execute() per request, by endpoint.',
+            '# TYPE flaskr_db_query_duration_seconds histogram',
+        ]
+        lines += _histogram_lines('flaskr_db_query_duration_seconds', 'endpoint', metrics.queries)
+        lines += [
+            '# HELP flaskr_db_queries_total Statements executed, by endpoint.',
+            '# TYPE flaskr_db_queries_total counter',
+        ]
+        lines += ['flaskr_db_queries_total{{endpoint="{}"}} {}'.format(endpoint, count)
+                  for endpoint, count in sorted(metrics.query_counts.items())]
+        lines += [
+            '# HELP flaskr_n_plus_one_total Requests that repeated one statement at least METRICS_N_PLUS_ONE_THRESHOLD times.',
+            '# TYPE flaskr_n_plus_one_total counter',
+        ]
+        lines += ['flaskr_n_plus_one_total{{endpoint="{}"}} {}'.format(endpoint, count)
+                  for endpoint, count in sorted(metrics.n_plus_one.items())]
+
+    # 连接池、缓存、限流、写队列、session、压缩和密码哈希池自己的计数器，只导出已经创建了的
+    extensions = current_app.extensions
+    lines.append('# TYPE flaskr_db_pool gauge')
+    for pool, key in (('write', 'flaskr.db'), ('read', 'flaskr.db.read')):
+        if key in extensions:
+            lines += _stats_lines('flaskr_db_pool', 'pool', pool, extensions[key].stats())
+
+    lines.append('# TYPE flaskr_cache gauge')
+    for name, cache in sorted(extensions.get('flaskr.cache', {}).items()):
+        lines += _stats_lines('flaskr_cache', 'cache', name, cache.stats())
+
+    for name, key in (('ratelimit', 'flaskr.ratelimit'), ('admission', 'flaskr.admission'),
+                      ('write_queue', 'flaskr.writer'), ('sessions', 'flaskr.sessions'),
+                      ('compress', 'flaskr.compress')):
+        if key in extensions:
+            lines.append('# TYPE flaskr_{} gauge'.format(name))
+            lines += _stats_lines('flaskr_' + name, 'pool', 'default', extensions[key].stats())
+
+    if 'flaskr.hashing' in extensions:
+        lines.append('# TYPE flaskr_password_hash gauge')
+        lines += _stats_lines('flaskr_password_hash', 'pool', 'default', extensions['flaskr.hashing'].stats())
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    app.extensions['flaskr.metrics'] = Metrics()
+    # flaskr.db wraps every connection it hands out with this
+    app.extensions['flaskr.db.wrap'] = TimedConnection
+
+    app.before_request(start_timer)
+    app.after_request(record_request)
+    app.add_url_rule('/metrics', 'metrics', render_metrics)
@@ -0,0 +1,222 @@
+import sqlite3
+import threading
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.exceptions import InternalServerError
+
+from flaskr.db import get_read_db
+
+# auth 和 blog 用到的所有 SQL 都在这里，每条都有名字。SQL 字符串是固定的（分页的几种写法也在这里展开好），
+# 所以 sqlite3 的语句缓存（DB_CACHED_STATEMENTS）能命中，每条语句在每个连接上只编译一次。
+# Before the first request is served, every statement is run through EXPLAIN QUERY PLAN against the
+# real schema (QUERY_PLAN_CHECK). A statement that no longer compiles, or a hot query that has
+# degraded into a full table scan or a sort, fails requests with QueryPlanError instead of getting
+# slower as the table grows (see check_once for when it is checked again). `flask check-queries` prints the plans.
+
+# name -> SQL
+STATEMENTS = {}
+# names of the statements that may not scan a whole table or sort in a temp b-tree
+HOT = set()
+
+
+def statement(name, sql, hot=False):
+    STATEMENTS[name] = sql
+    if hot:
+        HOT.add(name)
+    return sql
+
+
+def page(name, sql):
+    # 游标分页（见 blog.fetch_page）用的三条语句。sql 的 WHERE 以 {cursor} 结尾，post 表的别名必须是 p。
+    # first: the newest posts; before: posts older than the cursor; after: posts newer than the cursor,
+    # in ascending order (fetch_page flips them). All of them walk post(created DESC, id DESC) or
+    # an index that ends with those columns, and end with LIMIT ?.
+    return {
+        'first': statement(name + '.first', sql.format(cursor='1')
+                           + ' ORDER BY p.created DESC, p.id DESC LIMIT ?', hot=True),
+        'before': statement(name + '.before', sql.format(cursor='(p.created, p.id) < (?, ?)')
+                            + ' ORDER BY p.created DESC, p.id DESC LIMIT ?', hot=True),
+        'after': statement(name + '.after', sql.format(cursor='(p.created, p.id) > (?, ?)')
+                           + ' ORDER BY p.created, p.id LIMIT ?', hot=True),
+    }
+
+
+# user
+USER_BY_ID = statement('user_by_id', 'SELECT * FROM user WHERE id = ?', hot=True)
+USER_BY_USERNAME = statement('user_by_username', 'SELECT * FROM user WHERE username = ?', hot=True)
+USER_EXISTS = statement('user_exists', 'SELECT id FROM user WHERE username = ?', hot=True)
+INSERT_USER = statement('insert_user', 'INSERT INTO user (username, password) VALUES (?, ?)')
+UPDATE_PASSWORD = statement('update_password', 'UPDATE user SET password = ? WHERE id = ?', hot=True)
+
+# post; author_username is the denormalized user.username (authors.sql)
+POST_COLUMNS = 'p.id, p.title, p.body, p.created, p.author_id, p.author_username AS username'
+
+POST_BY_ID = statement('post_by_id', 'SELECT ' + POST_COLUMNS + ' FROM post p WHERE p.id = ?', hot=True)
+INDEX_PAGE = page('index_page', 'SELECT ' + POST_COLUMNS + ' FROM post p WHERE {cursor}')
+AUTHOR_BY_USERNAME = statement(
+    'author_by_username',
+    'SELECT u.id, u.username, s.post_count, s.last_post_at'
+    ' FROM user u LEFT JOIN user_stats s ON s.user_id = u.id'
+    ' WHERE u.username = ?',
+    hot=True,
+)
+AUTHOR_PAGE = page('author_page', 'SELECT ' + POST_COLUMNS + ' FROM post p WHERE p.author_id = ? AND {cursor}')
+# 归档页本来就要读完所有文章，只要求按索引顺序读，不排序
+ARCHIVE = statement('archive', 'SELECT ' + POST_COLUMNS + ' FROM post p ORDER BY p.created DESC, p.id DESC', hot=True)
+# 搜索结果按 rank 排序，只排序匹配到的那些行，不算在热点查询里
+SEARCH = statement(
+    'search',
+    'SELECT p.id, p.title, p.created, p.author_id, p.author_username AS username, rank,'
+    " snippet(post_fts, -1, char(2), char(3), '…', 24) AS snippet"
+    ' FROM post_fts JOIN post p ON p.id = post_fts.rowid'
+    ' WHERE post_fts MATCH ? AND (rank, post_fts.rowid) > (?, ?)'
+    ' ORDER BY rank, post_fts.rowid LIMIT ?',
+)
+INSERT_POST = statement(
+    'insert_post', 'INSERT INTO post (title, body, author_id, author_username) VALUES (?, ?, ?, ?)'
+)
+UPDATE_POST = statement('update_post', 'UPDATE post SET title = ?, body = ? WHERE id = ?', hot=True)
+DELETE_POST = statement('delete_post', 'DELETE FROM post WHERE id = ?', hot=True)
+# generation.sql
+POSTS_GENERATION = statement('posts_generation', 'SELECT modified FROM posts_generation WHERE id = 1', hot=True)
+BUMP_POSTS_GENERATION = statement(
+    'bump_posts_generation',
+    "UPDATE posts_generation SET modified = max((julianday('now') - 2440587.5) * 86400.0, modified + 0.001)"
+    ' WHERE id = 1',
+)
+
+# the last migration applied by `flask db upgrade`, see flaskr.db.MIGRATIONS
+SCHEMA_VERSION = statement('schema_version', 'SELECT MAX(version) FROM schema_version')
+
+
+class QueryPlanError(InternalServerError):
+    # The details go to the log and the CLI, not to the error page.
+    description = 'The database schema does not match the queries; see the server log.'
+
+    def __init__(self, problems, retry=False):
+        super().__init__()
+        self.problems = problems
+        # retry: a statement didn't compile, because the schema is behind (an upgrade may be running
+        # right now) or the database was busy, so the same check can pass a moment later
+        self.retry = retry
+
+    def __str__(self):
+        return 'Query plan check failed:\n  ' + '\n  '.join(self.problems)
+
+
+def explain(db, sql):
+    # 参数都用 NULL 代替，EXPLAIN QUERY PLAN 只编译语句，不执行
+    return [row[3] for row in db.execute('EXPLAIN QUERY PLAN ' + sql, (None,) * sql.count('?'))]
+
+
+def plan_problems(name, plan):
+    problems = []
+
+    for detail in plan:
+        # "SCAN post" is a full table scan; "SCAN p USING INDEX ..." walks an index in order and
+        # "SCAN post_fts VIRTUAL TABLE ..." is the full-text index answering MATCH.
+        if detail.startswith('SCAN ') and 'USING' not in detail and 'VIRTUAL TABLE' not in detail:
+            problems.append('{}: full table scan ({})'.format(name, detail))
+        elif 'TEMP B-TREE' in detail:
+            problems.append('{}: sorts its results ({})'.format(name, detail))
+
+    return problems
+
+
+def check_queries(db):
+    # Returns {name: plan}; raises QueryPlanError listing every statement that doesn't compile and
+    # every hot statement with a full scan or a sort.
+    plans = {}
+    errors = []
+    problems = []
+
+    for name, sql in STATEMENTS.items():
+        try:
+            plans[name] = explain(db, sql)
+        except sqlite3.OperationalError as e:
+            # 一般是数据库还没有 `flask db upgrade`
+            errors.append('{}: {}'.format(name, e))
+            continue
+
+        if name in HOT:
+            problems += plan_problems(name, plans[name])
+
+    if errors or problems:
+        raise QueryPlanError(errors + problems, retry=bool(errors))
+
+    return plans
+
+
+_check_lock = threading.Lock()
+
+
+def check_once():
+    # before_request：检查通过以后，每个请求只是一次字典查找。
+    # A check that failed is not kept for good: a statement that didn't compile fails just this request
+    # and is checked again on the next one, and plan problems are kept together with the schema_version
+    # they were found at and checked again once `flask db upgrade` has moved it.
+    app = current_app._get_current_object()
+    checked = app.extensions.get('flaskr.queries')
+
+    if checked is None or checked[1]:
+        with _check_lock:
+            checked = app.extensions.get('flaskr.queries')
+            if checked is None or checked[1]:
+                checked = _check(app, checked)
+
+    if checked[1]:
+        raise QueryPlanError(checked[1])
+
+
+def _check(app, checked):
+    # Returns and stores (schema version, problems); raises QueryPlanError without storing anything
+    # when a statement doesn't compile.
+    db = get_read_db()
+    try:
+        version = db.execute(SCHEMA_VERSION).fetchone()[0]
+    except sqlite3.OperationalError as e:
+        app.logger.error('Query plan check failed: %s', e)
+        raise QueryPlanError(['schema_version: {}'.format(e)], retry=True)
+
+    if checked is not None and checked[0] == version:
+        return checked
+
+    try:
+        check_queries(db)
+        problems = []
+    except QueryPlanError as e:
+        app.logger.error('%s', e)
+        if e.retry:
+            raise
+        problems = e.problems
+
+    checked = app.extensions['flaskr.queries'] = (version, problems)
+    return checked
+
+
+@click.command('check-queries')
+@click.option('--verbose', '-v', is_flag=True, help='Print the plan of every statement.')
+@with_appcontext
+def check_queries_command(verbose):
+    """Check every named statement with EXPLAIN QUERY PLAN."""
+    try:
+        plans = check_queries(get_read_db())
+    except QueryPlanError as e:
+        raise click.ClickException(str(e))
+
+    if verbose:
+        for name, plan in plans.items():
+            click.echo(name)
+            for detail in plan:
+                click.echo('  ' + detail)
+
+    click.echo('{} statements checked.'.format(len(plans)))
+
+
+def init_app(app):
+    app.cli.add_command(check_queries_command)
+
+    if app.config['QUERY_PLAN_CHECK']:
+        app.before_request(check_once)
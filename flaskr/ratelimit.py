@@ -0,0 +1,222 @@
+import functools
+import threading
+import time
+
+from flask import current_app, g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from flaskr.cache import local_cache_client
+
+# 限流和准入控制，都在 create_app 里配置。
+# - 令牌桶 (token bucket)：每个 key（客户端 IP、登录用的用户名）一个桶，容量 N 个令牌，每 seconds/N 秒补一个，
+#   每个请求拿走一个，拿不到就返回 429。用 @limit('ip', 'username') 装饰 view，只限制 POST。
+#   The check runs before the view body, so a credential-stuffing burst is turned away before any
+#   password hash is computed.
+# - 并发上限：同时处理的请求超过 ADMISSION_MAX_REQUESTS 个时，新请求最多等 ADMISSION_TIMEOUT 秒，
+#   还等不到就返回 503，而不是让所有请求一起变慢。
+
+
+class MemoryStore(object):
+    # key -> [tokens, updated, capacity, rate]。每次更新都是一次字典查找，和 key 的数量无关。
+    # Buckets that have refilled completely carry no information, so a sweep every sweep_interval
+    # seconds drops them and memory stays proportional to the clients seen recently.
+
+    def __init__(self, sweep_interval=60.0):
+        self.sweep_interval = sweep_interval
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def consume(self, key, capacity, rate):
+        # Takes one token from the bucket; returns 0 if there was one, else the seconds until there is.
+        now = time.monotonic()
+
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [capacity, now, capacity, rate]
+
+            tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+
+            bucket[0] = tokens
+            return (1 - tokens) / rate
+
+    def _sweep(self, now):
+        # 调用方已经持有锁。已经补满的桶和新建的一样，删掉不影响结果
+        for key, (tokens, updated, capacity, rate) in list(self._buckets.items()):
+            if tokens + (now - updated) * rate >= capacity:
+                del self._buckets[key]
+        self._next_sweep = now + self.sweep_interval
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SharedStore(object):
+    # 桶放在 memcached 风格的共享缓存里（SHARED_CACHE_CLIENT，默认是 flaskr.cache.LocalCacheClient），
+    # 多个 worker 进程共用同一个限额。
+    # get + set is not atomic, so concurrent requests for the same key across workers may each get
+    # a token; a real deployment would use the server's cas/incr. Entries expire once they'd be full.
+
+    def __init__(self, client, prefix='ratelimit'):
+        self.client = client
+        self.prefix = prefix
+
+    def consume(self, key, capacity, rate):
+        now = time.time()
+        cache_key = '{}:{}'.format(self.prefix, key)
+
+        bucket = self.client.get(cache_key)
+        if bucket is None:
+            tokens = capacity
+        else:
+            tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) / rate
+
+        self.client.set(cache_key, (tokens, now), expire=int((capacity - tokens) / rate) + 1)
+        return wait
+
+
+class RateLimiter(object):
+    def __init__(self, store, rules):
+        # rules: scope name -> (requests, seconds)
+        self.store = store
+        self.rules = rules
+        self._lock = threading.Lock()
+
+        self.allowed = 0
+        self.limited = 0
+
+    def hit(self, scope, value):
+        # Returns the seconds to wait before retrying, 0 if the request may go ahead.
+        if scope not in self.rules:
+            raise ValueError('No rate limit configured for {!r}'.format(scope))
+
+        requests, seconds = self.rules[scope]
+        wait = self.store.consume('{}:{}'.format(scope, value), requests, requests / seconds)
+
+        with self._lock:
+            if wait:
+                self.limited += 1
+            else:
+                self.allowed += 1
+
+        return wait
+
+    def stats(self):
+        stats = {'allowed': self.allowed, 'limited': self.limited}
+        if isinstance(self.store, MemoryStore):
+            stats['buckets'] = len(self.store)
+        return stats
+
+
+class Admission(object):
+    # 限制同时处理的请求数。A request that can't get a slot within timeout seconds is shed with 503.
+
+    def __init__(self, max_requests, timeout):
+        self._slots = threading.BoundedSemaphore(max_requests)
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        self.shed = 0
+
+    def enter(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.shed += 1
+            raise ServiceUnavailable('The server is busy, please try again in a moment.', retry_after=1)
+
+        with self._lock:
+            self.in_flight += 1
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def stats(self):
+        return {'max_requests': self.max_requests, 'in_flight': self.in_flight, 'shed': self.shed}
+
+
+def get_limiter(app=None):
+    app = app or current_app._get_current_object()
+    return app.extensions['flaskr.ratelimit']
+
+
+# 每个 scope 从请求里取出限流用的 key
+SCOPES = {
+    'ip': lambda: request.remote_addr or 'unknown',
+    # 用户名统一成小写，换大小写不能绕过限制
+    'username': lambda: request.form.get('username', '').strip().lower() or None,
+}
+
+
+def limit(*scopes):
+    # View decorator: POST requests take a token from the bucket of every scope, in order, and get a
+    # 429 with Retry-After as soon as one is empty. GET requests (showing the form) aren't limited.
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(**kwargs):
+            limiter = current_app.extensions.get('flaskr.ratelimit')
+
+            if limiter is not None and request.method == 'POST':
+                for scope in scopes:
+                    value = SCOPES[scope]()
+                    if value is None:
+                        continue
+
+                    wait = limiter.hit(scope, value)
+                    if wait:
+                        raise TooManyRequests('Too many attempts, please try again later.',
+                                              retry_after=int(wait) + 1)
+
+            return view(**kwargs)
+
+        return wrapped_view
+
+    return decorator
+
+
+def admit():
+    current_app.extensions['flaskr.admission'].enter()
+    g._admitted = True
+
+
+def release(e=None):
+    # teardown_request 在请求结束时总会执行，包括 admit() 抛出 503 的请求，所以要看 g._admitted
+    if g.pop('_admitted', False):
+        current_app.extensions['flaskr.admission'].leave()
+
+
+def init_app(app):
+    if app.config['RATELIMIT_ENABLED']:
+        if app.config['RATELIMIT_STORAGE'] == 'memory':
+            store = MemoryStore(app.config['RATELIMIT_SWEEP_INTERVAL'])
+        elif app.config['RATELIMIT_STORAGE'] == 'shared':
+            store = SharedStore(app.config['SHARED_CACHE_CLIENT'] or local_cache_client)
+        else:
+            raise ValueError('Unknown RATELIMIT_STORAGE {!r}'.format(app.config['RATELIMIT_STORAGE']))
+
+        app.extensions['flaskr.ratelimit'] = RateLimiter(store, app.config['RATELIMITS'])
+
+    if app.config['ADMISSION_MAX_REQUESTS']:
+        app.extensions['flaskr.admission'] = Admission(
+            app.config['ADMISSION_MAX_REQUESTS'], app.config['ADMISSION_TIMEOUT']
+        )
+        app.before_request(admit)
+        app.teardown_request(release)
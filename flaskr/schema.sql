@@ -1,17 +1,27 @@
-DROP TABLE IF EXISTS user;
-DROP TABLE IF EXISTS post;
-
-CREATE TABLE user(
+-- 迁移 1（flaskr.db.MIGRATIONS）。已有的数据库上也会执行，所以只能用 IF NOT EXISTS，不能 DROP；
+-- init-db 先删掉所有的表再执行迁移。
+CREATE TABLE IF NOT EXISTS user(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   username TEXT UNIQUE NOT NULL,
   password TEXT NOT NULL
 );
 
-CREATE TABLE post(
+CREATE TABLE IF NOT EXISTS post(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   author_id INTEGER NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   title TEXT NOT NULL,
   body TEXT NOT NULL,
+  -- user.username 的副本，由 authors.sql 里的触发器维护，读文章的时候不用 JOIN user。
+  -- 在这之前建的数据库由迁移 3 加上这一列
+  author_username TEXT,
   FOREIGN KEY (author_id) REFERENCES USER(id)
-);
\ No newline at end of file
+);
+
+-- blog.index 按 (created, id) 倒序做游标分页，这个索引让每一页都是一次索引范围扫描，
+-- 不需要全表扫描再排序。id DESC 让并列的 created 也能直接按索引顺序读出。
+-- 按作者查文章用的 post(author_id, created DESC, id DESC) 在 authors.sql 里。
+CREATE INDEX IF NOT EXISTS post_created_id ON post(created DESC, id DESC);
+
+-- 全文搜索的 post_fts 表和同步用的触发器在 search.sql 里（迁移 2），作者名和 user_stats 的触发器在
+-- authors.sql 里（迁移 3）
@@ -0,0 +1,26 @@
+-- 全文搜索索引：FTS5 虚拟表，内容不重复存储，直接引用 post 表 (external content table)。
+-- 迁移 2 执行这个文件，rebuild-search-index 也会执行它，
+-- 所以这里只能用 IF NOT EXISTS，不能 DROP。
+CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(
+  title,
+  body,
+  content='post',
+  content_rowid='id'
+);
+
+-- 标题里的匹配比正文里的权重高
+INSERT INTO post_fts(post_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)');
+
+-- 用触发器保持索引和 post 表同步，blog.create / update / delete 不需要改动
+CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN
+  INSERT INTO post_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN
+  INSERT INTO post_fts(post_fts, rowid, title, body) VALUES ('delete', old.id, old.title, old.body);
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF title, body ON post BEGIN
+  INSERT INTO post_fts(post_fts, rowid, title, body) VALUES ('delete', old.id, old.title, old.body);
+  INSERT INTO post_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+END;
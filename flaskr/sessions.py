@@ -0,0 +1,195 @@
+import secrets
+import threading
+import time
+
+from flask.sessions import SecureCookieSession, SessionInterface, session_json_serializer
+
+from flaskr.cache import get_cache
+from flaskr.db import database_url, open_pool
+
+# 服务器端 session（SESSION_STORE，默认关闭）。Flask 默认把整个 session 序列化、签名以后放在 cookie 里，
+# 每个请求都要验证签名、反序列化，flash() 的消息也会让 cookie 越来越大。
+# With a store, the cookie only carries a random session id (32 characters, no signature: it is
+# unguessable and means nothing without the store) and the data stays on the server:
+#     SESSION_STORE='cache'    flaskr.cache.get_cache('session'): an LRU with TTL in each worker
+#                              (SESSION_CACHE_BACKEND='memory') or SHARED_CACHE_CLIENT ('shared')
+#     SESSION_STORE='sqlite'   a session table in the app's database, through its own small pool
+# The store is only written when the session changed, so most requests just read it. Logging out
+# deletes the entry, which logs that cookie out on every node sharing the store.
+# Entries expire PERMANENT_SESSION_LIFETIME after they were last changed.
+
+
+class ServerSession(SecureCookieSession):
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.rotate = False
+
+    def clear(self):
+        # auth.login 登录成功时先 clear()，这时换一个新的 id，防止 session fixation
+        super().clear()
+        self.rotate = True
+
+
+# Session data is stored as the same tagged JSON Flask's cookie sessions use (it round-trips the
+# tuples, bytes and Markup that flash() and friends put in a session). Never pickle: the stores can be
+# written by other processes, and unpickling what someone wrote there runs their code.
+serializer = session_json_serializer
+
+
+def _loads(data):
+    # 读不出来的（比如以前存的 pickle）当作没有 session，重新登录就好
+    try:
+        return serializer.loads(data)
+    except ValueError:
+        return None
+
+
+class CacheSessionStore(object):
+    # 存序列化之后的字符串：进程内的 LRUCache 存的是对象本身，请求里修改 session 不能改到缓存里的那份
+    def __init__(self, cache):
+        self.cache = cache
+
+    def load(self, sid):
+        data = self.cache.get(sid)
+        return _loads(data) if data is not None else None
+
+    def save(self, sid, data, ttl):
+        self.cache.set(sid, serializer.dumps(data), ttl=ttl)
+
+    def delete(self, sid):
+        self.cache.delete(sid)
+
+
+class SQLiteSessionStore(object):
+    # Keeps its own pool so saving a session never commits (or waits for) the request's connection;
+    # the SQL is kept here rather than in flaskr.queries because the table is created on first use.
+
+    def __init__(self, pool, sweep_interval=300.0):
+        self.pool = pool
+        self.sweep_interval = sweep_interval
+        self._next_sweep = 0
+        self._created = False
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        db = self.pool.checkout()
+        if not self._created:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS session'
+                ' (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL) WITHOUT ROWID'
+            )
+            db.commit()
+            self._created = True
+        return db
+
+    def load(self, sid):
+        db = self._connection()
+        try:
+            row = db.execute('SELECT data FROM session WHERE id = ? AND expires > ?', (sid, time.time())).fetchone()
+        finally:
+            db.close()
+        return _loads(row[0]) if row is not None else None
+
+    def save(self, sid, data, ttl):
+        now = time.time()
+        db = self._connection()
+        try:
+            db.execute('INSERT OR REPLACE INTO session (id, data, expires) VALUES (?, ?, ?)',
+                       (sid, serializer.dumps(data), now + ttl))
+
+            # 过期的 session 每隔 sweep_interval 秒顺便删一次
+            with self._lock:
+                sweep = now >= self._next_sweep
+                if sweep:
+                    self._next_sweep = now + self.sweep_interval
+            if sweep:
+                db.execute('DELETE FROM session WHERE expires <= ?', (now,))
+
+            db.commit()
+        finally:
+            db.close()
+
+    def delete(self, sid):
+        db = self._connection()
+        try:
+            db.execute('DELETE FROM session WHERE id = ?', (sid,))
+            db.commit()
+        finally:
+            db.close()
+
+
+class ServerSessionInterface(SessionInterface):
+    session_class = ServerSession
+
+    def __init__(self, store):
+        self.store = store
+        self.loads = 0
+        self.saves = 0
+        self.deletes = 0
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+
+        if sid and len(sid) == 32:
+            data = self.store.load(sid)
+            self.loads += 1
+            if data is not None:
+                return self.session_class(data, sid)
+
+        return self.session_class()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            # 登出：删掉服务器上的数据，这个 cookie 在所有节点上都立刻失效
+            if session.modified:
+                if session.sid is not None:
+                    self.store.delete(session.sid)
+                    self.deletes += 1
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # 没改过的 session 不写存储，也不重新发 cookie
+        if session.modified:
+            if session.sid is None or session.rotate:
+                if session.sid is not None:
+                    self.store.delete(session.sid)
+                session.sid = secrets.token_urlsafe(24)
+
+            self.store.save(session.sid, dict(session), int(app.permanent_session_lifetime.total_seconds()))
+            self.saves += 1
+        elif not self.should_set_cookie(app, session):
+            return
+
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def stats(self):
+        return {'loads': self.loads, 'saves': self.saves, 'deletes': self.deletes}
+
+
+def init_app(app):
+    if app.config['SESSION_STORE'] == 'cache':
+        store = CacheSessionStore(get_cache('session', app))
+    elif app.config['SESSION_STORE'] == 'sqlite':
+        store = SQLiteSessionStore(open_pool(app, database_url(app), size=app.config['SESSION_POOL_SIZE']))
+        app.extensions['flaskr.sessions.pool'] = store.pool
+    else:
+        raise ValueError('Unknown SESSION_STORE {!r}'.format(app.config['SESSION_STORE']))
+
+    app.session_interface = app.extensions['flaskr.sessions'] = ServerSessionInterface(store)
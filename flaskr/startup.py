@@ -0,0 +1,137 @@
+import json
+import os
+import sys
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
+
+# 冷启动分析：autoscaler 在高峰期启动新的 worker，从进程启动到能处理第一个请求的时间越短越好。
+# `flask startup-profile` starts a fresh interpreter (this process has already imported everything),
+# imports flask and flaskr, calls create_app() and sends the first two requests to /, timing every
+# step. create_app() records its own phases in app.extensions['flaskr.startup'].
+#
+#     flask startup-profile                    # one line per phase, in milliseconds
+#     flask startup-profile --budget 500       # exits with 1 if the first response takes longer
+#
+# 模板的字节码缓存：Jinja 第一次用到一个模板的时候要解析、编译成 Python 代码，每个 worker 都要做一遍。
+# With TEMPLATE_BYTECODE_CACHE the compiled code is stored under TEMPLATE_CACHE_DIR (instance/jinja-cache
+# by default) and later workers load it instead; `flask precompile-templates` fills it at deploy time.
+
+# Runs in the fresh interpreter; prints the phases as JSON. argv[1] is the database to use.
+PROBE = '''
+import json, sys, time
+phases = []
+started = time.perf_counter()
+import flask
+phases.append(('import flask', time.perf_counter() - started))
+mark = time.perf_counter()
+import flaskr
+phases.append(('import flaskr', time.perf_counter() - mark))
+app = flaskr.create_app()
+app.config['DATABASE'] = sys.argv[1]
+phases += [('create_app: ' + name, seconds) for name, seconds in app.extensions['flaskr.startup']]
+mark = time.perf_counter()
+names = app.jinja_env.list_templates()
+for name in names:
+    app.jinja_env.get_template(name)
+cache = app.jinja_env.bytecode_cache
+phases.append(('load {} templates ({} from cache)'.format(len(names), cache.hits if cache else 0),
+               time.perf_counter() - mark))
+client = app.test_client()
+mark = time.perf_counter()
+status = client.get('/').status_code
+phases.append(('first request', time.perf_counter() - mark))
+ready = time.perf_counter() - started
+mark = time.perf_counter()
+client.get('/')
+phases.append(('second request', time.perf_counter() - mark))
+from flaskr.db import close_pools
+close_pools(app)
+print(json.dumps({'phases': phases, 'time_to_first_request': ready, 'status': status}))
+'''
+
+
+def profile(database):
+    # 子进程的工作目录和当前进程一样，所以用的是同一个 instance 文件夹和 config.py。
+    # subprocess is imported here so create_app() doesn't pay for it.
+    import subprocess
+
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE, database], capture_output=True, text=True, check=False
+    )
+    if result.returncode != 0:
+        raise click.ClickException('The startup probe failed:\n' + result.stderr)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+@click.command('startup-profile')
+@click.option('--budget', type=float, help='Fail if the first response takes longer than this many milliseconds.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the report as JSON.')
+@with_appcontext
+def startup_profile_command(budget, as_json):
+    """Time the imports, create_app() and the first request in a fresh process."""
+    report = profile(current_app.config['DATABASE'])
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        for name, seconds in report['phases']:
+            click.echo('{:<36} {:8.1f} ms'.format(name, seconds * 1000))
+        click.echo('{:<36} {:8.1f} ms'.format('time to first request', report['time_to_first_request'] * 1000))
+
+    if report['status'] >= 400:
+        raise click.ClickException('The first request answered {}.'.format(report['status']))
+    if budget is not None and report['time_to_first_request'] * 1000 > budget:
+        raise click.ClickException('Time to first request is over the budget of {:g} ms.'.format(budget))
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    # 记录命中次数，startup-profile 用
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.hits = 0
+        self.misses = 0
+
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+        if bucket.code is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+
+@click.command('precompile-templates')
+@click.option('--verbose', '-v', is_flag=True, help='Print the compile time of every template.')
+@with_appcontext
+def precompile_templates_command(verbose):
+    """Compile every template into the bytecode cache."""
+    env = current_app.jinja_env
+    if env.bytecode_cache is None:
+        raise click.ClickException('TEMPLATE_BYTECODE_CACHE is off, there is nowhere to store the templates.')
+
+    # 先清空，保证每个模板都真正编译一遍，而不是从旧的缓存里读出来
+    env.bytecode_cache.clear()
+    started = time.perf_counter()
+    names = env.list_templates()
+
+    for name in names:
+        mark = time.perf_counter()
+        env.get_template(name)
+        if verbose:
+            click.echo('{:<36} {:8.1f} ms'.format(name, (time.perf_counter() - mark) * 1000))
+
+    click.echo('Compiled {} templates in {:.1f} ms.'.format(len(names), (time.perf_counter() - started) * 1000))
+
+
+def init_app(app):
+    app.cli.add_command(startup_profile_command)
+    app.cli.add_command(precompile_templates_command)
+
+    if app.config['TEMPLATE_BYTECODE_CACHE']:
+        directory = app.config['TEMPLATE_CACHE_DIR'] or os.path.join(app.instance_path, 'jinja-cache')
+        os.makedirs(directory, exist_ok=True)
+        # jinja_env 在第一次用到的时候才用 jinja_options 创建，这里设置还来得及
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=TemplateBytecodeCache(directory))
@@ -0,0 +1,220 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+
+from flaskr.db import ConnectionPool, database_url, open_pool
+
+# 后台写队列（默认关闭，WRITE_QUEUE_ENABLED）。每个 create / update / delete 单独 commit 的话，写得多的时候
+# SQLite 要一个一个排队，每次 commit 都要落盘一次。打开以后这些写操作交给一个专门的写线程：
+# it collects whatever arrives within WRITE_QUEUE_MAX_DELAY seconds (at most WRITE_QUEUE_BATCH_SIZE
+# operations) and commits them as one transaction, a "group commit". Each operation runs inside its
+# own SAVEPOINT, so one failing statement only fails its own future.
+# With WRITE_QUEUE_WAIT the view waits for its future, i.e. until its write is committed; without it
+# the view returns right away and the write lands a few milliseconds later (relaxed mode).
+# Whatever goes wrong on the writer thread is logged on flaskr.writer and never stops the thread.
+
+logger = logging.getLogger(__name__)
+
+
+class WriteTimeout(ServiceUnavailable):
+    description = 'The write queue is too busy, please try again.'
+
+
+_STOP = object()
+
+
+class WriteQueue(object):
+    def __init__(self, database, pragmas=None, batch_size=64, max_delay=0.005, after_commit=None, pool=None):
+        # after_commit() is called on the writer thread after every batch that changed something.
+        # pool: a connection pool of size 1 for another backend (see flaskr.db.open_pool) instead of the file.
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.after_commit = after_commit
+        # 写线程自己的连接，不占用 get_db() 的连接池，view 等待写入的时候不会和写线程抢连接
+        self._pool = pool or ConnectionPool(database, size=1, pragmas=pragmas)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.operations = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.batches = 0
+        self.max_batch = 0
+
+    def submit(self, statements):
+        # statements: [(sql, params), ...] that belong together. Returns a Future whose result is
+        # the lastrowid of the last statement once the batch holding it has been committed.
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='flaskr-writer', daemon=True)
+                self._thread.start()
+
+        future = Future()
+        self._queue.put((statements, future))
+        return future
+
+    def _run(self):
+        db = self._pool.checkout()
+
+        try:
+            while True:
+                batch = [self._queue.get()]
+                if batch[0] is _STOP:
+                    return
+
+                # 第一个操作到了以后最多再等 max_delay 秒，把这段时间里来的操作凑成一批
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    try:
+                        item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    batch.append(item)
+                    if item is _STOP:
+                        break
+
+                stop = batch[-1] is _STOP
+                if stop:
+                    batch.pop()
+
+                self._commit(db, batch)
+
+                if stop:
+                    return
+        finally:
+            db.close()
+
+    def _commit(self, db, batch):
+        # 等不及的 view 已经取消了自己的 future (see wait)，这些操作不再执行；剩下的从这里开始不能再取消
+        queued = len(batch)
+        batch = [(statements, future) for statements, future in batch if future.set_running_or_notify_cancel()]
+        if len(batch) < queued:
+            with self._lock:
+                self.cancelled += queued - len(batch)
+        if not batch:
+            return
+
+        results = []
+
+        try:
+            # 整批一个事务；BEGIN IMMEDIATE 一开始就拿到写锁，不会执行到一半才发现数据库被锁住
+            db.execute('BEGIN IMMEDIATE')
+            for statements, future in batch:
+                db.execute('SAVEPOINT operation')
+                try:
+                    cursor = None
+                    for sql, params in statements:
+                        cursor = db.execute(sql, params)
+                except Exception as e:
+                    # 不只是 sqlite3.Error：参数不对会抛 TypeError / ValueError，同样只让这一个操作失败
+                    db.execute('ROLLBACK TO operation')
+                    db.execute('RELEASE operation')
+                    results.append((future, e, None))
+                else:
+                    db.execute('RELEASE operation')
+                    results.append((future, None, cursor.lastrowid if cursor is not None else None))
+
+            db.commit()
+        except Exception as e:
+            # BEGIN 或 commit 失败，这一批都没有写进去
+            logger.error('Write queue batch of %d operations failed', len(batch), exc_info=True)
+            try:
+                db.rollback()
+            except Exception:
+                logger.exception('Write queue rollback failed')
+            results = [(future, e, None) for _, future in batch]
+
+        failed = sum(1 for _, error, _ in results if error is not None)
+        with self._lock:
+            self.batches += 1
+            self.operations += len(batch)
+            self.failed += failed
+            self.max_batch = max(self.max_batch, len(batch))
+
+        if self.after_commit is not None and failed < len(batch):
+            try:
+                self.after_commit()
+            except Exception:
+                # the batch is committed either way; a failing hook must not take the writer thread down
+                logger.exception('Write queue after_commit failed')
+
+        for future, error, result in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'operations': self.operations,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+            'batches': self.batches,
+            'max_batch': self.max_batch,
+        }
+
+    def close(self):
+        # 先把已经排队的写完再退出
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+        self._pool.close()
+
+
+_queue_lock = threading.Lock()
+
+
+def get_write_queue(app=None):
+    # None when WRITE_QUEUE_ENABLED is off; the views then write through get_db() as before.
+    app = app or current_app._get_current_object()
+    if not app.config['WRITE_QUEUE_ENABLED']:
+        return None
+
+    write_queue = app.extensions.get('flaskr.writer')
+
+    if write_queue is None:
+        with _queue_lock:
+            write_queue = app.extensions.get('flaskr.writer')
+            if write_queue is None:
+                # 页面缓存的 posts generation 由数据库里的触发器更新，提交以后不用再做什么
+                write_queue = app.extensions['flaskr.writer'] = WriteQueue(
+                    app.config['DATABASE'],
+                    batch_size=app.config['WRITE_QUEUE_BATCH_SIZE'],
+                    max_delay=app.config['WRITE_QUEUE_MAX_DELAY'],
+                    pool=open_pool(app, database_url(app), size=1),
+                )
+
+    return write_queue
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error('Queued write failed', exc_info=future.exception())
+
+
+def wait(future):
+    # In WRITE_QUEUE_WAIT mode, block until the write is committed; errors from the write are raised here.
+    # In relaxed mode nobody waits for the result, so a failed write is logged instead.
+    if not current_app.config['WRITE_QUEUE_WAIT']:
+        future.add_done_callback(_log_failure)
+        return None
+
+    # After DB_POOL_TIMEOUT seconds a write that is still queued is cancelled, so the 503 really means
+    # "nothing was written, try again". One the writer has already started can't be taken back;
+    # its batch is being committed, so wait for that instead of inviting a duplicate.
+    try:
+        return future.result(timeout=current_app.config['DB_POOL_TIMEOUT'])
+    except TimeoutError:
+        if future.cancel():
+            raise WriteTimeout()
+        return future.result()
@@ -5,7 +5,8 @@ print(find_packages())
 setup(
     name='flaskr',
     version='1.0.0',
-    packages=find_packages(),
+    # benchmarks/ is a development tool, not part of the flaskr package
+    packages=find_packages(exclude=('benchmarks',)),
     include_package_data=True,
     zip_safe=False,
     install_requires=[
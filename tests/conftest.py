@@ -3,7 +3,7 @@ import tempfile
 
 import pytest
 from flaskr import create_app
-from flaskr.db import get_db,init_db
+from flaskr.db import close_pools,get_db,init_db
 
 with open(os.path.join(os.path.dirname(__file__),'data.sql'),'rb') as f:
     _data_sql=f.read().decode('utf8')
@@ -14,6 +14,8 @@ def app():
     app=create_app({
         'TESTING':True,
         'DATABASE':db_path,
+        # same method as the hashes in data.sql, so logging in doesn't rehash them
+        'PASSWORD_HASH_METHOD':'pbkdf2:sha256:50000',
 
     })
 
@@ -23,8 +25,12 @@ def app():
 
     yield app
 
+    # close the pooled connections so SQLite removes the -wal/-shm files
+    close_pools(app)
     os.close(db_fd)
     os.unlink(db_path)
+    # left by `flask db upgrade` (init_db), see flaskr.db.UpgradeLock
+    os.unlink(db_path+'-upgrade.lock')
 
 @pytest.fixture
 def client(app):
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+from flaskr.asgi import ASGIAdapter, build_environ
+from flaskr.db import get_db
+
+
+def call(adapter,method,path,body=b'',headers=(),query_string=b''):
+    scope={
+        'type':'http','method':method,'path':path,'query_string':query_string,
+        'headers':list(headers),'http_version':'1.1','scheme':'http',
+        'server':('testserver',80),'client':('127.0.0.1',12345),
+    }
+    # body may be a list of chunks, sent without a Content-Length as with chunked encoding
+    chunks=body if isinstance(body,list) else [body]
+    incoming=[{'type':'http.request','body':chunk,'more_body':i<len(chunks)-1} for i,chunk in enumerate(chunks)]
+    sent=[]
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(adapter(scope,receive,send))
+    start=sent[0]
+    headers={name.decode():value.decode() for name,value in start['headers']}
+    chunks=[message['body'] for message in sent[1:]]
+    assert sent[-1]['more_body'] is False
+    return start['status'],headers,chunks
+
+
+@pytest.fixture
+def adapter(app):
+    adapter=ASGIAdapter(app,workers=2)
+    yield adapter
+    adapter.executor.shutdown()
+
+
+def test_get(adapter):
+    status,headers,chunks=call(adapter,'GET','/')
+    assert status==200
+    assert b'test title' in b''.join(chunks)
+
+
+def test_login_session(adapter):
+    status,headers,chunks=call(
+        adapter,'POST','/auth/login',
+        body=b'username=test&password=test',
+        headers=[(b'content-type',b'application/x-www-form-urlencoded')],
+    )
+    assert status==302
+    cookie=headers['set-cookie'].split(';',1)[0]
+
+    status,headers,chunks=call(adapter,'GET','/',headers=[(b'cookie',cookie.encode())])
+    assert b'Log Out' in b''.join(chunks)
+
+
+def test_streaming(app,adapter):
+    app.config['ARCHIVE_BATCH_SIZE']=1
+    status,headers,chunks=call(adapter,'GET','/archive')
+    assert status==200
+    assert b'test title' in b''.join(chunks)
+
+
+def test_streaming_across_threads(app):
+    # every chunk may be read on a different pool thread; the app context must follow the request
+    with app.app_context():
+        db=get_db()
+        db.executemany('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',
+                       [('post %d'%i,'body') for i in range(400)])
+        db.commit()
+    app.config['ARCHIVE_BATCH_SIZE']=10
+    adapter=ASGIAdapter(app,workers=8)
+    try:
+        for _ in range(3):
+            status,headers,chunks=call(adapter,'GET','/archive')
+            body=b''.join(chunks)
+            assert status==200 and len(chunks)>2
+            assert b'post 399' in body and b'test title' in body
+    finally:
+        adapter.executor.shutdown()
+
+
+def test_body_too_large(app):
+    adapter=ASGIAdapter(app,workers=1,max_body=10)
+
+    def wsgi_app(environ,start_response):
+        raise AssertionError('the app must not see the request')
+
+    adapter.app=wsgi_app
+    status,headers,chunks=call(adapter,'POST','/auth/login',body=b'x'*11,headers=[(b'content-length',b'11')])
+    assert status==413
+    # no Content-Length: the limit is checked while the body arrives
+    status,headers,chunks=call(adapter,'POST','/auth/login',body=[b'x'*6,b'x'*6])
+    assert status==413
+    adapter.executor.shutdown()
+
+
+def test_build_environ():
+    environ=build_environ({
+        'type':'http','method':'GET','path':'/café','query_string':b'q=1',
+        'headers':[(b'cookie',b'a=1'),(b'cookie',b'b=2'),(b'content-type',b'text/plain')],
+    },None)
+    assert environ['PATH_INFO']=='/cafÃ©'
+    assert environ['QUERY_STRING']=='q=1'
+    assert environ['HTTP_COOKIE']=='a=1; b=2'
+    assert environ['CONTENT_TYPE']=='text/plain'
+
+
+def test_lifespan(app):
+    adapter=ASGIAdapter(app,workers=1)
+    incoming=[{'type':'lifespan.startup'},{'type':'lifespan.shutdown'}]
+    sent=[]
+
+    async def receive():
+        return incoming.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(adapter({'type':'lifespan'},receive,send))
+    assert sent==['lifespan.startup.complete','lifespan.shutdown.complete']
@@ -0,0 +1,59 @@
+import gzip
+import json
+import os
+
+import pytest
+from flask import url_for
+from flaskr.assets import get_assets, hashed_name
+
+
+@pytest.fixture
+def built(app,runner,tmp_path):
+    app.config['ASSETS_DIR']=str(tmp_path)
+    get_assets(app).directory=str(tmp_path)
+    result=runner.invoke(args=['build-assets'])
+    assert 'Built 1 assets' in result.output
+    with open(os.path.join(app.static_folder,'style.css'),'rb') as f:
+        return hashed_name('style.css',f.read())
+
+
+def test_manifest(app,built,tmp_path):
+    with open(tmp_path/'manifest.json') as f:
+        manifest=json.load(f)
+    assert manifest['files']=={'style.css':built}
+    assert 'gzip' in manifest['encodings'][built]
+
+    with open(tmp_path/(built+'.gz'),'rb') as f:
+        compressed=f.read()
+    with open(tmp_path/built,'rb') as f:
+        assert gzip.decompress(compressed)==f.read()
+
+
+def test_url_for(app,client,built):
+    with app.test_request_context():
+        assert url_for('static',filename='style.css')=='/static/'+built
+    assert ('/static/'+built).encode() in client.get('/').data
+
+
+def test_immutable(client,built):
+    response=client.get('/static/'+built)
+    assert response.status_code==200
+    assert response.mimetype=='text/css'
+    assert response.cache_control.immutable and response.cache_control.max_age==31536000
+    assert response.content_encoding is None
+    assert 'Accept-Encoding' in response.vary
+
+
+def test_precompressed(client,built):
+    response=client.get('/static/'+built,headers={'Accept-Encoding':'gzip, deflate'})
+    assert response.content_encoding=='gzip'
+    assert response.mimetype=='text/css'
+    assert b'body' in gzip.decompress(response.data)
+
+
+def test_unbuilt(app,client):
+    # without a manifest the original files are served as before
+    with app.test_request_context():
+        assert url_for('static',filename='style.css')=='/static/style.css'
+    response=client.get('/static/style.css')
+    assert response.status_code==200 and not response.cache_control.immutable
@@ -1,6 +1,8 @@
 import pytest
 from flask import g,session
-from flask.db import get_db
+from flaskr.auth import invalidate_user
+from flaskr.cache import get_cache
+from flaskr.db import get_db
 
 def test_register(client,app):
     assert client.get('/auth/register').status_code==200
@@ -55,3 +57,42 @@ def test_logout(client,auth):
         assert 'user_id' not in session
         
 
+
+
+def test_user_loaded_lazily(client,auth):
+    auth.login()
+
+    with client:
+        client.get('/hello')
+        # /hello never reads g.user, so the user was never looked up
+        assert 'user' not in g.__dict__
+        assert g.user['username']=='test'
+        assert g.get('user')['id']==1
+
+
+def test_user_cache(app,client,auth):
+    auth.login()
+    client.get('/')
+    client.get('/')
+
+    with app.app_context():
+        cache=get_cache('user')
+        assert cache.stats()['misses']==1
+        assert cache.stats()['hits']==1
+
+        get_db().execute("UPDATE user SET username='renamed' WHERE id=1")
+        get_db().commit()
+        invalidate_user(1)
+
+    assert b'renamed' in client.get('/').data
+
+
+def test_user_cache_shared_backend(app,client,auth):
+    app.config['USER_CACHE_BACKEND']='shared'
+    auth.login()
+    client.get('/')
+
+    with app.app_context():
+        assert get_cache('user').get(1)['username']=='test'
+        invalidate_user(1)
+        assert get_cache('user').get(1) is None
@@ -0,0 +1,29 @@
+import json
+
+from benchmarks import bench
+
+
+def test_bench_smoke(tmp_path):
+    output=tmp_path/'bench.json'
+    status=bench.main([
+        '--users','2','--posts','50','--requests','4','--concurrency','2',
+        '--hash-method','pbkdf2:sha256:1000','--output',str(output),
+    ])
+    assert status==0
+
+    report=json.loads(output.read_text())
+    for driver in ('testclient','wsgi'):
+        for name in bench.SCENARIOS:
+            result=report['results'][driver][name]
+            assert result['errors']==0
+            assert result['p50_ms']<=result['p95_ms']<=result['p99_ms']
+    assert report['peak_rss_kb']>0
+
+
+def test_compare():
+    def report(rps,p95):
+        return {'results':{'wsgi':{'index':{'throughput_rps':rps,'p95_ms':p95}}}}
+
+    assert bench.compare(report(95,10.5),report(100,10),0.1)['regressions']==[]
+    assert bench.compare(report(80,10),report(100,10),0.1)['regressions']==['wsgi/index']
+    assert bench.compare(report(100,12),report(100,10),0.1)['regressions']==['wsgi/index']
@@ -1,5 +1,8 @@
 import pytest
-from flaskr.db import get_db
+from flask import g
+from flaskr.cache import get_cache
+from flaskr import create_app
+from flaskr.db import close_pools, get_db, get_pool
 
 def test_index(client,auth):
     response=client.get('/')
@@ -69,6 +72,20 @@ def test_update(client,auth,app):
         post=db.execute('SELECT * FROM post WHERE id = 1').fetchone()
         assert post['title']=='updated'
 
+
+def test_writer_released_after_commit(app,client,auth):
+    auth.login()
+
+    with client:
+        # the update form only reads, so it never takes the writer
+        client.get('/1/update')
+        assert 'db' not in g
+
+        # a write gives the writer back as soon as it has committed, before the redirect
+        assert client.post('/1/update',data={'title':'updated','body':''}).status_code==302
+        assert 'db' not in g
+        assert get_pool().stats()['idle']==1
+
 @pytest.mark.parametrize('path',(
     '/create',
     '/1/update',
@@ -93,3 +110,231 @@ def test_delet(client,auth,app):
 
 
 
+
+def test_index_pagination(app,client):
+    app.config['POSTS_PER_PAGE']=2
+    with app.app_context():
+        db=get_db()
+        db.executemany(
+            'INSERT INTO post (title,body,author_id,created) VALUES (?,?,1,?)',
+            [('post %d'%i,'','2018-01-0%d 00:00:00'%i) for i in range(2,6)]
+        )
+        db.commit()
+
+    # newest first: post 5, post 4
+    response=client.get('/')
+    assert b'post 5' in response.data and b'post 4' in response.data
+    assert b'post 3' not in response.data
+    assert b'Newer' not in response.data
+    assert b'before=2018-01-04+00:00:00_4' in response.data
+
+    response=client.get('/?before=2018-01-04 00:00:00_4')
+    assert b'post 3' in response.data and b'post 2' in response.data
+    assert b'post 4' not in response.data
+    assert b'after=2018-01-03+00:00:00_3' in response.data
+
+    # the last page only holds the fixture post and has no Older link
+    response=client.get('/?before=2018-01-02 00:00:00_2')
+    assert b'test title' in response.data
+    assert b'Older' not in response.data
+
+    response=client.get('/?after=2018-01-03 00:00:00_3')
+    assert b'post 5' in response.data and b'post 4' in response.data
+    assert b'Newer' not in response.data
+
+
+@pytest.mark.parametrize('cursor',('nonsense','2018-01-01_\u00b2','2018-01-01_'+'9'*30))
+def test_index_invalid_cursor(client,cursor):
+    assert client.get('/',query_string={'before':cursor}).status_code==400
+    assert client.get('/search',query_string={'q':'test','after':cursor.replace('2018-01-01','1.5')}).status_code==400
+
+
+def test_index_page_cache(app,client,auth):
+    assert b'test title' in client.get('/').data
+
+    # a change that bypasses the views still starts a new generation (generation.sql)
+    with app.app_context():
+        db=get_db()
+        db.execute("UPDATE post SET title='changed' WHERE id=1")
+        db.commit()
+    assert b'changed' in client.get('/').data
+
+    auth.login()
+    client.post('/create',data={'title':'created','body':''})
+    auth.logout()
+    response=client.get('/')
+    assert b'changed' in response.data
+    assert b'created' in response.data
+
+
+def test_index_not_modified(client,auth):
+    response=client.get('/')
+    etag=response.headers['ETag']
+    assert response.headers['Vary']=='Cookie'
+
+    response=client.get('/',headers={'If-None-Match':etag})
+    assert response.status_code==304
+    assert response.data==b''
+
+    # a logged-in user gets a different page and a different ETag
+    auth.login()
+    response=client.get('/',headers={'If-None-Match':etag})
+    assert response.status_code==200
+    assert response.headers['ETag']!=etag
+
+    client.post('/1/update',data={'title':'updated','body':''})
+    response=client.get('/',headers={'If-None-Match':response.headers['ETag']})
+    assert response.status_code==200
+    assert b'updated' in response.data
+
+
+def test_generation_shared_by_workers(app,client):
+    # two apps on the same database stand in for two worker processes, each with its own page cache
+    etag=client.get('/').headers['ETag']
+    worker=create_app({'TESTING':True,'DATABASE':app.config['DATABASE']})
+    with worker.app_context():
+        db=get_db()
+        db.execute("INSERT INTO post (title,body,author_id) VALUES ('elsewhere','',1)")
+        db.commit()
+    close_pools(worker)
+
+    response=client.get('/',headers={'If-None-Match':etag})
+    assert response.status_code==200 and b'elsewhere' in response.data
+
+
+def test_post_fragment_cache(app,client,auth):
+    auth.login()
+    client.get('/')
+    client.get('/')
+
+    with app.app_context():
+        stats=get_cache('fragment').stats()
+        assert stats['misses']==1
+        assert stats['hits']==1
+
+
+def test_archive(app,client):
+    app.config['ARCHIVE_BATCH_SIZE']=2
+    with app.app_context():
+        db=get_db()
+        db.executemany(
+            'INSERT INTO post (title,body,author_id,created) VALUES (?,?,1,?)',
+            [('post %d'%i,'','2018-01-0%d 00:00:00'%i) for i in range(2,6)]
+        )
+        db.commit()
+
+    response=client.get('/archive')
+    assert response.is_streamed
+    data=response.get_data()
+    titles=[b'post 5',b'post 4',b'post 3',b'post 2',b'test title']
+    positions=[data.index(title) for title in titles]
+    assert positions==sorted(positions)
+
+    # the read connection is returned once the stream has been consumed
+    assert get_pool(app,readonly=True).stats()['idle']==1
+
+
+def test_search(client):
+    response=client.get('/search?q=body')
+    assert b'test title' in response.data
+    assert b'<mark>body</mark>' in response.data
+
+    assert b'No posts match' in client.get('/search?q=missing').data
+    # FTS5 syntax in the query is searched for literally instead of raising an error
+    assert client.get('/search?q=%22body+-+OR').status_code==200
+
+
+def test_search_escapes_snippet(app,client):
+    with app.app_context():
+        db=get_db()
+        db.execute("INSERT INTO post (title,body,author_id) VALUES ('x','<script>evil</script>',1)")
+        db.commit()
+
+    response=client.get('/search?q=evil')
+    assert b'&lt;script&gt;<mark>evil</mark>' in response.data
+
+
+def test_search_pagination(app,client):
+    app.config['POSTS_PER_PAGE']=2
+    with app.app_context():
+        db=get_db()
+        db.executemany(
+            'INSERT INTO post (title,body,author_id) VALUES (?,?,1)',
+            [('post %d'%i,'needle '*i) for i in range(1,6)]
+        )
+        db.commit()
+
+    seen=[]
+    url='/search?q=needle'
+    while url:
+        data=client.get(url).get_data(as_text=True)
+        seen+=[line.strip() for line in data.splitlines() if line.strip().startswith('<h1>post')]
+        url=None
+        if 'More results' in data:
+            url=data.split('<div class="pagination">')[1].split('href="')[1].split('"')[0].replace('&amp;','&')
+
+    # every match exactly once, most relevant (most occurrences) first
+    assert seen==['<h1>post %d</h1>'%i for i in (5,4,3,2,1)]
+
+
+def test_search_index_follows_writes(client,auth):
+    auth.login()
+    client.post('/1/update',data={'title':'renamed','body':'fresh words'})
+    assert b'renamed' in client.get('/search?q=fresh').data
+    assert b'renamed' not in client.get('/search?q=body').data
+
+    client.post('/1/delete')
+    assert b'No posts match' in client.get('/search?q=fresh').data
+
+
+def test_detail(client,auth):
+    response=client.get('/1')
+    assert b'test title' in response.data
+    assert b'href="/author/test"' in response.data
+    assert b'href="/1/update"' not in response.data
+
+    response=client.get('/1',headers={'If-None-Match':response.headers['ETag']})
+    assert response.status_code==304
+
+    auth.login()
+    assert b'href="/1/update"' in client.get('/1').data
+    assert client.get('/2').status_code==404
+
+
+def test_author(app,client):
+    app.config['POSTS_PER_PAGE']=2
+    with app.app_context():
+        db=get_db()
+        db.executemany(
+            'INSERT INTO post (title,body,author_id,created) VALUES (?,?,?,?)',
+            [('post %d'%i,'',1 if i%2 else 2,'2018-01-0%d 00:00:00'%i) for i in range(2,8)]
+        )
+        db.commit()
+
+    # user 1 wrote posts 7, 5, 3 and the fixture post
+    response=client.get('/author/test')
+    assert b'Posts by test' in response.data
+    assert b'4 posts' in response.data
+    assert b'post 7' in response.data and b'post 5' in response.data
+    assert b'post 6' not in response.data
+    assert b'href="/author/test?before=2018-01-05+00:00:00_5"' in response.data
+
+    response=client.get('/author/test?before=2018-01-05 00:00:00_5')
+    assert b'post 3' in response.data and b'test title' in response.data
+    assert b'post 4' not in response.data
+    assert b'Older' not in response.data
+
+    response=client.get('/author/test',headers={'If-None-Match':client.get('/author/test').headers['ETag']})
+    assert response.status_code==304
+
+    assert client.get('/author/nobody').status_code==404
+
+
+def test_author_query_uses_index(app):
+    with app.app_context():
+        plan=' '.join(row['detail'] for row in get_db().execute(
+            'EXPLAIN QUERY PLAN SELECT p.id,title FROM post p WHERE p.author_id=? AND (p.created, p.id) < (?, ?)'
+            ' ORDER BY p.created DESC, p.id DESC LIMIT 20',(1,'2019-01-01',1)
+        ))
+        assert 'post_author_created' in plan
+        assert 'TEMP B-TREE' not in plan
@@ -0,0 +1,50 @@
+import time
+
+import pytest
+from flaskr.cache import LocalCacheClient, LRUCache, SharedCache, get_cache
+
+
+def test_lru_eviction():
+    cache=LRUCache(maxsize=2)
+    cache.set('a',1)
+    cache.set('b',2)
+    assert cache.get('a')==1
+    # 'b' is now the least recently used entry
+    cache.set('c',3)
+    assert cache.get('b') is None
+    assert cache.get('a')==1 and cache.get('c')==3
+    assert cache.stats()['evictions']==1
+
+
+def test_lru_ttl(monkeypatch):
+    now=[100.0]
+    monkeypatch.setattr(time,'monotonic',lambda:now[0])
+    cache=LRUCache(ttl=10)
+    cache.set('a',1)
+    assert cache.get('a')==1
+
+    now[0]+=11
+    assert cache.get('a','missing')=='missing'
+    assert len(cache)==0
+
+
+def test_shared_cache():
+    client=LocalCacheClient()
+    first=SharedCache(client,'user')
+    second=SharedCache(client,'user')
+
+    value={'id':1}
+    first.set(1,value)
+    # values are serialized, not shared by reference
+    assert second.get(1)==value and second.get(1) is not value
+
+    second.delete(1)
+    assert first.get(1) is None
+    assert first.stats()=={'hits':0,'misses':1}
+
+
+def test_get_cache_unknown_backend(app):
+    app.config['USER_CACHE_BACKEND']='nope'
+    with app.app_context():
+        with pytest.raises(ValueError):
+            get_cache('user')
@@ -0,0 +1,87 @@
+import gzip
+import zlib
+
+from flaskr import create_app
+from flaskr.compress import brotli
+from flaskr.db import get_db
+
+
+def add_posts(app,count):
+    with app.app_context():
+        db=get_db()
+        db.executemany('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',
+                       [('post %d'%i,'body '*50) for i in range(count)])
+        db.commit()
+
+
+def test_gzip(app,client):
+    add_posts(app,20)
+    response=client.get('/',headers={'Accept-Encoding':'gzip, deflate'})
+    assert response.content_encoding=='gzip'
+    assert 'Accept-Encoding' in response.vary and 'Cookie' in response.vary
+    html=gzip.decompress(response.data)
+    assert b'post 19' in html
+    assert len(response.data)<len(html)//3
+    assert app.extensions['flaskr.compress'].stats()['compressed']==1
+
+
+def test_deflate(app,client):
+    add_posts(app,20)
+    response=client.get('/',headers={'Accept-Encoding':'deflate'})
+    assert response.content_encoding=='deflate'
+    assert b'post 19' in zlib.decompress(response.data)
+
+
+def test_brotli(app,client):
+    add_posts(app,20)
+    response=client.get('/',headers={'Accept-Encoding':'br'})
+    if brotli is None:
+        assert response.content_encoding is None
+    else:
+        assert response.content_encoding=='br'
+        assert b'post 19' in brotli.decompress(response.data)
+
+
+def test_skipped(client):
+    # no Accept-Encoding, a body below COMPRESS_MIN_SIZE, a HEAD request
+    assert client.get('/').content_encoding is None
+    assert client.get('/hello',headers={'Accept-Encoding':'gzip'}).content_encoding is None
+    response=client.head('/',headers={'Accept-Encoding':'gzip'})
+    assert response.content_encoding is None
+
+
+def test_streamed(app,client):
+    add_posts(app,300)
+    app.config['ARCHIVE_BATCH_SIZE']=50
+    response=client.get('/archive',headers={'Accept-Encoding':'gzip'},buffered=False)
+    assert response.content_encoding=='gzip' and 'Content-Length' not in response.headers
+    # every chunk is flushed as it comes instead of being buffered to the end
+    chunks=list(response.response)
+    assert len(chunks)>2
+    decompressor=zlib.decompressobj(31)
+    assert b'post 299' in decompressor.decompress(chunks[0]+chunks[1])
+    response.close()
+
+
+def test_etag(app,client):
+    add_posts(app,20)
+    response=client.get('/',headers={'Accept-Encoding':'gzip'})
+    etag=response.headers['ETag']
+    assert etag.startswith('W/')
+    response=client.get('/',headers={'Accept-Encoding':'gzip','If-None-Match':etag})
+    assert response.status_code==304
+
+
+def test_level(app):
+    sizes=[]
+    add_posts(app,20)
+    for level in (1,9):
+        level_app=create_app({'TESTING':True,'DATABASE':app.config['DATABASE'],'COMPRESS_LEVEL':level})
+        sizes.append(len(level_app.test_client().get('/',headers={'Accept-Encoding':'gzip'}).data))
+    assert sizes[1]<=sizes[0]
+
+
+def test_disabled(app):
+    plain_app=create_app({'TESTING':True,'DATABASE':app.config['DATABASE'],'COMPRESS_ENABLED':False})
+    assert 'flaskr.compress' not in plain_app.extensions
+    assert plain_app.test_client().get('/',headers={'Accept-Encoding':'gzip'}).content_encoding is None
@@ -1,7 +1,13 @@
 import sqlite3
+import threading
+import time
 
 import pytest
-from flaskr.db import get_db
+from flaskr import create_app
+from flaskr.db import (
+    MIGRATIONS, PoolTimeout, UpgradeLock, UpgradeLocked, check_authors, close_db, close_pools, get_db, get_pool,
+    get_read_db, import_records, init_db, upgrade, upgrade_lock_path,
+)
 
 def test_get_close_db(app):
     with app.app_context():
@@ -28,3 +34,478 @@ def test_init_db_command(runner,monkeypatch):
     assert 'Initialized' in result.output
     assert Recorder.called
 
+
+def test_pool_reuses_connection(app):
+    with app.app_context():
+        first=get_db()._conn
+
+    with app.app_context():
+        assert get_db()._conn is first
+
+    stats=get_pool(app).stats()
+    assert stats['open']==1
+    assert stats['hits']>=1
+
+
+def test_pool_recycles_connection(app):
+    app.config['DB_POOL_MAX_USES']=1
+    app.extensions.pop('flaskr.db').close()
+
+    with app.app_context():
+        first=get_db()._conn
+
+    with app.app_context():
+        assert get_db()._conn is not first
+
+    assert get_pool(app).stats()['recycled']>=1
+
+
+def test_pool_discards_connection_on_error(app):
+    with app.app_context():
+        db=get_db()
+        first=db._conn
+        close_db(Exception())
+
+    with app.app_context():
+        assert get_db()._conn is not first
+
+
+def test_pool_rolls_back_uncommitted(app):
+    with app.app_context():
+        get_db().execute('DELETE FROM post')
+
+    with app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM post').fetchone()[0]==1
+
+
+def test_pool_timeout(app):
+    app.config['DB_POOL_SIZE']=1
+    app.config['DB_POOL_TIMEOUT']=0.01
+    app.extensions.pop('flaskr.db').close()
+    pool=get_pool(app)
+
+    held=pool.checkout()
+    with pytest.raises(PoolTimeout):
+        pool.checkout()
+
+    held.close()
+    pool.checkout().close()
+    assert pool.stats()['timeouts']==1
+
+
+def test_pool_wakes_waiter_on_discard(app):
+    app.config['DB_POOL_SIZE']=1
+    app.config['DB_POOL_MAX_USES']=1
+    app.config['DB_POOL_TIMEOUT']=2
+    app.extensions.pop('flaskr.db').close()
+    pool=get_pool(app)
+
+    held=pool.checkout()
+    result=[]
+    waiter=threading.Thread(target=lambda:result.append(pool.checkout()))
+    waiter.start()
+    time.sleep(0.1)
+    # max_uses=1: the connection is closed, not returned, and the waiter opens a new one
+    started=time.monotonic()
+    held.close()
+    waiter.join()
+    assert time.monotonic()-started<1
+    assert result[0]._conn is not None and pool.stats()['open']==1
+    result[0].close()
+    stats=pool.stats()
+    assert stats['open']==0 and stats['idle']==0 and stats['timeouts']==0
+
+
+def test_pragmas(app):
+    with app.app_context():
+        db=get_db()
+        assert db.execute('PRAGMA journal_mode').fetchone()[0]=='wal'
+        assert db.execute('PRAGMA synchronous').fetchone()[0]==1
+        assert db.execute('PRAGMA busy_timeout').fetchone()[0]==5000
+
+
+def test_init_db_sets_journal_mode(app):
+    conn=sqlite3.connect(app.config['DATABASE'])
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0]=='wal'
+    conn.close()
+
+
+def test_read_db_is_read_only(app):
+    with app.app_context():
+        db=get_read_db()
+        assert db.execute('SELECT COUNT(*) FROM post').fetchone()[0]==1
+
+        with pytest.raises(sqlite3.OperationalError):
+            db.execute('DELETE FROM post')
+
+
+def test_read_db_reads_own_writes(app):
+    with app.app_context():
+        db=get_db()
+        db.execute('DELETE FROM post')
+        # once the request holds the writer, reads see its uncommitted changes
+        assert get_read_db() is db
+        assert get_read_db().execute('SELECT COUNT(*) FROM post').fetchone()[0]==0
+
+
+def test_read_db_released(app):
+    with app.app_context():
+        db=get_read_db()
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.execute('SELECT 1')
+
+    assert get_pool(app,readonly=True).stats()['idle']==1
+
+
+def test_rebuild_search_index_command(app,runner):
+    with app.app_context():
+        db=get_db()
+        db.executescript('DROP TABLE post_fts; DROP TRIGGER post_fts_insert;')
+        db.execute("INSERT INTO post (title,body,author_id) VALUES ('second','needle',1)")
+        db.commit()
+
+    result=runner.invoke(args=['rebuild-search-index'])
+    assert 'Indexed 2 posts.' in result.output
+
+    with app.app_context():
+        db=get_db()
+        assert db.execute("SELECT rowid FROM post_fts WHERE post_fts MATCH 'needle'").fetchone()[0]==2
+        # the triggers are back as well
+        db.execute("INSERT INTO post (title,body,author_id) VALUES ('third','needle',1)")
+        assert len(db.execute("SELECT rowid FROM post_fts WHERE post_fts MATCH 'needle'").fetchall())==2
+        db.commit()
+
+    # rebuilding a live index, triggers and all, leaves it consistent
+    assert 'Indexed 3 posts.' in runner.invoke(args=['rebuild-search-index']).output
+    with app.app_context():
+        get_db().execute("INSERT INTO post_fts(post_fts) VALUES ('integrity-check')")
+
+
+@pytest.mark.parametrize('filename',('dump.ndjson','dump.csv'))
+def test_export_import_posts(app,runner,tmp_path,filename):
+    path=str(tmp_path/filename)
+    with app.app_context():
+        db=get_db()
+        db.execute("INSERT INTO post (title,body,author_id) VALUES ('second','line one\r\nline two',2)")
+        db.commit()
+
+    result=runner.invoke(args=['export-posts',path])
+    assert result.exit_code==0
+
+    with app.app_context():
+        init_db()
+
+    result=runner.invoke(args=['import-posts',path,'--batch-size','2','--defer-indexes'])
+    assert 'Imported 2 users and 2 posts.' in result.output
+
+    with app.app_context():
+        db=get_db()
+        # passwords are imported as they are, without rehashing
+        assert db.execute("SELECT password FROM user WHERE username='test'").fetchone()[0].startswith('pbkdf2:sha256:50000$')
+        post=db.execute('SELECT * FROM post WHERE id=2').fetchone()
+        assert post['body']=='line one\r\nline two'
+        # indexes, triggers and the search index are back
+        names=[row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE tbl_name='post'")]
+        assert 'post_created_id' in names and 'post_fts_insert' in names
+        assert db.execute("SELECT rowid FROM post_fts WHERE post_fts MATCH 'two'").fetchone()[0]==2
+
+    # importing the same file again doesn't duplicate anything
+    result=runner.invoke(args=['import-posts',path])
+    assert 'Imported 0 users and 0 posts.' in result.output
+
+
+def test_import_resumes(app,tmp_path):
+    path=str(tmp_path/'dump.ndjson')
+    records=[
+        {'type':'post','id':10+i,'author_id':1,'created':'2019-01-01 00:00:00','title':'t%d'%i,'body':''}
+        for i in range(5)
+    ]
+
+    def interrupted():
+        for i,record in enumerate(records):
+            if i==3:
+                raise KeyboardInterrupt
+            yield record
+
+    with app.app_context():
+        with pytest.raises(KeyboardInterrupt):
+            import_records(interrupted(),source=path,batch_size=2,defer_indexes=True)
+        # the first batch was committed together with its checkpoint
+        assert get_db().execute('SELECT position FROM import_checkpoint').fetchone()[0]==2
+
+    with app.app_context():
+        # records 1-2 are skipped, 3-5 are written, and the indexes dropped by the first run are restored
+        assert import_records(iter(records),source=path,batch_size=2)==(0,3)
+        assert get_db().execute('SELECT COUNT(*) FROM post').fetchone()[0]==6
+        assert get_db().execute("SELECT COUNT(*) FROM sqlite_master WHERE name='import_deferred'").fetchone()[0]==0
+
+
+def test_author_triggers(app):
+    with app.app_context():
+        db=get_db()
+        assert db.execute('SELECT author_username FROM post WHERE id=1').fetchone()[0]=='test'
+        stats=db.execute('SELECT post_count,last_post_at FROM user_stats WHERE user_id=1').fetchone()
+        assert stats[0]==1 and str(stats[1])=='2018-01-01 00:00:00'
+
+        db.execute("INSERT INTO post (title,body,author_id,created) VALUES ('b','',1,'2019-01-01 00:00:00')")
+        db.execute("UPDATE user SET username='renamed' WHERE id=1")
+        assert [row[0] for row in db.execute('SELECT author_username FROM post')]==['renamed','renamed']
+        assert db.execute('SELECT post_count FROM user_stats WHERE user_id=1').fetchone()[0]==2
+
+        db.execute('DELETE FROM post WHERE id=2')
+        stats=db.execute('SELECT post_count,last_post_at FROM user_stats WHERE user_id=1').fetchone()
+        assert stats[0]==1 and str(stats[1])=='2018-01-01 00:00:00'
+
+        db.execute('UPDATE post SET author_id=2 WHERE id=1')
+        assert db.execute('SELECT author_username FROM post WHERE id=1').fetchone()[0]=='other'
+        assert [tuple(row) for row in db.execute('SELECT user_id,post_count FROM user_stats ORDER BY user_id')]==[(1,0),(2,1)]
+
+
+def test_migrate_authors_command(app,runner):
+    with app.app_context():
+        db=get_db()
+        # the schema before author_username and user_stats existed
+        for name in ('post_author_insert','post_author_update','user_rename',
+                     'user_stats_insert','user_stats_delete','user_stats_move'):
+            db.execute('DROP TRIGGER %s'%name)
+        db.executescript('DROP TABLE user_stats; ALTER TABLE post DROP COLUMN author_username;')
+        db.execute("INSERT INTO post (title,body,author_id) VALUES ('second','',2)")
+        db.commit()
+
+    result=runner.invoke(args=['migrate-authors','--batch-size','1'])
+    assert 'Updated 2 posts.' in result.output
+
+    result=runner.invoke(args=['check-authors'])
+    assert result.exit_code==0
+    assert 'consistent' in result.output
+
+    with app.app_context():
+        db=get_db()
+        assert [row[0] for row in db.execute('SELECT author_username FROM post ORDER BY id')]==['test','other']
+        assert db.execute('SELECT post_count FROM user_stats WHERE user_id=2').fetchone()[0]==1
+
+
+def test_check_authors_command(app,runner):
+    with app.app_context():
+        db=get_db()
+        db.execute("UPDATE post SET author_username='stale'")
+        db.execute('UPDATE user_stats SET post_count=5')
+        db.commit()
+
+    result=runner.invoke(args=['check-authors'])
+    assert result.exit_code==1
+    assert '1 posts and 1 user_stats rows are out of sync' in result.output
+
+    result=runner.invoke(args=['check-authors','--fix'])
+    assert 'Fixed 1 posts and 1 user_stats rows.' in result.output
+
+    with app.app_context():
+        assert check_authors()==(0,0)
+
+
+def test_db_status(runner):
+    result=runner.invoke(args=['db','status'])
+    assert result.exit_code==0
+    assert result.output.count('applied')==len(MIGRATIONS)
+
+    result=runner.invoke(args=['db','upgrade'])
+    assert 'Already up to date.' in result.output
+
+
+# the schema as it was before migrations: no schema_version, post_fts, author_username or user_stats
+LEGACY_SCHEMA='''
+CREATE TABLE user (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, password TEXT NOT NULL);
+CREATE TABLE post (id INTEGER PRIMARY KEY AUTOINCREMENT, author_id INTEGER NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, title TEXT NOT NULL, body TEXT NOT NULL);
+INSERT INTO user (username, password) VALUES ('old', 'x');
+INSERT INTO post (title, body, author_id) VALUES ('first', 'needle', 1), ('second', 'haystack', 1), ('third', '', 1);
+'''
+
+
+def test_upgrade_legacy_database(tmp_path):
+    path=str(tmp_path/'legacy.sqlite')
+    conn=sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+
+    app=create_app({'TESTING':True,'DATABASE':path})
+    runner=app.test_cli_runner()
+
+    result=runner.invoke(args=['db','status'])
+    assert result.exit_code==1 and '4 migrations pending' in result.output
+
+    result=runner.invoke(args=['db','upgrade','--to','2','--batch-size','1'])
+    assert 'Upgraded to version 2.' in result.output
+    assert runner.invoke(args=['db','status']).exit_code==1
+
+    result=runner.invoke(args=['db','upgrade','--batch-size','1'])
+    assert 'Upgraded to version 4.' in result.output
+    assert runner.invoke(args=['db','status']).exit_code==0
+
+    with app.app_context():
+        db=get_db()
+        # the existing posts were backfilled and kept
+        assert db.execute("SELECT rowid FROM post_fts WHERE post_fts MATCH 'needle'").fetchone()[0]==1
+        assert [row[0] for row in db.execute('SELECT author_username FROM post')]==['old']*3
+        assert db.execute('SELECT post_count FROM user_stats WHERE user_id=1').fetchone()[0]==3
+        assert check_authors()==(0,0)
+    assert b'first' in app.test_client().get('/').data
+    close_pools(app)
+
+
+def test_upgrade_is_rerunnable(app):
+    # a migration interrupted after its changes but before schema_version was written runs again
+    with app.app_context():
+        db=get_db()
+        db.execute('DELETE FROM schema_version WHERE version > 1')
+        db.commit()
+        assert upgrade(batch_size=1)==[2,3,4]
+        assert db.execute('SELECT COUNT(*) FROM post').fetchone()[0]==1
+        assert db.execute("SELECT rowid FROM post_fts WHERE post_fts MATCH 'test'").fetchone()[0]==1
+        assert check_authors()==(0,0)
+
+
+def test_upgrade_resumes_search_backfill(tmp_path):
+    # killed after the first batch of an old, batched backfill: post_fts and its triggers exist,
+    # but only some posts are in the index and migration 2 is not recorded
+    path=str(tmp_path/'legacy.sqlite')
+    conn=sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',[('post %d'%i,'needle') for i in range(27)])
+    conn.commit()
+    conn.close()
+
+    app=create_app({'TESTING':True,'DATABASE':path})
+    with app.app_context():
+        assert upgrade(target=1)==[1]
+        db=get_db()
+        with app.open_resource('search.sql') as f:
+            db.executescript(f.read().decode('utf8'))
+        db.execute("INSERT INTO post_fts(rowid,title,body) SELECT id,title,body FROM post WHERE id<=10")
+        db.commit()
+
+        assert upgrade()==[2,3,4]
+        assert len(db.execute("SELECT rowid FROM post_fts WHERE post_fts MATCH 'needle'").fetchall())==28
+        db.execute("INSERT INTO post_fts(post_fts) VALUES ('integrity-check')")
+    close_pools(app)
+
+
+def test_upgrade_beside_writes(tmp_path):
+    path=str(tmp_path/'legacy.sqlite')
+    conn=sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=wal')
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',[('post %d'%i,'body') for i in range(2000)])
+    conn.commit()
+    conn.close()
+
+    app=create_app({'TESTING':True,'DATABASE':path})
+    stop=threading.Event()
+
+    def write():
+        # the app keeps creating and editing posts while the search index is built
+        conn=sqlite3.connect(path,timeout=30)
+        while not stop.is_set():
+            conn.execute("INSERT INTO post (title,body,author_id) VALUES ('during','needle',1)")
+            conn.execute("UPDATE post SET body='needle' WHERE id=(SELECT MAX(id) FROM post)-1000")
+            conn.commit()
+            time.sleep(0.001)
+        conn.close()
+
+    writer=threading.Thread(target=write)
+    writer.start()
+    try:
+        with app.app_context():
+            upgrade(batch_size=100)
+    finally:
+        stop.set()
+        writer.join()
+
+    with app.app_context():
+        db=get_db()
+        assert db.execute("SELECT COUNT(*) FROM post WHERE title='during'").fetchone()[0]>0
+        db.execute("INSERT INTO post_fts(post_fts) VALUES ('integrity-check')")
+        expected=db.execute("SELECT COUNT(*) FROM post WHERE body='needle'").fetchone()[0]
+        assert len(db.execute("SELECT rowid FROM post_fts WHERE post_fts MATCH 'needle'").fetchall())==expected
+    close_pools(app)
+
+
+def test_upgrade_lock(app):
+    with app.app_context():
+        db=get_db()
+        db.execute('DELETE FROM schema_version WHERE version=4')
+        db.commit()
+
+        # another node is upgrading: wait for it, then give up
+        other=UpgradeLock(upgrade_lock_path(app))
+        other.acquire()
+        with pytest.raises(UpgradeLocked):
+            upgrade(wait=0.1)
+
+        # the other node finished (or died, which drops the lock as well)
+        other.release()
+        assert upgrade()==[4]
+
+
+def test_upgrade_lock_held_through_long_steps(app,monkeypatch):
+    # a step that holds SQLite's write lock for a long time (a big CREATE INDEX, the FTS rebuild)
+    started=threading.Event()
+    finish=threading.Event()
+
+    def slow(db,batch_size,pause):
+        db.execute('BEGIN IMMEDIATE')
+        started.set()
+        finish.wait(5)
+        db.commit()
+
+    monkeypatch.setattr('flaskr.db.MIGRATIONS',MIGRATIONS[:-1]+[(4,'slow',slow)])
+    with app.app_context():
+        db=get_db()
+        db.execute('DELETE FROM schema_version WHERE version=4')
+        db.commit()
+    results=[]
+
+    def run():
+        with app.app_context():
+            results.append(upgrade())
+
+    thread=threading.Thread(target=run)
+    thread.start()
+    started.wait(5)
+    # a second node neither steals the lock nor runs migration 4 again
+    node=create_app({'TESTING':True,'DATABASE':app.config['DATABASE']})
+    try:
+        with node.app_context():
+            with pytest.raises(UpgradeLocked):
+                upgrade(wait=0.5)
+    finally:
+        finish.set()
+        thread.join()
+        close_pools(node)
+    assert results==[[4]]
+
+
+def test_concurrent_upgrades(tmp_path):
+    path=str(tmp_path/'legacy.sqlite')
+    conn=sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+
+    # two nodes run `flask db upgrade` at the same time
+    nodes=[create_app({'TESTING':True,'DATABASE':path}) for _ in range(2)]
+    results=[]
+
+    def run(node):
+        with node.app_context():
+            results.append(upgrade(batch_size=1))
+
+    threads=[threading.Thread(target=run,args=(node,)) for node in nodes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results)==[[],[1,2,3,4]]
+    for node in nodes:
+        close_pools(node)
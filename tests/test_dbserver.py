@@ -0,0 +1,179 @@
+import sqlite3
+import threading
+
+import pytest
+from flask import session
+from flaskr import create_app
+from flaskr.db import (
+    WROTE_AT, close_pools, get_db, get_pool, get_read_db, init_db, mark_written, reads_own_writes
+)
+from flaskr.dbclient import RemoteConnection, RemotePool
+from flaskr.dbserver import DatabaseServer
+
+
+@pytest.fixture
+def serve(app):
+    # starts stand-in servers on the test database, stops them after the test
+    servers=[]
+
+    def serve(readonly=False):
+        server=DatabaseServer(app.config['DATABASE'],readonly=readonly)
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+        servers.append(server)
+        return server.url
+
+    yield serve
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def remote_app(app,serve):
+    remote_app=create_app({
+        'TESTING':True,
+        'DATABASE':app.config['DATABASE'],
+        'DATABASE_URL':serve(),
+        'PASSWORD_HASH_METHOD':'pbkdf2:sha256:50000',
+    })
+    yield remote_app
+    close_pools(remote_app)
+
+
+def test_remote_connection(remote_app):
+    with remote_app.app_context():
+        assert isinstance(get_pool(),RemotePool)
+        db=get_db()
+        row=db.execute('SELECT * FROM post WHERE id = ?',(1,)).fetchone()
+        assert row['title']=='test title' and row[0]==1
+        assert dict(row)['author_id']==1
+        # TIMESTAMP columns come back as datetime, as they do locally
+        assert row['created'].year==2018
+
+        with pytest.raises(sqlite3.IntegrityError):
+            db.execute('INSERT INTO user (username, password) VALUES (?, ?)',('test','x'))
+
+        cursor=db.execute('INSERT INTO user (username, password) VALUES (?, ?)',('remote','x'))
+        assert cursor.lastrowid==3 and db.in_transaction
+        db.rollback()
+        assert db.execute('SELECT COUNT(*) FROM user').fetchone()[0]==2
+
+
+def test_remote_cursor_streams(remote_app):
+    with remote_app.app_context():
+        db=get_db()
+        db.executemany('INSERT INTO post (title, body, author_id) VALUES (?, ?, 1)',
+                       [('post %d'%i,'') for i in range(1200)])
+        db.commit()
+        cursor=db.execute('SELECT id FROM post ORDER BY id')
+        assert len(cursor.fetchmany(700))==700
+        assert len(cursor.fetchall())==501
+        assert len(list(db.execute('SELECT id FROM post')))==1201
+
+
+def test_remote_app(remote_app):
+    client=remote_app.test_client()
+    assert b'test title' in client.get('/').data
+    client.post('/auth/login',data={'username':'test','password':'test'})
+    client.post('/create',data={'title':'over the wire','body':''})
+    assert b'over the wire' in client.get('/').data
+    assert b'over the wire' in client.get('/2').data
+
+
+def test_remote_init_db(app,serve):
+    remote_app=create_app({'TESTING':True,'DATABASE_URL':serve()})
+    with remote_app.app_context():
+        init_db()
+        assert get_read_db().execute('SELECT COUNT(*) FROM post').fetchone()[0]==0
+    close_pools(remote_app)
+
+
+def test_read_only_replica(app,serve):
+    replica_app=create_app({'TESTING':True,'DATABASE':app.config['DATABASE'],
+                            'DATABASE_REPLICA_URLS':[serve(readonly=True)]})
+    with replica_app.test_request_context():
+        with pytest.raises(sqlite3.OperationalError):
+            get_read_db().execute('DELETE FROM post')
+    close_pools(replica_app)
+
+
+def test_read_your_writes(app,serve):
+    replica_app=create_app({'TESTING':True,'DATABASE_URL':serve(),
+                            'DATABASE_REPLICA_URLS':[serve(readonly=True),serve(readonly=True)]})
+
+    with replica_app.test_request_context():
+        get_read_db()
+        assert not reads_own_writes()
+    # reads go to the replicas in turn and never open a primary connection
+    with replica_app.test_request_context():
+        get_read_db()
+    assert get_pool(replica_app,readonly=True).stats()['open']==1
+    assert replica_app.extensions['flaskr.db.read'].stats()['replicas']==2
+    assert 'flaskr.db' not in replica_app.extensions
+
+    with replica_app.test_request_context():
+        # taking the writer without committing anything leaves the session alone
+        get_db()
+        assert WROTE_AT not in session
+        mark_written()
+        assert session[WROTE_AT]
+        wrote_at=session[WROTE_AT]
+
+    # the next request of the same user reads from the primary
+    with replica_app.test_request_context():
+        session[WROTE_AT]=wrote_at
+        assert reads_own_writes()
+        get_read_db()
+    assert get_pool(replica_app).stats()['hits']==1
+
+    with replica_app.test_request_context():
+        session[WROTE_AT]=wrote_at-replica_app.config['DB_READ_YOUR_WRITES']
+        assert not reads_own_writes()
+
+    close_pools(replica_app)
+
+
+def test_wrote_at_set_on_commit(app,serve):
+    replica_app=create_app({'TESTING':True,'DATABASE':app.config['DATABASE'],
+                            'DATABASE_REPLICA_URLS':[serve(readonly=True)],
+                            'PASSWORD_HASH_METHOD':'pbkdf2:sha256:50000'})
+    client=replica_app.test_client()
+    client.post('/auth/login',data={'username':'test','password':'test'})
+
+    with client:
+        client.get('/1/update')
+        assert WROTE_AT not in session
+        client.post('/1/update',data={'title':'updated','body':''})
+        assert session[WROTE_AT]
+
+    close_pools(replica_app)
+
+
+def test_secret_required(serve):
+    url=serve()
+    assert url.startswith('flaskrdb://:') and '@127.0.0.1:' in url
+    port=int(url.rsplit(':',1)[1])
+    with pytest.raises(sqlite3.OperationalError,match='Authentication failed'):
+        RemoteConnection('127.0.0.1',port,secret='guess')
+
+
+def test_attach_and_pragmas_refused(remote_app,tmp_path):
+    with remote_app.app_context():
+        db=get_db()
+        for sql in ("ATTACH '{}' AS other".format(tmp_path/'other.sqlite'),
+                    "VACUUM INTO '{}'".format(tmp_path/'copy.sqlite'),
+                    'PRAGMA journal_mode=DELETE','PRAGMA writable_schema=ON'):
+            with pytest.raises(sqlite3.DatabaseError,match='not authorized|authorization denied'):
+                db.execute(sql)
+        with pytest.raises(sqlite3.DatabaseError):
+            db.executescript("ATTACH '{}' AS other".format(tmp_path/'other.sqlite'))
+        assert db.execute('PRAGMA table_info(post)').fetchall()
+    assert not list(tmp_path.iterdir())
+
+
+def test_unknown_backend():
+    app=create_app({'TESTING':True,'DATABASE_URL':'postgres://localhost/flaskr'})
+    with app.app_context():
+        with pytest.raises(ValueError):
+            get_pool()
@@ -0,0 +1,83 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from flaskr.db import close_pools, get_db
+from flaskr.hashing import HashPool, HashQueueFull
+from werkzeug.security import check_password_hash
+
+
+def test_hash_and_check():
+    pool=HashPool('pbkdf2:sha256:1000',workers=1)
+    pwhash=pool.hash('secret')
+    assert pwhash.startswith('pbkdf2:sha256:1000$')
+    assert pool.check(pwhash,'secret')
+    assert not pool.check(pwhash,'wrong')
+    assert pool.stats()['hashes']==3
+    pool.close()
+
+
+def test_full_queue_rejected():
+    pool=HashPool('pbkdf2:sha256:1000',workers=1,queue_depth=0)
+    started=threading.Event()
+    release=threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    thread=threading.Thread(target=pool.run,args=(block,))
+    thread.start()
+    started.wait()
+
+    with pytest.raises(HashQueueFull) as e:
+        pool.hash('secret')
+    assert e.value.code==503
+
+    release.set()
+    thread.join()
+    assert pool.stats()['rejected']==1
+    # the slot is free again
+    assert pool.hash('secret')
+    pool.close()
+
+
+def test_needs_rehash():
+    pool=HashPool('pbkdf2:sha256:1000',workers=1)
+    assert not pool.needs_rehash(pool.hash('secret'))
+    assert pool.needs_rehash('pbkdf2:sha256:50000$salt$hash')
+    pool.close()
+
+
+def test_rehash_on_login(app,client,auth):
+    app.config['PASSWORD_HASH_METHOD']='pbkdf2:sha256:1000'
+    assert auth.login().status_code==302
+
+    with app.app_context():
+        pwhash=get_db().execute('SELECT password FROM user WHERE id=1').fetchone()[0]
+    assert pwhash.startswith('pbkdf2:sha256:1000$')
+
+    # the new hash still accepts the same password
+    auth.logout()
+    assert auth.login().status_code==302
+
+
+def test_concurrent_logins_overlap(app,monkeypatch):
+    # four logins must be inside the hash pool at the same time to get past the barrier, which only
+    # happens if none of them holds a database connection while it hashes
+    close_pools(app)
+    app.config.update(DB_POOL_SIZE=1,DB_READ_POOL_SIZE=1)
+    barrier=threading.Barrier(4,timeout=5)
+
+    def check(pwhash,password):
+        barrier.wait()
+        return check_password_hash(pwhash,password)
+
+    monkeypatch.setattr('flaskr.hashing.check_password_hash',check)
+
+    def login(_):
+        return app.test_client().post('/auth/login',data={'username':'test','password':'test'}).status_code
+
+    with ThreadPoolExecutor(4) as executor:
+        assert list(executor.map(login,range(4)))==[302]*4
+    assert not barrier.broken
@@ -0,0 +1,58 @@
+import pytest
+from flaskr import create_app
+from flaskr.db import close_pools, get_db
+from flaskr.metrics import Histogram
+
+
+@pytest.fixture
+def metrics_app(app):
+    app=create_app(dict(app.config,METRICS_ENABLED=True,METRICS_N_PLUS_ONE_THRESHOLD=3))
+    yield app
+    close_pools(app)
+
+
+def test_disabled_by_default(app,client):
+    assert 'flaskr.metrics' not in app.extensions
+    assert client.get('/metrics').status_code==404
+    assert 'Server-Timing' not in client.get('/').headers
+
+
+def test_histogram():
+    histogram=Histogram(buckets=(0.1,1.0))
+    for value in (0.05,0.5,0.5,5):
+        histogram.observe(value)
+    assert histogram.counts==[1,2,1]
+    assert histogram.count==4
+
+
+def test_server_timing(metrics_app):
+    response=metrics_app.test_client().get('/')
+    timing=response.headers['Server-Timing']
+    assert timing.startswith('app;dur=')
+    # posts_generation and the page itself
+    assert 'desc="2 queries"' in timing
+
+
+def test_metrics_endpoint(metrics_app):
+    client=metrics_app.test_client()
+    client.get('/')
+    client.get('/')
+
+    data=client.get('/metrics').get_data(as_text=True)
+    assert 'flaskr_request_duration_seconds_count{endpoint="blog.index"} 2' in data
+    assert 'flaskr_request_duration_seconds_bucket{endpoint="blog.index",le="+Inf"} 2' in data
+    assert 'flaskr_db_pool_hits{pool="read"}' in data
+
+
+def test_n_plus_one(metrics_app,caplog):
+    @metrics_app.route('/loop')
+    def loop():
+        db=get_db()
+        for id in range(5):
+            db.execute('SELECT * FROM post WHERE id=?',(id,)).fetchone()
+        return ''
+
+    client=metrics_app.test_client()
+    client.get('/loop')
+    assert 'Possible N+1 queries in loop' in caplog.text
+    assert 'flaskr_n_plus_one_total{endpoint="loop"} 1' in client.get('/metrics').get_data(as_text=True)
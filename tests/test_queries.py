@@ -0,0 +1,61 @@
+from unittest.mock import patch
+
+from flaskr import queries
+from flaskr.db import MIGRATIONS, get_db, get_pool, upgrade
+
+
+def test_check_queries(app):
+    with app.app_context():
+        plans=queries.check_queries(get_db())
+    assert set(plans)==set(queries.STATEMENTS)
+    assert 'USING INDEX post_created_id' in plans['index_page.first'][0]
+
+
+def test_check_queries_command(runner):
+    result=runner.invoke(args=['check-queries','-v'])
+    assert result.exit_code==0
+    assert 'SEARCH p USING INDEX post_author_created' in result.output
+    assert '{} statements checked.'.format(len(queries.STATEMENTS)) in result.output
+
+
+def test_full_scan_fails(app,client,runner,caplog):
+    with app.app_context():
+        get_db().execute('DROP INDEX post_created_id')
+
+    result=runner.invoke(args=['check-queries'])
+    assert result.exit_code==1
+    assert 'index_page.first: full table scan' in result.output
+
+    # every request fails until an upgrade fixes the schema
+    assert client.get('/').status_code==500
+    assert client.get('/auth/login').status_code==500
+    assert 'full table scan' in caplog.text
+
+    def restore_index(db,batch_size,pause):
+        db.execute('CREATE INDEX post_created_id ON post (created DESC, id DESC)')
+
+    migrations=MIGRATIONS+[(5,'post(created, id) index again',restore_index)]
+    with app.app_context():
+        with patch('flaskr.db.MIGRATIONS',migrations):
+            assert upgrade()==[5]
+    assert client.get('/').status_code==200
+
+
+def test_check_retried_during_upgrade(app,client):
+    # the app starts while the database is still at version 3
+    with app.app_context():
+        db=get_db()
+        db.execute('DROP TABLE posts_generation')
+        db.execute('DELETE FROM schema_version WHERE version=4')
+        db.commit()
+
+    assert client.get('/hello').status_code==500
+
+    with app.app_context():
+        assert upgrade()==[4]
+    assert client.get('/hello').status_code==200
+    assert client.get('/').status_code==200
+
+
+def test_statement_cache(app):
+    assert get_pool(app).cached_statements==app.config['DB_CACHED_STATEMENTS']
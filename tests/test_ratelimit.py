@@ -0,0 +1,86 @@
+import time
+
+import pytest
+from flaskr.cache import LocalCacheClient
+from flaskr.ratelimit import Admission, MemoryStore, SharedStore, get_limiter
+from werkzeug.exceptions import ServiceUnavailable
+
+
+@pytest.mark.parametrize('store',(MemoryStore(),SharedStore(LocalCacheClient())))
+def test_token_bucket(store):
+    # 2 tokens, refilled at 100 per second
+    assert store.consume('k',2,100)==0
+    assert store.consume('k',2,100)==0
+    wait=store.consume('k',2,100)
+    assert 0<wait<=0.01
+    time.sleep(0.02)
+    assert store.consume('k',2,100)==0
+    # other keys have their own bucket
+    assert store.consume('other',2,100)==0
+
+
+def test_sweep_drops_full_buckets():
+    store=MemoryStore(sweep_interval=0)
+    store.consume('refilled',1,1000)
+    store.consume('empty',1,0.001)
+    time.sleep(0.01)
+    store.consume('new',1,0.001)
+    assert len(store)==2
+
+
+def test_login_limited_by_username(app,client,auth,monkeypatch):
+    app.config['RATELIMITS']['username']=(2,60)
+    checked=[]
+    monkeypatch.setattr('flaskr.auth.check_password',lambda *args:checked.append(args))
+
+    auth.login(password='a')
+    auth.login(password='b')
+    response=auth.login()
+    assert response.status_code==429
+    assert int(response.headers['Retry-After'])>=1
+    # the password was never checked for the rejected attempt
+    assert len(checked)==2
+
+    # another account from the same address still gets through
+    assert auth.login(username='other',password='other').status_code==200
+    assert get_limiter(app).stats()['limited']==1
+
+
+def test_register_limited_by_ip(app,client):
+    app.config['RATELIMITS']['ip']=(1,60)
+    assert client.post('/auth/register',data={'username':'','password':''}).status_code==200
+    assert client.post('/auth/register',data={'username':'','password':''}).status_code==429
+    # showing the form isn't limited
+    assert client.get('/auth/register').status_code==200
+
+
+def test_disabled(app,client):
+    app.extensions.pop('flaskr.ratelimit')
+    app.config['RATELIMITS']['ip']=(1,60)
+    for _ in range(3):
+        assert client.post('/auth/register',data={'username':'','password':''}).status_code==200
+
+
+def test_admission_sheds_load():
+    admission=Admission(1,timeout=0.01)
+    admission.enter()
+    with pytest.raises(ServiceUnavailable):
+        admission.enter()
+    assert admission.stats()=={'max_requests':1,'in_flight':1,'shed':1}
+
+    admission.leave()
+    admission.enter()
+    admission.leave()
+
+
+def test_admission_releases_slot(app,client):
+    app.extensions['flaskr.admission']=Admission(1,timeout=0.01)
+    for _ in range(3):
+        assert client.get('/').status_code==200
+        assert client.get('/missing').status_code==404
+
+    # a request held open elsewhere makes the next one wait and then give up
+    app.extensions['flaskr.admission'].enter()
+    response=client.get('/')
+    assert response.status_code==503
+    assert response.headers['Retry-After']=='1'
@@ -0,0 +1,123 @@
+import pickle
+import time
+
+import pytest
+from markupsafe import Markup
+from flaskr import create_app
+from flaskr.cache import local_cache_client
+from flaskr.db import close_pools
+from flaskr.sessions import CacheSessionStore
+
+STORES=[
+    {'SESSION_STORE':'cache','SESSION_CACHE_BACKEND':'memory'},
+    {'SESSION_STORE':'cache','SESSION_CACHE_BACKEND':'shared'},
+    {'SESSION_STORE':'sqlite'},
+]
+
+
+@pytest.fixture(params=STORES,ids=['memory','shared','sqlite'])
+def store_app(app,request):
+    store_app=create_app(dict({
+        'TESTING':True,
+        'DATABASE':app.config['DATABASE'],
+        'PASSWORD_HASH_METHOD':'pbkdf2:sha256:50000',
+    },**request.param))
+    yield store_app
+    close_pools(store_app)
+    local_cache_client.flush_all()
+
+
+def login(client):
+    return client.post('/auth/login',data={'username':'test','password':'test'})
+
+
+def session_cookie(client):
+    cookie=client.get_cookie('session')
+    return cookie.value if cookie is not None else None
+
+
+def test_opaque_cookie(store_app):
+    client=store_app.test_client()
+    interface=store_app.session_interface
+    client.get('/')
+    # nothing stored for anonymous visitors
+    assert session_cookie(client) is None and interface.saves==0
+
+    assert login(client).headers['Location']=='/'
+    sid=session_cookie(client)
+    assert len(sid)==32 and '.' not in sid
+    assert interface.store.load(sid)=={'user_id':1}
+
+    # unchanged sessions are read, never written
+    for _ in range(3):
+        response=client.get('/')
+        assert b'Log Out' in response.data
+        assert 'Set-Cookie' not in response.headers
+    assert interface.saves==1
+
+
+def test_login_rotates_id(store_app):
+    client=store_app.test_client()
+    with client.session_transaction() as session:
+        session['theme']='dark'
+    anonymous=session_cookie(client)
+    assert store_app.session_interface.store.load(anonymous)=={'theme':'dark'}
+
+    login(client)
+    assert session_cookie(client)!=anonymous
+    assert store_app.session_interface.store.load(anonymous) is None
+
+
+def test_server_side_logout(store_app):
+    client=store_app.test_client()
+    login(client)
+    sid=session_cookie(client)
+
+    # a copy of the cookie, e.g. on another device
+    other=store_app.test_client()
+    other.set_cookie('session',sid)
+    assert b'Log Out' in other.get('/').data
+
+    client.get('/auth/logout')
+    assert session_cookie(client) is None
+    assert store_app.session_interface.store.load(sid) is None
+    assert b'Log Out' not in other.get('/').data
+
+
+def test_unknown_id(store_app):
+    client=store_app.test_client()
+    client.set_cookie('session','x'*32)
+    assert b'Log In' in client.get('/').data
+    client.set_cookie('session','forged.cookie')
+    assert b'Log In' in client.get('/').data
+
+
+def test_tagged_json(store_app):
+    store=store_app.session_interface.store
+    data={'_flashes':[('message',Markup('<b>saved</b>'))],'raw':b'\x00\xff'}
+    store.save('s'*32,data,60)
+    assert store.load('s'*32)==data
+
+
+def test_pickle_is_not_loaded(store_app):
+    class Exploit(object):
+        def __reduce__(self):
+            return (exec,("raise AssertionError('unpickled')",))
+
+    client=store_app.test_client()
+    client.set_cookie('session','p'*32)
+    store=store_app.session_interface.store
+    payload=pickle.dumps({'user_id':1,'x':Exploit()})
+    if isinstance(store,CacheSessionStore):
+        store.cache.set('p'*32,payload)
+    else:
+        db=store._connection()
+        db.execute('INSERT INTO session VALUES (?,?,?)',('p'*32,payload,time.time()+60))
+        db.commit()
+        db.close()
+    assert b'Log In' in client.get('/').data
+
+
+def test_unknown_store(app):
+    with pytest.raises(ValueError):
+        create_app({'TESTING':True,'DATABASE':app.config['DATABASE'],'SESSION_STORE':'redis'})
@@ -0,0 +1,47 @@
+from flaskr import create_app
+
+# time from starting the interpreter to the first response, generous enough for a slow CI machine
+BUDGET_MS=3000
+
+
+def test_phases_recorded(app):
+    phases=[name for name,seconds in app.extensions['flaskr.startup']]
+    assert phases[0]=='config'
+    assert 'auth' in phases and 'blog' in phases
+    # metrics is off by default and isn't even imported
+    assert 'metrics' not in phases
+    assert 'metrics' in [name for name,seconds in create_app({'METRICS_ENABLED':True}).extensions['flaskr.startup']]
+
+
+def test_time_to_first_request(runner):
+    result=runner.invoke(args=['startup-profile','--budget',str(BUDGET_MS)])
+    assert result.exit_code==0,result.output
+    assert 'import flask' in result.output
+    assert 'create_app: db' in result.output
+    assert 'first request' in result.output
+
+
+def test_over_budget(runner):
+    result=runner.invoke(args=['startup-profile','--budget','0.001'])
+    assert result.exit_code==1
+    assert 'over the budget' in result.output
+
+
+def test_precompile_templates(app,tmp_path):
+    config={'DATABASE':app.config['DATABASE'],'TEMPLATE_CACHE_DIR':str(tmp_path)}
+    result=create_app(config).test_cli_runner().invoke(args=['precompile-templates','-v'])
+    names=create_app(config).jinja_env.list_templates()
+    assert 'Compiled {} templates'.format(len(names)) in result.output
+    assert 'blog/index.html' in result.output
+    assert len(list(tmp_path.iterdir()))==len(names)
+
+    # a new worker loads them from the cache instead of compiling
+    env=create_app(config).jinja_env
+    env.get_template('blog/index.html')
+    assert env.bytecode_cache.hits>=1
+    assert env.bytecode_cache.misses==0
+
+
+def test_no_auto_reload(app):
+    assert app.jinja_env.auto_reload is False
+    assert create_app({'DEBUG':True}).jinja_env.auto_reload is True
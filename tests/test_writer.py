@@ -0,0 +1,147 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+from flaskr.db import close_pools, get_db
+from flaskr.writer import WriteQueue, WriteTimeout, get_write_queue, wait
+
+
+def test_group_commit(app):
+    write_queue=WriteQueue(app.config['DATABASE'],batch_size=100,max_delay=0.05)
+    futures=[
+        write_queue.submit([('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',('queued %d'%i,''))])
+        for i in range(10)
+    ]
+    ids=[future.result(timeout=5) for future in futures]
+    assert ids==list(range(2,12))
+    # everything that arrived within max_delay went into one transaction
+    assert write_queue.stats()['batches']<10
+    assert write_queue.stats()['operations']==10
+    write_queue.close()
+
+    with app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM post').fetchone()[0]==11
+
+
+def test_failed_operation(app):
+    write_queue=WriteQueue(app.config['DATABASE'],max_delay=0.05)
+    good=write_queue.submit([('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',('good',''))])
+    bad=write_queue.submit([
+        ('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',('half done','')),
+        ('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',(None,'')),
+    ])
+
+    with pytest.raises(sqlite3.IntegrityError):
+        bad.result(timeout=5)
+    assert good.result(timeout=5)==2
+    assert write_queue.stats()['failed']==1
+    write_queue.close()
+
+    with app.app_context():
+        titles=[row[0] for row in get_db().execute('SELECT title FROM post')]
+        assert 'good' in titles and 'half done' not in titles
+
+
+class Unbindable(object):
+    def __conform__(self,protocol):
+        raise ValueError('cannot bind')
+
+
+def test_non_sqlite_error(app):
+    write_queue=WriteQueue(app.config['DATABASE'],max_delay=0.05)
+    bad=write_queue.submit([
+        ('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',('half done','')),
+        ('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',('x',Unbindable())),
+    ])
+    with pytest.raises(ValueError):
+        bad.result(timeout=5)
+    # the operation was rolled back and the transaction is not left open
+    assert write_queue.submit([('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',('after',''))]).result(timeout=5)
+    write_queue.close()
+
+    with app.app_context():
+        titles=[row[0] for row in get_db().execute('SELECT title FROM post')]
+        assert 'after' in titles and 'half done' not in titles
+
+
+def test_after_commit_error(app,caplog):
+    def after_commit():
+        raise ConnectionError('cache is down')
+
+    write_queue=WriteQueue(app.config['DATABASE'],max_delay=0.01,after_commit=after_commit)
+    for title in ('first','second'):
+        # the writer thread survives the hook and keeps committing
+        assert write_queue.submit([('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',(title,''))]).result(timeout=5)
+    write_queue.close()
+    assert 'after_commit failed' in caplog.text
+    assert 'cache is down' in caplog.text
+
+
+def test_create_through_queue(app,client,auth):
+    app.config['WRITE_QUEUE_ENABLED']=True
+    auth.login()
+    client.post('/create',data={'title':'queued','body':''})
+    # the view waited for the commit, and the page cache was invalidated by the writer
+    assert b'queued' in client.get('/').data
+    client.post('/2/update',data={'title':'requeued','body':''})
+    assert b'requeued' in client.get('/').data
+
+    with app.app_context():
+        assert get_write_queue().stats()['operations']==2
+
+
+def test_relaxed_mode(app,client,auth):
+    app.config.update(WRITE_QUEUE_ENABLED=True,WRITE_QUEUE_WAIT=False)
+    auth.login()
+    assert client.post('/1/delete').status_code==302
+
+    # closing the pools flushes the queue first
+    close_pools(app)
+    with app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM post').fetchone()[0]==0
+
+
+def test_relaxed_mode_logs_failures(app,caplog):
+    app.config.update(WRITE_QUEUE_ENABLED=True,WRITE_QUEUE_WAIT=False)
+    with app.app_context():
+        future=get_write_queue().submit([('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',(None,''))])
+        assert wait(future) is None
+    close_pools(app)
+    assert 'Queued write failed' in caplog.text and 'NOT NULL' in caplog.text
+
+
+def test_timeout_cancels_queued_write(app):
+    app.config.update(WRITE_QUEUE_ENABLED=True,DB_POOL_TIMEOUT=0.1)
+    # another process holds the write lock, so the writer is stuck in its first batch
+    blocker=sqlite3.connect(app.config['DATABASE'],check_same_thread=False)
+    blocker.execute('BEGIN IMMEDIATE')
+
+    timer=threading.Timer(0.3,blocker.rollback)
+    try:
+        with app.app_context():
+            write_queue=get_write_queue()
+            first=write_queue.submit([('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',('first',''))])
+            # let the writer take it and block in BEGIN IMMEDIATE
+            while write_queue.stats()['queued']:
+                time.sleep(0.01)
+            time.sleep(0.05)
+            second=write_queue.submit([('INSERT INTO post (title,body,author_id) VALUES (?,?,1)',('second',''))])
+
+            # still queued: cancelled, so a retry after the 503 can't write it twice
+            with pytest.raises(WriteTimeout):
+                wait(second)
+
+            # already running: wait for its commit rather than answer 503
+            timer.start()
+            assert wait(first)==2
+    finally:
+        timer.cancel()
+        blocker.rollback()
+        close_pools(app)
+
+    with app.app_context():
+        titles=[row[0] for row in get_db().execute('SELECT title FROM post')]
+        assert 'first' in titles and 'second' not in titles
+    assert second.cancelled()
+    blocker.close()